@@ -10,6 +10,8 @@ Built-in providers:
 - multi
 - memcache
 - s3
+- lmdb
+- mbtiles
 
 Example built-in cache, for JSON configuration file:
 
@@ -44,20 +46,66 @@ The save() method accepts an additional argument before the others:
 
 - body: raw content to save to the cache.
 
+A cache may also provide a save_many() method, used to save all the tiles
+of a metatile at once. It accepts a list of bodies and a list of coordinates
+in place of the single body and coord arguments to save().
+
+A cache may also provide a remove_area() method, used by tilestache-clean.py
+to remove every tile in an area at once instead of one tile at a time. It
+accepts a layer, a list of zoom levels, a bbox of upper-left and lower-right
+Coordinates, and a list of formats; see TileStache.Core.areaRanges() for the
+tiles that make up an area. Call the remove_area() function here to use it
+where available, with plain per-tile removal in parallel for other caches.
+
+Disk, S3 and Multi caches also provide bump_generation(), which accepts a layer
+and makes every cached tile of it disappear at once; see TileStache.Generations.
+
+Any cache configuration may also include a "lock" dictionary to replace the
+cache's own lock() and unlock() methods with a separate lock manager, see
+TileStache.Locks for details:
+
+    "cache": {
+      "name": "Disk",
+      "path": "/tmp/stache",
+      "lock": {"name": "file", "path": "/tmp/stache-locks"}
+    }
+
 TODO: add stale_lock_timeout and cache_lifespan to cache API in v2.
 """
 
 import os
 import sys
 import time
+import errno
 import gzip
+import Queue
+import logging
+
+from threading import Thread, Lock
+from multiprocessing.pool import ThreadPool
+from itertools import islice
+
+from struct import Struct
+from StringIO import StringIO
 
 from tempfile import mkstemp
 from os.path import isdir, exists, dirname, basename, join as pathjoin
 
-from .Core import KnownUnknown
+from ModestMaps.Core import Coordinate
+
+from .Core import KnownUnknown, areaRanges
 from . import Memcache
 from . import S3
+from . import LMDB
+from . import MBTiles
+from .Generations import Generations, Reaper
+from .Locks import File as FileLocks
+
+# bundle file header: magic string, columns and rows,
+# followed by one (offset, length) entry for each tile.
+_bundle_magic = 'TSB1'
+_bundle_head = Struct('>4sHH')
+_bundle_entry = Struct('>II')
 
 def getCacheByName(name):
     """ Retrieve a cache object by name.
@@ -79,6 +127,12 @@ def getCacheByName(name):
     elif name.lower() == 's3':
         return S3.Cache
 
+    elif name.lower() == 'lmdb':
+        return LMDB.Cache
+
+    elif name.lower() == 'mbtiles':
+        return MBTiles.Cache
+
     raise Exception('Unknown cache name: "%s"' % name)
 
 class Test:
@@ -170,27 +224,87 @@ class Disk:
           are safe or portable. For an example tile 12/656/1582.png, "portable"
           creates matching directory trees while "portable" guarantees directories
           with fewer files, e.g. 12/000/656/001/582.png. Defaults to safe.
+          A third choice, "bundle", stores blocks of tiles together in single
+          bundle files, see below.
         - gzip: optional list of file formats that should be stored in a
           compressed form. Defaults to "txt", "text", "json", and "xml".
           Provide an empty list in the configuration for no compression.
+        - bundle: optional number of rows and columns of tiles per bundle file
+          when dirs is "bundle". Defaults to the size of each layer's metatile.
+        - generations: optional boolean flag to keep each layer's tiles in
+          numbered generations, see below. Defaults to false.
+        - generation_ttl: optional number of seconds that each process keeps
+          its copy of a layer's generation number. Defaults to 5.
 
         If your configuration file is loaded from a remote location, e.g.
         "http://example.com/tilestache.cfg", the path *must* be an unambiguous
         filesystem path, e.g. "file:///tmp/cache"
+
+        Bundles keep the number of files down for very large caches. Each bundle
+        file holds a square block of tiles, e.g. 12/000/164/000/395.png.bundle
+        for tile 12/656/1582.png in a 4x4 bundle. A bundle starts with a small
+        fixed-size index of offsets and lengths for every tile, followed by the
+        tile contents. A whole metatile is written to a bundle at once, and a
+        single tile is read with one seek into the index. Bundles are best used
+        with the default bundle size matching the layer metatile, so that each
+        bundle is written whole by the render that holds its lock. A bundle
+        that's only partly changed, by a larger bundle size or by a removal, is
+        read and written again while holding a flock() on a file in a
+        "bundle-locks" directory in the cache path, so that concurrent writers
+        don't lose each other's tiles.
+
+        With generations, tiles are kept in a directory for the current
+        generation of their layer, e.g. osm/g3/12/000/656/001/582.png, and the
+        number is kept in a small file, e.g. osm/generation. Call
+        bump_generation() to move a layer to a new, empty generation at once;
+        old generations are removed in the background by a low-priority
+        TileStache.Generations.Reaper thread in the same process. Tiles cached
+        before generations were turned on are left alone.
     """
-    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split()):
+    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split(), bundle=None, generations=False, generation_ttl=5):
         self.cachepath = path
         self.umask = umask
         self.dirs = dirs
         self.gzip = [format.lower() for format in gzip]
+        self.bundle = bundle
+        self.bundle_locks = FileLocks(pathjoin(path, 'bundle-locks'), umask)
+
+        self.generations = None
+        self.reaper = None
+
+        if generations:
+            self.generations = Generations(self._read_generation, self._write_generation, generation_ttl)
+            self.reaper = Reaper(delay=generation_ttl * 2)
 
     def _is_compressed(self, format):
         return format.lower() in self.gzip
     
+    def _bundle_size(self, layer):
+        """ Return columns, rows of a bundle for a layer.
+        """
+        if self.bundle:
+            return int(self.bundle), int(self.bundle)
+        
+        return int(layer.metatile.columns), int(layer.metatile.rows)
+    
+    def _bundle_offset(self, layer, coord):
+        """ Return the index position of a tile within its bundle.
+        """
+        columns, rows = self._bundle_size(layer)
+        return (int(coord.row) % rows) * columns + (int(coord.column) % columns)
+    
+    def _layerpath(self, layer):
+        """ Return the directory of a layer's tiles, relative to the cache path.
+        """
+        if self.generations is None:
+            return layer.name()
+        
+        return os.sep.join( (layer.name(), 'g%d' % self.generations.get(layer.name())) )
+    
     def _filepath(self, layer, coord, format):
         """
         """
-        l = layer.name()
+        l = self._layerpath(layer)
         z = '%d' % coord.zoom
         e = format.lower()
         e += self._is_compressed(format) and '.gz' or ''
@@ -210,8 +324,18 @@ class Disk:
 
             filepath = os.sep.join( (l, z, x, y + '.' + e) )
             
+        elif self.dirs == 'bundle':
+            columns, rows = self._bundle_size(layer)
+            x = '%06d' % (int(coord.column) / columns)
+            y = '%06d' % (int(coord.row) / rows)
+
+            x1, x2 = x[:3], x[3:]
+            y1, y2 = y[:3], y[3:]
+            
+            filepath = os.sep.join( (l, z, x1, x2, y1, y2 + '.' + e + '.bundle') )
+            
         else:
-            raise KnownUnknown('Please provide a valid "dirs" parameter to the Disk cache, either "safe" or "portable" but not "%s"' % self.dirs)
+            raise KnownUnknown('Please provide a valid "dirs" parameter to the Disk cache, either "safe", "portable" or "bundle" but not "%s"' % self.dirs)
 
         return filepath
 
@@ -253,7 +377,7 @@ class Disk:
                 os.makedirs(lockpath, 0777&~self.umask)
                 break
             except OSError, e:
-                if e.errno != 17:
+                if e.errno != errno.EEXIST:
                     raise
                 time.sleep(.2)
             finally:
@@ -277,18 +401,169 @@ class Disk:
         """
         fullpath = self._fullpath(layer, coord, format)
         
+        if self.dirs == 'bundle':
+            columns, rows = self._bundle_size(layer)
+            self._change_bundle(fullpath, columns, rows, {self._bundle_offset(layer, coord): None}, format)
+            return
+        
+        _remove_file(fullpath)
+    
+    def remove_area(self, layer, zooms, bbox, formats):
+        """ Remove every cached tile in an area, in each of a list of formats.
+
+            Each directory that might hold tiles in the area is listed just
+            once, and only the files found there are removed, instead of
+            trying every possible tile. Bundles that lie completely inside
+            the area are removed without being read.
+        """
+        suffixes = {}
+
+        for format in formats:
+            suffix = format.lower() + (self._is_compressed(format) and '.gz' or '')
+            suffix += (self.dirs == 'bundle') and '.bundle' or ''
+            suffixes[suffix] = format
+
+        for (zoom, left, top, right, bottom) in areaRanges(zooms, bbox):
+            zoompath = pathjoin(self.cachepath, self._layerpath(layer), '%d' % zoom)
+
+            if self.dirs != 'bundle':
+                for (fullpath, column, row, suffix) in self._list_area(zoompath, left, top, right, bottom, suffixes):
+                    _remove_file(fullpath)
+
+                continue
+
+            columns, rows = self._bundle_size(layer)
+            bundles = self._list_area(zoompath, left // columns, top // rows,
+                                      (right - 1) // columns + 1, (bottom - 1) // rows + 1, suffixes)
+
+            for (fullpath, bundle_column, bundle_row, suffix) in bundles:
+                xmin, ymin = bundle_column * columns, bundle_row * rows
+
+                if left <= xmin and xmin + columns <= right and top <= ymin and ymin + rows <= bottom:
+                    _remove_file(fullpath)
+                    continue
+
+                changes = {}
+
+                for row in range(max(top, ymin), min(bottom, ymin + rows)):
+                    for column in range(max(left, xmin), min(right, xmin + columns)):
+                        changes[(row - ymin) * columns + (column - xmin)] = None
+
+                self._change_bundle(fullpath, columns, rows, changes, suffixes[suffix])
+
+    def _list_area(self, zoompath, left, top, right, bottom, suffixes):
+        """ Generate (fullpath, column, row, suffix) tuples for files in an area of one zoom level.
+
+            Column and row are tile numbers, or bundle numbers for bundles,
+            and only files with one of the given suffixes are listed.
+        """
+        if self.dirs == 'portable':
+            for x in _listdir(zoompath):
+                column = _number(x)
+
+                if column is None or not left <= column < right:
+                    continue
+
+                for name in _listdir(pathjoin(zoompath, x)):
+                    y, dot, suffix = name.partition('.')
+                    row = _number(y)
+
+                    if suffix in suffixes and row is not None and top <= row < bottom:
+                        yield pathjoin(zoompath, x, name), column, row, suffix
+
+        elif self.dirs in ('safe', 'bundle'):
+            for x1 in _listdir(zoompath):
+                if not _may_hold(x1, left, right):
+                    continue
+
+                for x2 in _listdir(pathjoin(zoompath, x1)):
+                    column = _number(x1 + x2)
+
+                    if column is None or not left <= column < right:
+                        continue
+
+                    for y1 in _listdir(pathjoin(zoompath, x1, x2)):
+                        if not _may_hold(y1, top, bottom):
+                            continue
+
+                        for name in _listdir(pathjoin(zoompath, x1, x2, y1)):
+                            y2, dot, suffix = name.partition('.')
+                            row = _number(y1 + y2)
+
+                            if suffix in suffixes and row is not None and top <= row < bottom:
+                                yield pathjoin(zoompath, x1, x2, y1, name), column, row, suffix
+
+        else:
+            raise KnownUnknown('Please provide a valid "dirs" parameter to the Disk cache, either "safe", "portable" or "bundle" but not "%s"' % self.dirs)
+        
+    def bump_generation(self, layer):
+        """ Move a layer to a new generation, so that none of its cached tiles are found.
+        
+            Returns the new generation number. Older generations are
+            removed in the background once other processes have caught up.
+        """
+        if self.generations is None:
+            raise KnownUnknown('Disk cache at "%s" has no generations, set "generations" to true to use them' % self.cachepath)
+        
+        number = self.generations.bump(layer.name())
+        self.reaper.put(self._reap_generations, layer.name(), number)
+        
+        return number
+    
+    def _read_generation(self, name):
+        """ Return the generation number of a layer from its file, or None.
+        """
         try:
-            os.remove(fullpath)
-        except OSError, e:
-            # errno=2 means that the file does not exist, which is fine
-            if e.errno != 2:
+            return int(open(pathjoin(self.cachepath, name, 'generation')).read())
+        except IOError, e:
+            if e.errno != errno.ENOENT:
                 raise
+            return None
+    
+    def _write_generation(self, name, number):
+        """ Write the generation number of a layer to its file.
+        """
+        self._write('%d' % number, pathjoin(self.cachepath, name, 'generation'), 'generation')
+    
+    def _reap_generations(self, name, number):
+        """ Remove every generation of a layer before a number, yielding after each few files.
+        """
+        layerpath = pathjoin(self.cachepath, name)
+        
+        for generation in _listdir(layerpath):
+            if generation[:1] != 'g' or _number(generation[1:]) is None or _number(generation[1:]) >= number:
+                continue
+            
+            for (dirpath, dirnames, filenames) in os.walk(pathjoin(layerpath, generation), topdown=False):
+                for (index, filename) in enumerate(filenames):
+                    _remove_file(pathjoin(dirpath, filename))
+                    
+                    if index % 100 == 99:
+                        yield
+                
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    # someone is still writing here, leave it for next time.
+                    pass
+                
+                yield
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
         fullpath = self._fullpath(layer, coord, format)
         
+        if self.dirs == 'bundle':
+            columns, rows = self._bundle_size(layer)
+            offset = self._bundle_offset(layer, coord)
+            body = _read_bundle_tile(fullpath, columns, rows, offset, layer.cache_lifespan)
+
+            if body and self._is_compressed(format):
+                return gzip.GzipFile(fileobj=StringIO(body), mode='r').read()
+
+            return body
+        
         if not exists(fullpath):
             return None
 
@@ -307,13 +582,75 @@ class Disk:
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
+        if self.dirs == 'bundle':
+            return self.save_many([body], layer, [coord], format)
+        
         fullpath = self._fullpath(layer, coord, format)
         
+        if self._is_compressed(format):
+            body = _gzip(body)
+        
+        self._write(body, fullpath, format)
+    
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles, such as all the tiles of a metatile.
+        
+            With bundles, each bundle file is written just once.
+        """
+        if self.dirs != 'bundle':
+            for (body, coord) in zip(bodies, coords):
+                self.save(body, layer, coord, format)
+            
+            return
+        
+        columns, rows = self._bundle_size(layer)
+        bundles = {}
+        
+        for (body, coord) in zip(bodies, coords):
+            fullpath = self._fullpath(layer, coord, format)
+            offset = self._bundle_offset(layer, coord)
+            
+            if self._is_compressed(format):
+                body = _gzip(body)
+            
+            bundles.setdefault(fullpath, {})[offset] = body
+        
+        for (fullpath, saved) in bundles.items():
+            self._change_bundle(fullpath, columns, rows, saved, format)
+    
+    def _change_bundle(self, fullpath, columns, rows, changes, format):
+        """ Change some of the tiles in a bundle file, holding its lock.
+        
+            Changes is a dictionary of tile bodies by bundle offset, with None
+            to remove a tile. A bundle left with no tiles is removed.
+        """
+        self.bundle_locks.acquire(fullpath)
+        
+        try:
+            if len(changes) == columns * rows:
+                # a complete bundle can be written without looking.
+                bodies = [None] * (columns * rows)
+            else:
+                bodies = _read_bundle(fullpath, columns, rows) or [None] * (columns * rows)
+            
+            for (offset, body) in changes.items():
+                bodies[offset] = body
+            
+            if [body for body in bodies if body]:
+                self._write(_pack_bundle(columns, rows, bodies), fullpath, format)
+            else:
+                _remove_file(fullpath)
+        finally:
+            self.bundle_locks.release(fullpath)
+    
+    def _write(self, body, fullpath, format):
+        """ Atomically write raw file contents to a full path.
+        """
         try:
             umask_old = os.umask(self.umask)
             os.makedirs(dirname(fullpath), 0777&~self.umask)
         except OSError, e:
-            if e.errno != 17:
+            if e.errno != errno.EEXIST:
                 raise
         finally:
             os.umask(umask_old)
@@ -322,15 +659,8 @@ class Disk:
         suffix += self._is_compressed(format) and '.gz' or ''
 
         fh, tmp_path = mkstemp(dir=self.cachepath, suffix=suffix)
-        
-        if self._is_compressed(format):
-            os.close(fh)
-            tmp_file = gzip.open(tmp_path, 'w')
-            tmp_file.write(body)
-            tmp_file.close()
-        else:
-            os.write(fh, body)
-            os.close(fh)
+        os.write(fh, body)
+        os.close(fh)
         
         try:
             os.rename(tmp_path, fullpath)
@@ -340,6 +670,152 @@ class Disk:
 
         os.chmod(fullpath, 0666&~self.umask)
 
+def _listdir(path):
+    """ Return a list of names in a directory, empty if there's no such directory.
+    """
+    try:
+        return os.listdir(path)
+    except OSError, e:
+        # it's missing or not a directory
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return []
+
+def _number(name):
+    """ Return the integer value of a file or directory name, or None.
+    """
+    try:
+        return int(name)
+    except ValueError:
+        return None
+
+def _may_hold(prefix, start, stop):
+    """ Return true if a directory of a thousand numbers could hold one in a range.
+    
+        Prefix is the first half of a six-digit number, as in "safe" and
+        "bundle" Disk layouts; longer and negative numbers are never ruled out.
+    """
+    number = _number(prefix)
+    
+    if number is None:
+        return False
+    
+    if prefix.startswith('-') or stop > 1000000:
+        return True
+    
+    return number * 1000 < stop and start < (number + 1) * 1000
+
+def _remove_file(fullpath):
+    """ Remove a file, if it's still there.
+    """
+    try:
+        os.remove(fullpath)
+    except OSError, e:
+        # the file does not exist, which is fine
+        if e.errno != errno.ENOENT:
+            raise
+
+def _gzip(body):
+    """ Return a gzip-compressed copy of a body.
+    """
+    buff = StringIO()
+    file = gzip.GzipFile(fileobj=buff, mode='w')
+    file.write(body)
+    file.close()
+    
+    return buff.getvalue()
+
+def _bundle_header_size(columns, rows):
+    """ Return the byte length of a bundle index header.
+    """
+    return _bundle_head.size + _bundle_entry.size * columns * rows
+
+def _pack_bundle(columns, rows, bodies):
+    """ Return complete bundle file contents for a list of tile bodies.
+    
+        Bodies are ordered left-to-right, top-to-bottom, None where missing.
+    """
+    head = [_bundle_head.pack(_bundle_magic, columns, rows)]
+    offset = _bundle_header_size(columns, rows)
+    
+    for body in bodies:
+        length = body and len(body) or 0
+        head.append(_bundle_entry.pack(length and offset, length))
+        offset += length
+    
+    return ''.join(head + [body for body in bodies if body])
+
+def _read_bundle_head(file, columns, rows):
+    """ Return a list of (offset, length) index entries from an open bundle file.
+    
+        Returns None if the bundle doesn't match the expected size.
+    """
+    head = file.read(_bundle_header_size(columns, rows))
+    
+    if len(head) != _bundle_header_size(columns, rows):
+        return None
+    
+    if _bundle_head.unpack(head[:_bundle_head.size]) != (_bundle_magic, columns, rows):
+        return None
+    
+    entries = []
+    
+    for start in range(_bundle_head.size, len(head), _bundle_entry.size):
+        entries.append(_bundle_entry.unpack(head[start:start + _bundle_entry.size]))
+    
+    return entries
+
+def _read_bundle(fullpath, columns, rows):
+    """ Return a list of all tile bodies in a bundle file, None where missing.
+    
+        Returns None if the bundle doesn't exist or doesn't match the expected size.
+    """
+    try:
+        file = open(fullpath, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    
+    try:
+        entries = _read_bundle_head(file, columns, rows)
+        contents = file.read()
+    finally:
+        file.close()
+    
+    if entries is None:
+        return None
+    
+    start = _bundle_header_size(columns, rows)
+    return [length and contents[offset - start:offset - start + length] or None
+            for (offset, length) in entries]
+
+def _read_bundle_tile(fullpath, columns, rows, index, lifespan):
+    """ Return a single tile body from a bundle file, or None if it's not there.
+    """
+    try:
+        file = open(fullpath, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    
+    try:
+        if lifespan and time.time() - os.fstat(file.fileno()).st_mtime > lifespan:
+            return None
+        
+        entries = _read_bundle_head(file, columns, rows)
+        
+        if entries is None or not entries[index][1]:
+            return None
+        
+        offset, length = entries[index]
+        file.seek(offset)
+        return file.read(length)
+    
+    finally:
+        file.close()
+
 class Multi:
     """ Caches tiles to multiple, ordered caches.
         
@@ -347,7 +823,8 @@ class Multi:
         example a combination of Memcache and S3 to take advantage of the high
         speed of memcache and the high capacity of S3. Each tier of caching is
         checked sequentially when reading from the cache, while all tiers are
-        used together for writing. Locks are only used with the first cache.
+        used together for writing. Locks are taken from one tier at a time,
+        as described below.
         
         Example configuration:
         
@@ -373,51 +850,536 @@ class Multi:
             most remote cache should be at the end. Memcache and S3 together
             make a great pair.
 
+          background
+            Optional list of tier positions, counting from zero, whose writes
+            should happen in the background instead of making each request
+            wait. Defaults to none.
+          
+          promote
+            Optional string saying how a tile found in a later tier is copied
+            back to earlier tiers: "sync" while the request waits, "background"
+            through the same queues as background tiers, or "none" not at all.
+            Defaults to "sync".
+          
+          queue
+            Optional number of writes that may wait in the background for each
+            tier. Defaults to 256.
+          
+          wait
+            Optional number of seconds to wait for room in a full background
+            queue before giving up on a write. Defaults to 1.
+          
+          hedge
+            Optional number of milliseconds to wait for a tier to answer a read
+            before asking the next tier at the same time. Defaults to none,
+            so that each tier is read only after the one before it has missed.
+            Hedged reads are made by a small pool of threads, four per tier.
+
+          failures
+            Optional number of errors in a row after which a tier is taken
+            out of use for a while. Defaults to 3.
+          
+          ejection
+            Optional number of seconds that a failing tier is left out of use
+            before it's tried again. Defaults to 30.
+
+        Background writes are handed to one writer thread per tier. When a
+        tier falls so far behind that its queue stays full for the whole wait,
+        the write is skipped, and further writes to that tier are skipped
+        without waiting until its queue has drained to half full.
+        
+        The health of every tier is tracked as a moving average of its error
+        rate and its response time. A tier that fails too many times in a row
+        is ejected: it's skipped by reads, writes and locks until the ejection
+        period is over, so a dead memcache server costs nothing instead of a
+        connection timeout on every request. Locks are taken from the first
+        healthy tier, failing over to later tiers in order. Call health() for
+        a monitoring report on each tier.
+        
+        bump_generation() only reaches tiers that have generations, i.e. Disk
+        and S3 caches with "generations" turned on. Memcache tiers have none,
+        so with Memcache in front of S3 the old tiles are still served from
+        memcache after a bump until they expire; give Memcache a short
+        lifespan, or change its revision, when layers are bumped.
     """
-    def __init__(self, tiers):
+    def __init__(self, tiers, background=[], promote='sync', queue=256, wait=1, hedge=None, failures=3, ejection=30):
+        if promote not in ('sync', 'background', 'none'):
+            raise KnownUnknown('Please provide a valid "promote" parameter to the Multi cache, either "sync", "background" or "none" but not "%s"' % promote)
+        
         self.tiers = tiers
+        self.promote = promote
+        self.hedge = hedge
+        
+        self.tier_health = [TierHealth(failures, ejection) for cache in tiers]
+        self.writers = [WriteBehind(cache, queue, wait, health) for (cache, health) in zip(tiers, self.tier_health)]
+        self.background = [index in background for index in range(len(tiers))]
+        
+        # tier that holds each current lock, so unlock() can find it.
+        self.lock_tiers = {}
+        
+        # threads for hedged reads, started in the process that uses them.
+        self.reader_pool, self.reader_pid = None, None
+        self.reader_guard = Lock()
+
+    def _readers(self):
+        """ Return a pool of threads for hedged reads in this process.
+        """
+        with self.reader_guard:
+            if self.reader_pid != os.getpid():
+                self.reader_pool = ThreadPool(4 * len(self.tiers))
+                self.reader_pid = os.getpid()
+            
+            return self.reader_pool
+
+    def _call(self, index, method, *args):
+        """ Call a method on one tier, keeping track of its health.
+        """
+        health = self.tier_health[index]
+        start = time.time()
+        
+        try:
+            result = method(*args)
+        except:
+            health.failed(time.time() - start)
+            raise
+        
+        health.succeeded(time.time() - start)
+        return result
+
+    def _save(self, index, bodies, layer, coords, format, background):
+        """ Save a list of tiles to one tier, in the background if asked.
+        
+            Ejected tiers are skipped, and errors are logged but not raised.
+        """
+        if not self.tier_health[index].available():
+            return
+        
+        if background:
+            self.writers[index].put(_save_many, bodies, layer, coords, format)
+            return
+        
+        try:
+            self._call(index, _save_many, self.tiers[index], bodies, layer, coords, format)
+        except Exception, e:
+            logging.error('TileStache.Caches.Multi._save() tier %d: %s', index, e)
+
+    def health(self):
+        """ Return a list of health reports, one dictionary for each tier.
+        """
+        reports = []
+        
+        for (index, cache) in enumerate(self.tiers):
+            report = self.tier_health[index].report()
+            report.update(self.writers[index].report())
+            report.update(dict(tier=index, cache=cache.__class__.__name__))
+            reports.append(report)
+        
+        return reports
 
     def lock(self, layer, coord, format):
-        """ Acquire a cache lock for this tile in the first tier.
+        """ Acquire a cache lock for this tile in the first healthy tier.
         
             Returns nothing, but blocks until the lock has been acquired.
+            Ejected tiers are only tried when no tier is healthy.
         """
-        return self.tiers[0].lock(layer, coord, format)
+        healthy = [index for index in range(len(self.tiers)) if self.tier_health[index].available()]
+        ejected = [index for index in range(len(self.tiers)) if index not in healthy]
+        
+        for index in healthy + ejected:
+            try:
+                self._call(index, self.tiers[index].lock, layer, coord, format)
+            except Exception, e:
+                logging.warning('TileStache.Caches.Multi.lock() tier %d failed, trying the next: %s', index, e)
+                error = e
+                continue
+            
+            self.lock_tiers[(layer, coord.zoom, coord.column, coord.row, format)] = index
+            return
+        
+        raise error
     
     def unlock(self, layer, coord, format):
-        """ Release a cache lock for this tile in the first tier.
+        """ Release a cache lock for this tile in the tier that holds it.
         """
-        return self.tiers[0].unlock(layer, coord, format)
+        index = self.lock_tiers.pop((layer, coord.zoom, coord.column, coord.row, format), 0)
+        
+        try:
+            self._call(index, self.tiers[index].unlock, layer, coord, format)
+        except Exception, e:
+            # nothing more to be done, it will go stale.
+            logging.error('TileStache.Caches.Multi.unlock() tier %d: %s', index, e)
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile from every tier.
+        
+            Background tiers get the removal in line with their
+            other writes, so that it isn't undone by an earlier save.
+            If a background queue is too full to take it, the tile
+            is removed right away instead.
+        """
+        for (index, cache) in enumerate(self.tiers):
+            if self.background[index]:
+                if self.writers[index].put(_remove, layer, coord, format):
+                    continue
+            
+            self._call(index, cache.remove, layer, coord, format)
+        
+    def remove_area(self, layer, zooms, bbox, formats):
+        """ Remove every cached tile in an area from every tier.
+        
+            Each tier removes the area with its own remove_area() if it has
+            one, or else one tile at a time with no pool of its own, since
+            callers such as TileStache.Expire already run several removals
+            at once. Background tiers get the removal in line with their other
+            writes, or right away if their queue is full, as in remove().
         """
         for (index, cache) in enumerate(self.tiers):
-            cache.remove(layer, coord, format)
+            if self.background[index]:
+                if self.writers[index].put(_remove_area, layer, zooms, bbox, formats):
+                    continue
+            
+            self._call(index, _remove_area, cache, layer, zooms, bbox, formats)
+        
+    def flush(self):
+        """ Commit batched writes in every tier that has them, e.g. MBTiles.
+        """
+        for cache in self.tiers:
+            if hasattr(cache, 'flush'):
+                cache.flush()
+        
+    def bump_generation(self, layer):
+        """ Move a layer to a new generation in every tier that has generations.
+        
+            Other tiers, e.g. Memcache, still hold and serve the old tiles
+            until they expire, and a warning is logged.
+        """
+        for (index, cache) in enumerate(self.tiers):
+            if hasattr(cache, 'bump_generation'):
+                self._call(index, cache.bump_generation, layer)
+            else:
+                logging.warning('TileStache.Caches.Multi.bump_generation() tier %d has no generations, old tiles of "%s" are still there', index, layer.name())
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
         
             Start at the first tier and work forwards until a cached tile
             is found. When found, save it back to the earlier tiers for faster
-            access on future requests.
+            access on future requests. Ejected tiers are skipped, and a tier
+            that fails is treated as a miss.
         """
-        for (index, cache) in enumerate(self.tiers):
-            body = cache.read(layer, coord, format)
+        if self.hedge is None:
+            for (index, cache) in enumerate(self.tiers):
+                if not self.tier_health[index].available():
+                    continue
+                
+                try:
+                    body = self._call(index, cache.read, layer, coord, format)
+                except Exception, e:
+                    logging.error('TileStache.Caches.Multi.read() tier %d: %s', index, e)
+                    continue
+                
+                if body:
+                    break
+            else:
+                return None
+        
+        else:
+            index, body = self._read_hedged(layer, coord, format)
+            
+            if not body:
+                return None
+        
+        if self.promote != 'none':
+            # save the body in earlier tiers for speedier access
+            for earlier in range(index):
+                background = self.background[earlier] or self.promote == 'background'
+                self._save(earlier, [body], layer, [coord], format, background)
+        
+        return body
+    
+    def _read_hedged(self, layer, coord, format):
+        """ Read a cached tile, asking later tiers if earlier ones are slow.
+        
+            Return the index of the tier where the tile was found and its
+            body, or None for both if it wasn't found anywhere. Once a tile
+            is found, slower reads still underway are left to finish alone.
+        """
+        results = Queue.Queue()
+        tiers = [index for index in range(len(self.tiers)) if self.tier_health[index].available()]
+        
+        def read(index):
+            try:
+                body = self._call(index, self.tiers[index].read, layer, coord, format)
+            except Exception, e:
+                logging.error('TileStache.Caches.Multi._read_hedged() tier %d: %s', index, e)
+                body = None
+            
+            results.put((index, body))
+        
+        def start(index):
+            pool.apply_async(read, (index, ))
+        
+        if not tiers:
+            return None, None
+        
+        pool = self._readers()
+        start(tiers[0])
+        started, pending = 1, 1
+        
+        while pending:
+            try:
+                if started < len(tiers):
+                    index, body = results.get(True, self.hedge / 1000.)
+                else:
+                    index, body = results.get()
+            
+            except Queue.Empty:
+                # the tiers underway are too slow, ask the next one too
+                start(tiers[started])
+                started, pending = started + 1, pending + 1
+                continue
+            
+            pending -= 1
             
             if body:
-                # save the body in earlier tiers for speedier access
-                for cache in self.tiers[:index]:
-                    cache.save(body, layer, coord, format)
-                
-                return body
+                return index, body
+            
+            if started < len(tiers) and not pending:
+                start(tiers[started])
+                started, pending = started + 1, pending + 1
         
-        return None
+        return None, None
     
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         
             Every tier gets a saved copy.
         """
+        self.save_many([body], layer, [coord], format)
+
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles.
+        
+            Every tier gets a saved copy of each.
+        """
         for (index, cache) in enumerate(self.tiers):
+            self._save(index, bodies, layer, coords, format, self.background[index])
+
+class WriteBehind:
+    """ Bounded queue of background writes to a single cache, used by Multi.
+    
+        Writes are carried out in order by a single daemon thread, started
+        when the first write arrives in each process. Optional health is
+        a TierHealth instance that keeps track of how the writes go.
+    """
+    def __init__(self, cache, size, wait, health=None):
+        self.cache = cache
+        self.size = size
+        self.wait = wait
+        self.health = health
+        
+        self.queue = None
+        self.pid = None
+        self.healthy = True
+        self.guard = Lock()
+    
+    def _queue(self):
+        """ Return the write queue for this process, starting a writer if needed.
+        """
+        with self.guard:
+            if self.pid != os.getpid():
+                self.queue = Queue.Queue(self.size)
+                self.pid = os.getpid()
+                
+                writer = Thread(target=self._write, args=(self.queue, ))
+                writer.setDaemon(True)
+                writer.start()
+            
+            return self.queue
+    
+    def _write(self, queue):
+        """ Carry out queued writes forever.
+        """
+        while True:
+            func, args = queue.get()
+            start = time.time()
+            
+            try:
+                func(self.cache, *args)
+            except Exception, e:
+                logging.error('TileStache.Caches.WriteBehind._write() %s: %s', func.__name__, e)
+                
+                if self.health:
+                    self.health.failed(time.time() - start)
+            else:
+                if self.health:
+                    self.health.succeeded(time.time() - start)
+    
+    def report(self):
+        """ Return a dictionary describing the state of the queue.
+        """
+        queued = self.queue and self.pid == os.getpid() and self.queue.qsize() or 0
+        return {'queued writes': queued, 'skipping writes': not self.healthy}
+    
+    def put(self, func, *args):
+        """ Queue a call to func(cache, *args), waiting for room if necessary.
+        
+            Return true if the write was queued, false if it was skipped.
+        """
+        queue = self._queue()
+        
+        if not self.healthy:
+            if queue.qsize() > self.size / 2:
+                return False
+            
+            # caught up enough to try again.
+            self.healthy = True
+        
+        try:
+            queue.put((func, args), True, self.wait)
+        
+        except Queue.Full:
+            logging.warning('TileStache.Caches.WriteBehind.put() skipping writes to %s until its queue drains', self.cache)
+            self.healthy = False
+            return False
+        
+        return True
+
+class TierHealth:
+    """ Health of a single cache tier, used by Multi.
+    
+        Keeps moving averages of error rate and response time, and ejects
+        the tier for a number of seconds after enough failures in a row.
+        Once the ejection is over, one more failure ejects it again, while
+        a single success returns it to full health.
+    """
+    def __init__(self, failures, ejection, alpha=.1):
+        self.failures = failures
+        self.ejection = ejection
+        self.alpha = alpha
+        
+        self.error_rate = 0.
+        self.latency = 0.
+        self.errors = 0
+        self.ejected_until = 0
+    
+    def available(self):
+        """ Return true if the tier is not currently ejected.
+        """
+        return time.time() >= self.ejected_until
+    
+    def _update(self, error, elapsed):
+        """ Move the error rate and latency averages toward a new call.
+        """
+        self.error_rate += self.alpha * (error - self.error_rate)
+        self.latency += self.alpha * (elapsed - self.latency)
+    
+    def succeeded(self, elapsed):
+        """ Note a successful call that took a number of seconds.
+        """
+        self._update(0., elapsed)
+        self.errors = 0
+    
+    def failed(self, elapsed):
+        """ Note a failed call that took a number of seconds.
+        """
+        self._update(1., elapsed)
+        self.errors += 1
+        
+        if self.errors >= self.failures:
+            logging.warning('TileStache.Caches.TierHealth.failed() ejecting tier for %d seconds after %d errors', self.ejection, self.errors)
+            self.ejected_until = time.time() + self.ejection
+    
+    def report(self):
+        """ Return a dictionary describing the health of the tier.
+        """
+        return {'ejected': not self.available(), 'error rate': self.error_rate,
+                'latency': self.latency, 'errors in a row': self.errors}
+
+def _save_many(cache, bodies, layer, coords, format):
+    """ Save a list of tiles to a cache, with save_many() if it's available.
+    """
+    if hasattr(cache, 'save_many'):
+        cache.save_many(bodies, layer, coords, format)
+    else:
+        for (body, coord) in zip(bodies, coords):
             cache.save(body, layer, coord, format)
+
+def _remove(cache, layer, coord, format):
+    """ Remove a tile from a cache.
+    """
+    cache.remove(layer, coord, format)
+
+def _remove_area(cache, layer, zooms, bbox, formats):
+    """ Remove every tile in an area from a cache, with a single worker.
+    """
+    remove_area(cache, layer, zooms, bbox, formats, workers=1)
+
+def remove_area(cache, layer, zooms, bbox, formats, workers=8):
+    """ Remove every tile in an area from a cache, in each of a list of formats.
+    
+        Uses the cache's own remove_area() method if it has one, see
+        TileStache.Core.areaRanges() for the meaning of zooms and bbox.
+        Otherwise, tiles are removed one by one with a pool of workers
+        calling remove() in parallel, or serially with just one worker.
+        The pool is given a bounded chunk of tiles at a time, so a large
+        area is never held in memory all at once.
+    """
+    if hasattr(cache, 'remove_area'):
+        return cache.remove_area(layer, zooms, bbox, formats)
+    
+    def tiles():
+        for (zoom, left, top, right, bottom) in areaRanges(zooms, bbox):
+            for row in range(top, bottom):
+                for column in range(left, right):
+                    for format in formats:
+                        yield Coordinate(row, column, zoom), format
+    
+    def remove((coord, format)):
+        cache.remove(layer, coord, format)
+    
+    if workers <= 1:
+        for tile in tiles():
+            remove(tile)
+        return
+    
+    pool = ThreadPool(workers)
+    stream = tiles()
+    
+    try:
+        while True:
+            chunk = list(islice(stream, workers * 256))
+            
+            if not chunk:
+                break
+            
+            pool.map(remove, chunk, 64)
+    finally:
+        pool.close()
+        pool.join()
+
+class Locked:
+    """ Cache wrapper that hands locking off to a separate lock manager.
+    
+        Used when a cache configuration includes a "lock" dictionary, see
+        TileStache.Locks for details. Every method but lock() and unlock()
+        is passed straight through to the wrapped cache.
+    """
+    def __init__(self, cache, locks):
+        self.cache = cache
+        self.locks = locks
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def lock(self, layer, coord, format):
+        """ Acquire a lock for this tile from the lock manager.
+        
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        return self.locks.lock(layer, coord, format)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a lock for this tile from the lock manager.
+        """
+        return self.locks.unlock(layer, coord, format)
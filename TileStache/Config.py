@@ -77,8 +77,10 @@ from ModestMaps.Core import Coordinate
 
 import Core
 import Caches
+import Locks
 import Providers
 import Geography
+import TileIDs
 
 class Configuration:
     """ A complete site configuration, with a collection of Layer objects.
@@ -138,37 +140,47 @@ class Bounds:
         """
         self.upper_left_high = upper_left_high
         self.lower_right_low = lower_right_low
+        
+        # plain numbers for excludes(), which is called for every tile.
+        self._high, self._low = upper_left_high.zoom, lower_right_low.zoom
+        self._left, self._top = upper_left_high.column, upper_left_high.row
+        self._right, self._bottom = lower_right_low.column, lower_right_low.row
     
     def excludes(self, tile):
-        """ Check a tile Coordinate against the bounds, return true/false.
+        """ Check a tile Coordinate or TileIDs integer against the bounds, return true/false.
         """
-        if tile.zoom > self.upper_left_high.zoom:
+        if isinstance(tile, (int, long)):
+            column, row, zoom = TileIDs.decode(tile)
+        else:
+            column, row, zoom = tile.column, tile.row, tile.zoom
+        
+        if zoom > self._high:
             # too zoomed-in
             return True
         
-        if tile.zoom < self.lower_right_low.zoom:
+        if zoom < self._low:
             # too zoomed-out
             return True
 
         # check the top-left tile corner against the lower-right bound
-        _tile = tile.zoomTo(self.lower_right_low.zoom)
+        scale = 2. ** (self._low - zoom)
         
-        if _tile.column > self.lower_right_low.column:
+        if column * scale > self._right:
             # too far right
             return True
         
-        if _tile.row > self.lower_right_low.row:
+        if row * scale > self._bottom:
             # too far down
             return True
 
         # check the bottom-right tile corner against the upper-left bound
-        __tile = tile.right().down().zoomTo(self.upper_left_high.zoom)
+        scale = 2. ** (self._high - zoom)
         
-        if __tile.column < self.upper_left_high.column:
+        if (column + 1) * scale < self._left:
             # too far left
             return True
         
-        if __tile.row < self.upper_left_high.row:
+        if (row + 1) * scale < self._top:
             # too far up
             return True
         
@@ -186,7 +198,7 @@ class BoundsList:
         self.bounds = bounds
     
     def excludes(self, tile):
-        """ Check a tile Coordinate against the bounds, return false if none match.
+        """ Check a tile Coordinate or TileIDs integer against the bounds, return false if none match.
         """
         for bound in self.bounds:
             if not bound.excludes(tile):   
@@ -289,17 +301,39 @@ def _parseConfigfileCache(cache_dict, dirpath):
             if 'umask' in cache_dict:
                 kwargs['umask'] = int(cache_dict['umask'], 8)
             
-            add_kwargs('dirs', 'gzip')
+            add_kwargs('dirs', 'gzip', 'bundle', 'generations', 'generation_ttl')
         
         elif _class is Caches.Multi:
             kwargs['tiers'] = [_parseConfigfileCache(tier_dict, dirpath)
                                for tier_dict in cache_dict['tiers']]
+            
+            add_kwargs('background', 'promote', 'queue', 'wait', 'hedge', 'failures', 'ejection')
     
         elif _class is Caches.Memcache.Cache:
-            add_kwargs('servers', 'lifespan', 'revision')
+            add_kwargs('servers', 'lifespan', 'revision', 'compress', 'generation_zoom')
     
         elif _class is Caches.S3.Cache:
-            add_kwargs('bucket', 'access', 'secret')
+            add_kwargs('bucket', 'access', 'secret', 'uploaders', 'host', 'port', 'secure', 'generations', 'generation_ttl')
+    
+        elif _class is Caches.LMDB.Cache:
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'LMDB cache path')
+            
+            if 'umask' in cache_dict:
+                kwargs['umask'] = int(cache_dict['umask'], 8)
+            
+            add_kwargs('size')
+    
+        elif _class is Caches.MBTiles.Cache:
+            kwargs['filename'] = enforcedLocalPath(cache_dict['filename'], dirpath, 'MBTiles cache filename')
+            
+            if 'umask' in cache_dict:
+                kwargs['umask'] = int(cache_dict['umask'], 8)
+            
+            if 'tileset name' in cache_dict:
+                # "name" already picks the cache class.
+                kwargs['name'] = cache_dict['tileset name']
+            
+            add_kwargs('dedupe')
     
         else:
             raise Exception('Unknown cache: %s' % cache_dict['name'])
@@ -313,9 +347,43 @@ def _parseConfigfileCache(cache_dict, dirpath):
         raise Exception('Missing required cache name or class: %s' % json_dumps(cache_dict))
 
     cache = _class(**kwargs)
+    
+    if 'lock' in cache_dict:
+        locks = _parseConfigfileLock(cache_dict['lock'], dirpath)
+        cache = Caches.Locked(cache, locks)
 
     return cache
 
+def _parseConfigfileLock(lock_dict, dirpath):
+    """ Used by parseConfigfile() to parse just the lock parts of a config.
+    """
+    if 'name' in lock_dict:
+        _class = Locks.getLockByName(lock_dict['name'])
+        kwargs = {}
+        
+        if _class is Locks.File:
+            kwargs['path'] = enforcedLocalPath(lock_dict['path'], dirpath, 'File lock path')
+            
+            if 'umask' in lock_dict:
+                kwargs['umask'] = int(lock_dict['umask'], 8)
+        
+        elif _class is Locks.Memcache:
+            if 'servers' in lock_dict:
+                kwargs['servers'] = lock_dict['servers']
+            
+            if 'revision' in lock_dict:
+                kwargs['revision'] = lock_dict['revision']
+        
+    elif 'class' in lock_dict:
+        _class = loadClassPath(lock_dict['class'])
+        kwargs = lock_dict.get('kwargs', {})
+        kwargs = dict( [(str(k), v) for (k, v) in kwargs.items()] )
+
+    else:
+        raise Exception('Missing required lock name or class: %s' % json_dumps(lock_dict))
+
+    return _class(**kwargs)
+
 def _parseLayerBounds(bounds_dict, projection):
     """
     """
@@ -361,6 +429,9 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     if 'redirects' in layer_dict:
         layer_kwargs['redirects'] = dict(layer_dict['redirects'])
     
+    if 'lock' in layer_dict:
+        layer_kwargs['locks'] = _parseConfigfileLock(layer_dict['lock'], dirpath)
+    
     if 'preview' in layer_dict:
         preview_dict = layer_dict['preview']
         
@@ -448,6 +519,10 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
             else:
                 provider_kwargs['spacing'] = None
             
+            if 'simplify' in provider_dict:
+                provider_kwargs['simplify'] = float(provider_dict['simplify'])
+                provider_kwargs['preserve_topology'] = bool(provider_dict.get('preserve_topology', False))
+            
             if provider_dict.get('clipped', None) == 'padded':
                 provider_kwargs['clipped'] = 'padded'
             else:
@@ -23,6 +23,7 @@ configuration file as a dictionary:
           "bounds": { ... },
           "allowed origin": ...,
           "maximum cache age": ...,
+          "lock": { ... },
           "jpeg options": ...,
           "png options": ...
         }
@@ -64,6 +65,8 @@ configuration file as a dictionary:
   If a request is made for a tile with an extension in the dictionary keys,
   a response can be generated that redirects the client to the same tile
   with another extension.
+- "lock" is an optional dictionary describing a lock manager to use for this
+  layer in place of the cache's own locks, explained in TileStache.Locks.
 - "jpeg options" is an optional dictionary of JPEG creation options, passed
   through to PIL: http://www.pythonware.com/library/pil/handbook/format-jpeg.htm.
 - "png options" is an optional dictionary of PNG creation options, passed
@@ -196,6 +199,22 @@ def _getRecentTile(layer, coord, format):
     
     return None
 
+def areaRanges(zooms, bbox):
+    """ Generate (zoom, left, top, right, bottom) tuples for the tiles of an area.
+
+        Bbox is a pair of upper-left and lower-right Coordinates at any zoom,
+        e.g. the corners of a geographic area from layer.projection. At each
+        zoom the range holds every tile touched by the area: left and top
+        are included, right and bottom excluded, as in Curves.walk().
+    """
+    ul, lr = bbox
+
+    for zoom in zooms:
+        ul_ = ul.zoomTo(zoom).container()
+        lr_ = lr.zoomTo(zoom).container()
+
+        yield zoom, int(ul_.column), int(ul_.row), int(lr_.column) + 1, int(lr_.row) + 1
+
 class Metatile:
     """ Some basic characteristics of a metatile.
     
@@ -226,7 +245,9 @@ class Metatile:
             This is useful as a predictable way to refer to an entire metatile
             by one of its sub-tiles, currently needed to do locking correctly.
         """
-        return self.allCoords(coord)[0]
+        rows, columns = int(self.rows), int(self.columns)
+        
+        return Coordinate(rows * (int(coord.row) / rows), columns * (int(coord.column) / columns), coord.zoom)
 
     def allCoords(self, coord):
         """ Return a list of coordinates for a complete metatile.
@@ -234,18 +255,13 @@ class Metatile:
             Results are guaranteed to be ordered left-to-right, top-to-bottom.
         """
         rows, columns = int(self.rows), int(self.columns)
+        zoom = coord.zoom
         
         # upper-left corner of coord's metatile
         row = rows * (int(coord.row) / rows)
         column = columns * (int(coord.column) / columns)
         
-        coords = []
-        
-        for r in range(rows):
-            for c in range(columns):
-                coords.append(Coordinate(row + r, column + c, coord.zoom))
-
-        return coords
+        return [Coordinate(r, c, zoom) for r in range(row, row + rows) for c in range(column, column + columns)]
 
 class Layer:
     """ A Layer.
@@ -287,6 +303,9 @@ class Layer:
           redirects:
             Dictionary of per-extension HTTP redirects, treated as lowercase.
 
+          locks:
+            Lock manager to use in place of cache locks, see Locks module.
+
           preview_lat:
             Starting latitude for slippy map layer preview, default 37.80.
 
@@ -299,7 +318,7 @@ class Layer:
           preview_ext:
             Tile name extension for slippy map layer preview, default "png".
     """
-    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None):
+    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, locks=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None):
         self.provider = None
         self.config = config
         self.projection = projection
@@ -311,6 +330,7 @@ class Layer:
         self.allowed_origin = allowed_origin
         self.max_cache_age = max_cache_age
         self.redirects = redirects or dict()
+        self.locks = locks
         
         self.preview_lat = preview_lat
         self.preview_lon = preview_lon
@@ -395,6 +415,7 @@ class Layer:
         if self.doMetatile():
             # tile will be set again later
             tile, surtile = None, tile
+            bodies, others = [], []
             
             for (other, x, y) in subtiles:
                 buff = StringIO()
@@ -402,9 +423,9 @@ class Layer:
                 subtile = surtile.crop(bbox)
                 subtile.save(buff, format)
                 body = buff.getvalue()
-
-                if self.write_cache:
-                    self.config.cache.save(body, self, other, format)
+                
+                bodies.append(body)
+                others.append(other)
                 
                 if other == coord:
                     # the one that actually gets returned
@@ -412,6 +433,16 @@ class Layer:
                 
                 _addRecentTile(self, other, format, body)
 
+            if self.write_cache:
+                cache = self.config.cache
+                
+                if hasattr(cache, 'save_many'):
+                    # let the cache write the whole metatile at once
+                    cache.save_many(bodies, self, others, format)
+                else:
+                    for (body, other) in zip(bodies, others):
+                        cache.save(body, self, other, format)
+
         return tile
     
     def envelope(self, coord):
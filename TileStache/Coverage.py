@@ -0,0 +1,288 @@
+""" Tile coverage of geographic areas, for seeding irregular shapes.
+
+Polygons are read from GeoJSON and projected into tile coordinates. Covered
+tiles are found by descending a quadtree from zoom 0: a tile outside of the
+polygons is pruned along with everything below it, and a tile that lies
+completely inside is listed or counted as a whole block with no more geometry
+tests. Only tiles along the edges of the polygons are tested at every zoom.
+
+Each test clips the rings that reached the parent tile to the square of the
+child, in the manner of Sutherland-Hodgman, and compares the clipped area with
+the area of the tile. The work at each tile is proportional to the number of
+polygon vertices that fall inside it, not to the size of the whole polygon.
+
+Example use:
+
+    polygons = load_polygons(open('area.geojson'), layer.projection)
+
+    count = count_tiles(polygons, [10, 11, 12])
+
+    for coord in list_tiles(polygons, [10, 11, 12]):
+        ...
+
+Tiles of each zoom are listed in Z-order or Hilbert order (see Curves), both
+of which finish each quadrant before starting the next, so that tiles from one
+power-of-two metatile come out together. This module is pure Python and needs
+nothing beyond ModestMaps.
+"""
+from math import floor, ceil
+from random import random
+from bisect import bisect_right
+
+try:
+    from json import load as json_load
+except ImportError:
+    from simplejson import load as json_load
+
+from ModestMaps.Core import Coordinate
+from ModestMaps.Geo import Location
+
+from . import Curves
+
+# extent of the spherical mercator projection.
+_max_latitude = 85.0511287798
+
+# fraction of a tile's area that may be missing from a tile counted as inside.
+_epsilon = 1e-9
+
+# results of a tile test.
+_outside, _partial, _inside = 0, 1, 2
+
+def load_polygons(file, projection):
+    """ Load a list of polygons from a GeoJSON file, in zoom 0 tile coordinates.
+
+        Accepts a FeatureCollection, Feature, GeometryCollection, Polygon or
+        MultiPolygon; other geometries are ignored. Each polygon is returned
+        as a list of rings, outer ring first, and each ring is a list of
+        (column, row) tuples.
+    """
+    polygons = []
+
+    for geometry in _geometries(json_load(file)):
+        if geometry['type'] == 'Polygon':
+            parts = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            parts = geometry['coordinates']
+        else:
+            continue
+
+        for rings in parts:
+            polygons.append([_project_ring(ring, projection) for ring in rings])
+
+    return polygons
+
+def count_tiles(polygons, zooms):
+    """ Return the exact number of tiles that list_tiles() will generate.
+    """
+    count = 0
+
+    for zoom in zooms:
+        for (column, row, z, full) in _walk_roots(polygons, zoom):
+            count += 4 ** (zoom - z)
+
+    return count
+
+def list_tiles(polygons, zooms, order='zorder'):
+    """ Generate a stream of Coordinate objects for tiles covered by the polygons.
+
+        Tiles come zoom by zoom, in "zorder" or "hilbert" order within each zoom.
+    """
+    if order not in ('zorder', 'hilbert'):
+        raise ValueError('Tiles can be listed in "zorder" or "hilbert" order, not "%s"' % order)
+
+    for zoom in zooms:
+        for (column, row, z, full) in _walk_roots(polygons, zoom, order):
+            for (column, row) in _expand(column, row, z, zoom, order):
+                yield Coordinate(row, column, zoom)
+
+def sample_tiles(polygons, zoom, samples, random=random):
+    """ Return a list of up to a number of Coordinates sampled from the covered tiles at a zoom.
+
+        Tiles are spread out by taking one at random from each of equal
+        parts of the quadtree order, so every part of the area is sampled.
+        Uses the blocks found by the quadtree, not a list of every tile.
+    """
+    blocks, counts, total = [], [], 0
+
+    for (column, row, z, full) in _walk_roots(polygons, zoom):
+        blocks.append((column, row, zoom - z))
+        counts.append(total)
+        total += 4 ** (zoom - z)
+
+    if total <= samples:
+        positions = range(total)
+    else:
+        positions = [int((index + random()) * total / samples) for index in range(samples)]
+
+    coords = []
+
+    for position in positions:
+        index = bisect_right(counts, position) - 1
+        column, row, depth = blocks[index]
+        offset = position - counts[index]
+
+        # position within the block, in quadtree order.
+        for level in range(depth):
+            column, row = column * 2, row * 2
+
+        for level in range(depth):
+            column += ((offset >> (2 * level)) & 1) << level
+            row += ((offset >> (2 * level + 1)) & 1) << level
+
+        coords.append(Coordinate(row, column, zoom))
+
+    return coords
+
+def _geometries(geojson):
+    """ Generate a stream of geometries from any GeoJSON object.
+    """
+    if geojson['type'] == 'FeatureCollection':
+        for feature in geojson['features']:
+            for geometry in _geometries(feature):
+                yield geometry
+
+    elif geojson['type'] == 'Feature':
+        if geojson['geometry']:
+            for geometry in _geometries(geojson['geometry']):
+                yield geometry
+
+    elif geojson['type'] == 'GeometryCollection':
+        for geometry in geojson['geometries']:
+            for geometry in _geometries(geometry):
+                yield geometry
+
+    else:
+        yield geojson
+
+def _project_ring(ring, projection):
+    """ Convert a ring of (lon, lat) positions to zoom 0 tile coordinates.
+    """
+    points = []
+
+    for position in ring:
+        lon, lat = position[0], max(-_max_latitude, min(_max_latitude, position[1]))
+        coord = projection.locationCoordinate(Location(lat, lon)).zoomTo(0)
+        points.append((coord.column, coord.row))
+
+    return points
+
+def _walk_roots(polygons, zoom, order='zorder'):
+    """ Generate (column, row, zoom, full) tuples from every zoom 0 tile under the polygons.
+    """
+    points = [point for polygon in polygons for ring in polygon for point in ring]
+
+    if not points:
+        return
+
+    xs, ys = [x for (x, y) in points], [y for (x, y) in points]
+
+    for row in range(int(floor(min(ys))), max(int(ceil(max(ys))), int(floor(min(ys))) + 1)):
+        for column in range(int(floor(min(xs))), max(int(ceil(max(xs))), int(floor(min(xs))) + 1)):
+            for tile in _walk(polygons, column, row, 0, zoom, order):
+                yield tile
+
+def _walk(polygons, column, row, zoom, target, order):
+    """ Generate (column, row, zoom, full) tuples for covered tiles down to a target zoom.
+
+        Each tuple is a single tile at the target zoom, or a tile at a lower
+        zoom that lies completely inside the polygons, with full set to true.
+    """
+    size = .5 ** zoom
+    xmin, ymin = column * size, row * size
+
+    polygons, state = _test(polygons, xmin, ymin, xmin + size, ymin + size)
+
+    if state == _outside:
+        return
+
+    if state == _inside or zoom == target:
+        yield (column, row, zoom, state == _inside)
+        return
+
+    children = [(column * 2 + x, row * 2 + y) for (x, y) in ((0, 0), (1, 0), (0, 1), (1, 1))]
+
+    if order != 'zorder':
+        children.sort(key=lambda (x, y): Curves.index(x, y, zoom + 1, order))
+
+    for (x, y) in children:
+        for tile in _walk(polygons, x, y, zoom + 1, target, order):
+            yield tile
+
+def _expand(column, row, zoom, target, order):
+    """ Generate (column, row) tuples for all tiles at a target zoom below one, in curve order.
+    """
+    depth = target - zoom
+
+    return Curves.walk(column << depth, row << depth, (column + 1) << depth, (row + 1) << depth, order, target)
+
+def _test(polygons, xmin, ymin, xmax, ymax):
+    """ Clip polygons to a box, and return them with _outside, _partial or _inside.
+
+        Polygons may overlap, so a box is only inside if a single
+        polygon covers it.
+    """
+    clipped, area, largest = [], 0., 0.
+
+    for rings in polygons:
+        outer = _clip(rings[0], xmin, ymin, xmax, ymax)
+
+        if len(outer) < 3:
+            continue
+
+        holes = [_clip(ring, xmin, ymin, xmax, ymax) for ring in rings[1:]]
+        holes = [hole for hole in holes if len(hole) >= 3]
+
+        clipped.append([outer] + holes)
+        polygon_area = max(0, _area(outer) - sum(map(_area, holes)))
+        area, largest = area + polygon_area, max(largest, polygon_area)
+
+    box_area = (xmax - xmin) * (ymax - ymin)
+
+    if not clipped or area <= 0:
+        # however small a polygon is, it's only outside if nothing's left.
+        return clipped, _outside
+
+    if largest >= box_area * (1 - _epsilon):
+        return clipped, _inside
+
+    return clipped, _partial
+
+def _clip(ring, xmin, ymin, xmax, ymax):
+    """ Clip a ring to a box, one side at a time.
+    """
+    for (axis, limit, keep_above) in ((0, xmin, True), (0, xmax, False), (1, ymin, True), (1, ymax, False)):
+        if not ring:
+            break
+
+        clipped = []
+        previous = ring[-1]
+
+        for point in ring:
+            inside = (point[axis] >= limit) == keep_above
+            was_inside = (previous[axis] >= limit) == keep_above
+
+            if inside != was_inside:
+                # crossing the side, add the point where it happens
+                t = (limit - previous[axis]) / (point[axis] - previous[axis])
+                other = previous[1 - axis] + t * (point[1 - axis] - previous[1 - axis])
+                clipped.append(axis == 0 and (limit, other) or (other, limit))
+
+            if inside:
+                clipped.append(point)
+
+            previous = point
+
+        ring = clipped
+
+    return ring
+
+def _area(ring):
+    """ Return the unsigned area of a ring.
+    """
+    area = 0.
+
+    for (index, (x1, y1)) in enumerate(ring):
+        x2, y2 = ring[index - 1]
+        area += (x2 - x1) * (y2 + y1)
+
+    return abs(area) / 2
@@ -0,0 +1,188 @@
+""" Space-filling curves for ordering tiles within a zoom level.
+
+Tiles visited in row order jump from one edge of an area to the other at the
+end of every row, so consecutive tiles often need unrelated parts of a data
+source and land in unrelated parts of a cache. Tiles visited along a Z-order
+or Hilbert curve stay close together: each quadrant of the grid is finished
+before the next one is started, at every scale. The Hilbert curve also never
+jumps between neighboring quadrants, so consecutive tiles always touch.
+
+Three orders are known:
+
+  row
+    Row by row from the top, left to right within each row.
+
+  zorder
+    Morton order: upper-left, upper-right, lower-left and lower-right
+    quadrant in turn, at every scale. This is also the order of quadkeys.
+
+  hilbert
+    Hilbert curve, starting in the upper-left corner of the grid.
+
+Example use:
+
+    for (column, row) in walk(left, top, right, bottom, 'hilbert'):
+        ...
+
+    position = index(column, row, zoom, 'zorder')
+    column, row = coordinate(position, zoom, 'zorder')
+
+Rectangles are walked by descending a quadtree and pruning quadrants that
+fall outside, so nothing is sorted beyond a small block at a time and
+memory use doesn't grow with the size of the area.
+"""
+from . import TileIDs
+
+orders = ('row', 'zorder', 'hilbert')
+
+# largest block of cells to sort all at once, as a power of two.
+_block_bits = 5
+
+def index(column, row, bits, order):
+    """ Return the position of a cell along a curve through a grid 2^bits cells on a side.
+
+        For a tile grid, bits is the zoom level.
+    """
+    column, row = int(column), int(row)
+
+    if order == 'row':
+        return (row << bits) + column
+
+    elif order == 'zorder':
+        return TileIDs.morton(column, row)
+
+    elif order == 'hilbert':
+        return _hilbert_index(column, row, bits)
+
+    raise ValueError('Unknown order "%s", try one of %s' % (order, ', '.join(orders)))
+
+def coordinate(position, bits, order):
+    """ Return the (column, row) of a cell at a position along a curve, the inverse of index().
+    """
+    if order == 'row':
+        return position & ((1 << bits) - 1), position >> bits
+
+    elif order == 'zorder':
+        return TileIDs.unmorton(position)
+
+    elif order == 'hilbert':
+        return _hilbert_coordinate(position, bits)
+
+    raise ValueError('Unknown order "%s", try one of %s' % (order, ', '.join(orders)))
+
+def walk(left, top, right, bottom, order, bits=None):
+    """ Generate (column, row) tuples for cells in a rectangle, in order along a curve.
+
+        The rectangle includes left and top and excludes right and bottom.
+        The curve runs through a grid 2^bits cells on a side, by default
+        the smallest one that holds the rectangle.
+
+        A rectangle reaching past the left or top of the grid, e.g. tiles
+        padded past the edge of the map, is walked as if it were moved onto
+        the grid, so that every order covers the same cells.
+    """
+    left, top, right, bottom = int(left), int(top), int(right), int(bottom)
+
+    if right <= left or bottom <= top:
+        return
+
+    if order == 'row':
+        for row in range(top, bottom):
+            for column in range(left, right):
+                yield (column, row)
+        return
+
+    if order not in orders:
+        raise ValueError('Unknown order "%s", try one of %s' % (order, ', '.join(orders)))
+
+    dx, dy = max(0, -left), max(0, -top)
+
+    if bits is None or dx or dy:
+        bits = max(bits or 0, _bits(max(right + dx, bottom + dy)))
+
+    for (column, row) in _walk(left + dx, top + dy, right + dx, bottom + dy, order, bits, 0, 0, bits):
+        yield (column - dx, row - dy)
+
+def _walk(left, top, right, bottom, order, bits, column, row, size_bits):
+    """ Generate cells of the rectangle inside one quadtree block, in curve order.
+    """
+    size = 1 << size_bits
+    xmin, ymin = max(left, column), max(top, row)
+    xmax, ymax = min(right, column + size), min(bottom, row + size)
+
+    if xmax <= xmin or ymax <= ymin:
+        return
+
+    if size_bits <= _block_bits:
+        # small enough to sort the cells directly.
+        cells = [(index(x, y, bits, order), x, y) for y in range(ymin, ymax) for x in range(xmin, xmax)]
+        cells.sort()
+
+        for (position, x, y) in cells:
+            yield (x, y)
+        return
+
+    half = size >> 1
+    quadrants = [(column, row), (column + half, row), (column, row + half), (column + half, row + half)]
+
+    # quadrants of a block are contiguous along both curves, so any cell
+    # of each one will put the four of them in order.
+    quadrants.sort(key=lambda (x, y): index(x, y, bits, order))
+
+    for (x, y) in quadrants:
+        for cell in _walk(left, top, right, bottom, order, bits, x, y, size_bits - 1):
+            yield cell
+
+def _bits(size):
+    """ Return the smallest number of bits for a grid with a number of cells on a side.
+    """
+    bits = 0
+
+    while (1 << bits) < size:
+        bits += 1
+
+    return bits
+
+def _hilbert_index(x, y, bits):
+    """ Return the Hilbert curve position of a cell, as in Hacker's Delight.
+    """
+    position = 0
+    size = 1 << bits
+    step = size >> 1
+
+    while step:
+        rx = (x & step) and 1 or 0
+        ry = (y & step) and 1 or 0
+        position += step * step * ((3 * rx) ^ ry)
+        x, y = _hilbert_rotate(size, x, y, rx, ry)
+        step >>= 1
+
+    return position
+
+def _hilbert_coordinate(position, bits):
+    """ Return the (x, y) of a Hilbert curve position, the inverse of _hilbert_index().
+    """
+    x, y = 0, 0
+    step = 1
+
+    while step < (1 << bits):
+        rx = 1 & (position / 2)
+        ry = 1 & (position ^ rx)
+        x, y = _hilbert_rotate(step, x, y, rx, ry)
+        x += step * rx
+        y += step * ry
+        position /= 4
+        step <<= 1
+
+    return x, y
+
+def _hilbert_rotate(size, x, y, rx, ry):
+    """ Flip and swap a quadrant so the curve inside it has the usual orientation.
+    """
+    if ry == 0:
+        if rx == 1:
+            x, y = size - 1 - x, size - 1 - y
+
+        x, y = y, x
+
+    return x, y
@@ -0,0 +1,278 @@
+""" Expiry of cached tiles from lists of dirty tiles and areas.
+
+Data updates arrive as lists of dirty tiles, such as the expire lists written
+by osm2pgsql, or as dirty bounding boxes, e.g. from a PostGIS change log. Every
+tile that shows a dirty place needs to be removed from the cache or rendered
+again: the dirty tile itself, its parents at every lower zoom, and all of its
+children down to the most detailed zoom.
+
+A DirtyTiles set holds dirty tiles compactly as TileIDs integers. Each one
+stands for itself and every tile under it down to the set's maximum zoom, and
+implies all of its parents. A tile under another one adds nothing and is
+dropped, four siblings are merged into their parent, and a large bounding box
+is held as a handful of quadtree blocks instead of every tile it covers.
+
+Example use:
+
+    dirty = DirtyTiles(18)
+    load_dirty(open('expire.list'), layer.projection, dirty)
+
+    zooms = range(10, 19)
+    count = dirty.count(zooms)
+
+    expire_tiles(config.cache, layer, dirty, zooms, ['png'])
+    enqueue_tiles(WorkQueue.SQLiteQueue('osm.queue'), config.cache, layer, 'png', dirty, zooms)
+
+Dirty lists have one entry per line: a tile as "zoom/column/row", or a bounding
+box as "south west north east" in degrees, separated by spaces or commas. Blank
+lines and lines starting with "#" are skipped. Tiles deeper than the maximum
+zoom count as their parent at the maximum zoom.
+"""
+from heapq import merge
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
+
+from ModestMaps.Core import Coordinate
+from ModestMaps.Geo import Location
+
+from .Core import areaRanges
+from .Caches import remove_area
+from . import TileIDs
+
+class DirtyTiles:
+    """ Compact set of dirty tiles down to a maximum zoom.
+    """
+    def __init__(self, max_zoom):
+        self.max_zoom = int(max_zoom)
+        self.ids = set()
+        self.normal = True
+
+    def add_tile(self, column, row, zoom):
+        """ Add a dirty tile, or its parent at the maximum zoom if it's deeper.
+
+            Tiles off the map are ignored.
+        """
+        column, row, zoom = int(column), int(row), int(zoom)
+
+        if zoom > self.max_zoom:
+            shift = zoom - self.max_zoom
+            column, row, zoom = column >> shift, row >> shift, self.max_zoom
+
+        try:
+            self.ids.add(TileIDs.encode(column, row, zoom))
+        except ValueError:
+            return
+
+        self.normal = False
+
+    def add_area(self, ul, lr):
+        """ Add every tile at the maximum zoom that touches an area.
+
+            The area is given by upper-left and lower-right Coordinates,
+            as in TileStache.Core.areaRanges(), and clipped to the map.
+        """
+        for (zoom, left, top, right, bottom) in areaRanges([self.max_zoom], (ul, lr)):
+            size = 1 << zoom
+            left, top, right, bottom = max(left, 0), max(top, 0), min(right, size), min(bottom, size)
+
+            if left < right and top < bottom:
+                self._cover(left, top, right, bottom, 0, 0, 0)
+
+        self.normal = False
+
+    def _cover(self, left, top, right, bottom, column, row, zoom):
+        """ Add the largest blocks under one tile that lie inside a range of tiles at the maximum zoom.
+        """
+        depth = self.max_zoom - zoom
+        xmin, ymin = column << depth, row << depth
+        xmax, ymax = (column + 1) << depth, (row + 1) << depth
+
+        if xmax <= left or right <= xmin or ymax <= top or bottom <= ymin:
+            return
+
+        if left <= xmin and xmax <= right and top <= ymin and ymax <= bottom:
+            self.ids.add(TileIDs.encode(column, row, zoom))
+            return
+
+        for (x, y) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            self._cover(left, top, right, bottom, column * 2 + x, row * 2 + y, zoom + 1)
+
+    def _normalize(self):
+        """ Drop tiles under other tiles, and merge sets of four siblings into their parent.
+        """
+        ids = self.ids
+
+        for id in list(ids):
+            parent = id >> 2
+
+            while parent:
+                if parent in ids:
+                    ids.discard(id)
+                    break
+
+                parent >>= 2
+
+        for zoom in range(self.max_zoom, 0, -1):
+            siblings = {}
+
+            for id in ids:
+                if TileIDs.zoom(id) == zoom:
+                    siblings[id >> 2] = siblings.get(id >> 2, 0) + 1
+
+            for (parent, count) in siblings.items():
+                if count == 4:
+                    ids.difference_update(TileIDs.children(parent))
+                    ids.add(parent)
+
+        self.normal = True
+
+    def roots(self):
+        """ Return a sorted list of dirty tile IDs, none of them under another.
+
+            Every dirty tile is one of these, a tile under one of these
+            down to the maximum zoom, or a parent of one of these.
+        """
+        if not self.normal:
+            self._normalize()
+
+        return sorted(self.ids)
+
+    def _levels(self, zooms):
+        """ Generate (zoom, parents, blocks) for each zoom up to the maximum.
+
+            Parents is a sorted list of IDs of tiles above the roots, and
+            blocks is a list of (first, stop) ranges of IDs under the roots.
+            No tile is in more than one of them.
+        """
+        roots = [(id, TileIDs.zoom(id)) for id in self.roots()]
+
+        for zoom in sorted(set([int(zoom) for zoom in zooms if zoom <= self.max_zoom])):
+            parents = set([id >> (2 * (z - zoom)) for (id, z) in roots if z > zoom])
+            blocks = [TileIDs.descendants(id, zoom) for (id, z) in roots if z <= zoom]
+
+            yield zoom, sorted(parents), blocks
+
+    def count(self, zooms):
+        """ Return the number of dirty tiles at a list of zoom levels.
+        """
+        return sum([len(parents) + sum([stop - first for (first, stop) in blocks])
+                    for (zoom, parents, blocks) in self._levels(zooms)])
+
+    def tiles(self, zooms):
+        """ Generate a stream of dirty tile IDs at a list of zoom levels.
+
+            Tiles come zoom by zoom, in Z-order within each zoom.
+        """
+        for (zoom, parents, blocks) in self._levels(zooms):
+            for id in merge(parents, *[xrange(first, stop) for (first, stop) in blocks]):
+                yield id
+
+def load_dirty(file, projection, dirty):
+    """ Add the dirty tiles and bounding boxes listed in a file to a DirtyTiles set.
+
+        Raises ValueError for a line that's neither.
+    """
+    for (number, line) in enumerate(file):
+        line = line.strip()
+
+        if not line or line.startswith('#'):
+            continue
+
+        parts = line.replace(',', ' ').split()
+
+        try:
+            if len(parts) == 1:
+                zoom, column, row = map(int, line.split('/'))
+                dirty.add_tile(column, row, zoom)
+
+            elif len(parts) == 4:
+                lat1, lon1, lat2, lon2 = map(float, parts)
+                south, west = min(lat1, lat2), min(lon1, lon2)
+                north, east = max(lat1, lat2), max(lon1, lon2)
+
+                ul = projection.locationCoordinate(Location(north, west))
+                lr = projection.locationCoordinate(Location(south, east))
+                dirty.add_area(ul, lr)
+
+            else:
+                raise ValueError()
+
+        except ValueError:
+            raise ValueError('Line %d is neither a "zoom/column/row" tile nor a "south west north east" bounding box: %s' % (number + 1, line))
+
+def expire_tiles(cache, layer, dirty, zooms, formats, workers=8):
+    """ Remove every dirty tile at a list of zoom levels from a cache, in each of a list of formats.
+
+        The tiles under each dirty tile are removed together with
+        TileStache.Caches.remove_area(), and parents one by one, by
+        a pool of worker threads.
+    """
+    zooms = [zoom for zoom in zooms if zoom <= dirty.max_zoom]
+    roots = dirty.roots()
+
+    def remove_block(id):
+        column, row, zoom = TileIDs.decode(id)
+        depth = dirty.max_zoom - zoom
+
+        ul = Coordinate(row, column, zoom)
+        lr = Coordinate(((row + 1) << depth) - 1, ((column + 1) << depth) - 1, dirty.max_zoom)
+        remove_area(cache, layer, [z for z in zooms if z >= zoom], (ul, lr), formats, workers=1)
+
+    def remove_tile(id):
+        coord = TileIDs.to_coord(id)
+
+        for format in formats:
+            cache.remove(layer, coord, format)
+
+    parents = set()
+
+    for id in roots:
+        for zoom in zooms:
+            if zoom < TileIDs.zoom(id):
+                parents.add(TileIDs.parent(id, TileIDs.zoom(id) - zoom))
+
+    pool = ThreadPool(workers)
+
+    try:
+        for result in pool.imap_unordered(remove_block, roots):
+            pass
+
+        for result in pool.imap_unordered(remove_tile, sorted(parents), 64):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+def enqueue_tiles(queue, cache, layer, extension, dirty, zooms, workers=8):
+    """ Add every dirty tile at a list of zoom levels to a seeding work queue.
+
+        Tiles are added as units of one metatile each, for workers running
+        tilestache-seed.py with the same queue; see TileStache.WorkQueue.
+        Returns the number of units added.
+
+        Workers only render tiles missing from the cache, so the dirty tiles
+        are first removed from the cache with expire_tiles().
+    """
+    mimetype, format = layer.getTypeByExtension(extension)
+    expire_tiles(cache, layer, dirty, zooms, [format], workers)
+
+    rows, columns = layer.metatile.rows, layer.metatile.columns
+    count = dirty.count(zooms)
+
+    def units():
+        offset = 0
+
+        for (zoom, ids) in groupby(dirty.tiles(zooms), TileIDs.zoom):
+            metatiles = {}
+
+            for id in ids:
+                column, row, zoom = TileIDs.decode(id)
+                key = column / columns, row / rows
+
+                metatiles.setdefault(key, []).append((offset, count, row, column, zoom))
+                offset += 1
+
+            for tiles in sorted(metatiles.values()):
+                yield (layer.name(), extension, tiles)
+
+    return queue.put(units())
@@ -0,0 +1,159 @@
+""" Per-layer generation numbers, for removing a whole layer from a cache at once.
+
+A cache with generations keeps a small counter for each layer and puts the
+current number in the path or key of every tile it reads and writes. Bumping
+the counter makes every cached tile of the layer disappear at once, however big
+the cache is, so a new style can be deployed without hours of deletes. Tiles
+of old generations are left behind for a Reaper to remove slowly in the
+background.
+
+Generation numbers are shared between processes and servers through the cache
+itself, e.g. a small file next to the tiles, and each process keeps its own
+copy of a number for a few seconds to avoid reading it for every tile. A bump
+can take that long to reach every process, and in the meantime some of them
+may still read and write tiles of the old generation.
+
+Example use, with functions that load and store a number for a layer name:
+
+    generations = Generations(read, write, ttl=5)
+
+    number = generations.get('osm')
+    number = generations.bump('osm')
+
+    reaper = Reaper(delay=10)
+    reaper.put(remove_old_tiles, 'osm', number)
+
+    wait()
+
+Used by the Disk and S3 caches, see TileStache.Caches and TileStache.S3.
+"""
+import os
+import time
+import Queue
+import logging
+
+from threading import Thread, Lock
+
+# every reaper, for wait().
+_reapers = []
+
+def wait():
+    """ Block until every reaper in this process has finished its queued jobs.
+
+        Useful before a short-lived script exits, since reapers run in
+        daemon threads that would otherwise be cut off.
+    """
+    for reaper in _reapers:
+        reaper.join()
+
+class Generations:
+    """ Generation numbers for the layers of one cache, kept in memory for a few seconds.
+
+        Read and write are functions that load and store the number for
+        a layer name; read returns None for a layer without a number yet,
+        which counts as generation zero.
+    """
+    def __init__(self, read, write, ttl=5):
+        self.read = read
+        self.write = write
+        self.ttl = ttl
+
+        self.numbers = {}
+        self.guard = Lock()
+
+    def get(self, name):
+        """ Return the current generation number of a layer.
+        """
+        with self.guard:
+            number, due = self.numbers.get(name, (None, 0))
+
+        if time.time() < due:
+            return number
+
+        number = self.read(name) or 0
+
+        with self.guard:
+            self.numbers[name] = number, time.time() + self.ttl
+
+        return number
+
+    def bump(self, name):
+        """ Move a layer to a new generation, and return the new number.
+
+            Two bumps at the same moment may end up with the same number,
+            but either way the layer moves past its old generation.
+        """
+        number = (self.read(name) or 0) + 1
+        self.write(name, number)
+
+        with self.guard:
+            self.numbers[name] = number, time.time() + self.ttl
+
+        return number
+
+class Reaper:
+    """ Background removal of old generations, one step at a time.
+
+        Each job is a generator function that removes a little at a time
+        and yields between steps, e.g. after each batch of files. Jobs are
+        carried out in order by a single daemon thread, started when the
+        first job arrives in each process, which waits a delay before each
+        job so that other processes can catch up with a bump, and pauses
+        between steps so the cache isn't kept too busy to serve tiles.
+
+        Jobs still waiting when the process exits are lost, so a job should
+        remove every generation older than the current one, not just the
+        one before it.
+    """
+    def __init__(self, delay=10, pause=.05):
+        self.delay = delay
+        self.pause = pause
+
+        self.queue = None
+        self.pid = None
+        self.guard = Lock()
+
+        _reapers.append(self)
+
+    def _queue(self):
+        """ Return the job queue for this process, starting a reaper if needed.
+        """
+        with self.guard:
+            if self.pid != os.getpid():
+                self.queue = Queue.Queue()
+                self.pid = os.getpid()
+
+                reaper = Thread(target=self._reap, args=(self.queue, ))
+                reaper.setDaemon(True)
+                reaper.start()
+
+            return self.queue
+
+    def _reap(self, queue):
+        """ Carry out queued jobs forever.
+        """
+        while True:
+            due, func, args = queue.get()
+            time.sleep(max(0, due - time.time()))
+
+            try:
+                for step in func(*args):
+                    time.sleep(self.pause)
+            except Exception, e:
+                logging.error('TileStache.Generations.Reaper._reap() %s: %s', func.__name__, e)
+
+            queue.task_done()
+
+    def join(self):
+        """ Block until every job queued in this process is finished.
+        """
+        with self.guard:
+            queue = self.pid == os.getpid() and self.queue or None
+
+        if queue:
+            queue.join()
+
+    def put(self, func, *args):
+        """ Queue a job to run func(*args) after the delay.
+        """
+        self._queue().put((time.time() + self.delay, func, args))
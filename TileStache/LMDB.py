@@ -0,0 +1,196 @@
+""" Caches tiles to an LMDB memory-mapped database.
+
+Requires py-lmdb:
+  http://pypi.python.org/pypi/lmdb
+
+LMDB (http://symas.com/mdb/) keeps every tile in a single memory-mapped file
+with a B+tree index. Cached tiles are read straight out of shared memory with
+no system call per tile, any number of processes can read at once, and one
+process at a time can write. It's a good fit for single-machine deployments
+that would otherwise keep millions of small files in a Disk cache.
+
+Example configuration:
+
+  "cache": {
+    "name": "LMDB",
+    "path": "/tmp/stache.lmdb",
+    "size": 68719476736
+  }
+
+LMDB cache parameters:
+
+  path
+    Required local directory path where the database should be stored.
+
+  size
+    Optional maximum size of the database in bytes. This is the amount of
+    address space reserved for the memory map, and disk space is used only
+    as tiles are added. Defaults to 64GB.
+
+  umask
+    Optional string representation of octal permission mask for stored
+    files. Defaults to 0022.
+
+Each layer is kept in its own named database inside the environment, with keys
+packed into nine bytes of zoom, column and row plus the format, e.g. "png".
+Every metatile is written in a single transaction. Keys sort by zoom, column
+and row, so remove_area() finds the tiles in each column of an area with a
+single cursor seek, and removes a whole area in one transaction.
+
+Locks are kept outside the database in a "locks" directory under the path,
+using a TileStache.Locks.File lock manager.
+
+If your configuration file is loaded from a remote location, e.g.
+"http://example.com/tilestache.cfg", the path *must* be an unambiguous
+filesystem path, e.g. "file:///tmp/stache.lmdb"
+"""
+from os import getpid
+from time import time as _time
+from struct import Struct
+from os.path import join as pathjoin
+from threading import Lock as _Lock
+
+from .Locks import File as FileLocks
+from .Core import areaRanges
+
+try:
+    import lmdb
+except ImportError:
+    # at least we can build the documentation
+    pass
+
+# tile key: zoom, column, row, followed by a format string.
+_key = Struct('>BII')
+
+# tile value: save time as a double, followed by the tile body.
+_stamp = Struct('>d')
+
+def tile_key(coord, format):
+    """ Return a binary tile key string.
+    """
+    return _key.pack(int(coord.zoom), int(coord.column), int(coord.row)) + str(format.lower())
+
+class Cache:
+    """
+    """
+    def __init__(self, path, size=64 * 1024**3, umask=0022):
+        self.path = path
+        self.size = size
+        self.umask = umask
+
+        self.locks = FileLocks(pathjoin(path, 'locks'), umask)
+
+        self._env = None
+        self._pid = None
+        self._dbs = {}
+        self._guard = _Lock()
+
+    def _environment(self):
+        """ Return an open LMDB environment for this process.
+
+            LMDB environments can't be shared across a fork(), so a new one
+            is opened whenever the process ID changes.
+        """
+        if self._pid != getpid():
+            self._env = lmdb.open(self.path, map_size=self.size, max_dbs=1024,
+                                  mode=0666&~self.umask, readahead=False)
+            self._pid = getpid()
+            self._dbs = {}
+
+        return self._env
+
+    def _database(self, layer):
+        """ Return a named database handle for a layer, creating it if necessary.
+        """
+        name = str(layer.name())
+
+        with self._guard:
+            env = self._environment()
+
+            if name not in self._dbs:
+                # open_db() must not be called by two threads at once.
+                self._dbs[name] = env.open_db(name)
+
+            return self._dbs[name]
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        return self.locks.lock(layer, coord, format)
+
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+        """
+        return self.locks.unlock(layer, coord, format)
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        db = self._database(layer)
+
+        with self._environment().begin(write=True, db=db) as txn:
+            txn.delete(tile_key(coord, format))
+
+    def remove_area(self, layer, zooms, bbox, formats):
+        """ Remove every cached tile in an area, in each of a list of formats.
+        """
+        db = self._database(layer)
+        formats = [str(format.lower()) for format in formats]
+
+        with self._environment().begin(write=True, db=db) as txn:
+            cursor = txn.cursor()
+
+            for (zoom, left, top, right, bottom) in areaRanges(zooms, bbox):
+                for column in range(max(left, 0), right):
+                    cursor.set_range(_key.pack(zoom, column, max(top, 0)))
+
+                    while True:
+                        key = cursor.key()
+
+                        if len(key) < _key.size or _key.unpack(key[:_key.size]) >= (zoom, column, bottom):
+                            # past the end of this column
+                            break
+
+                        if key[_key.size:] in formats:
+                            # moves on to the next key
+                            cursor.delete()
+
+                        elif not cursor.next():
+                            break
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        db = self._database(layer)
+
+        with self._environment().begin(db=db, buffers=True) as txn:
+            value = txn.get(tile_key(coord, format))
+
+            if value is None:
+                return None
+
+            if layer.cache_lifespan:
+                saved, = _stamp.unpack(value[:_stamp.size])
+
+                if _time() - saved > layer.cache_lifespan:
+                    return None
+
+            # copy out of the memory map before the transaction ends.
+            return value[_stamp.size:]
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        self.save_many([body], layer, [coord], format)
+
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles in a single transaction.
+        """
+        db = self._database(layer)
+        stamp = _stamp.pack(_time())
+
+        with self._environment().begin(write=True, db=db) as txn:
+            for (body, coord) in zip(bodies, coords):
+                txn.put(tile_key(coord, format), stamp + body)
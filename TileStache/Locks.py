@@ -0,0 +1,411 @@
+""" The lock bits of TileStache.
+
+A lock manager is the part of TileStache that keeps two renderers from drawing
+the same tile (or metatile) at the same time. Every cache has lock() and unlock()
+methods of its own, but it's possible to swap in a separate lock manager for a
+whole cache or for a single layer, so that locking strategy can be chosen
+independently of where tiles are stored.
+
+Built-in lock managers:
+- thread
+- file
+- memcache
+- null
+
+Example built-in lock manager for a cache, for JSON configuration file:
+
+    "cache": {
+      "name": "Disk",
+      "path": "/tmp/stache",
+      "lock": {"name": "file", "path": "/tmp/stache-locks"}
+    }
+
+Example built-in lock manager for a single layer:
+
+    "layer-name": {
+      "provider": { ... },
+      "lock": {"name": "thread"}
+    }
+
+Example external lock manager:
+
+    "lock": {
+      "class": "Module:Classname",
+      "kwargs": {"frob": "yes"}
+    }
+
+A lock manager must provide two methods, lock() and unlock(), with the same
+arguments as the corresponding cache methods:
+
+- layer: instance of a Layer.
+- coord: single Coordinate that represents a tile.
+- format: string like "png" or "jpg" that is used as a filename extension.
+
+The lock() method blocks until the lock has been acquired, or until the
+layer's stale_lock_timeout has passed and the lock is forced.
+
+Waiting is done on real wakeups wherever possible: in-process waiters sleep on
+a condition variable that is notified by unlock(), and file lock waiters are
+woken up by the kernel. Only lock managers that coordinate through a remote
+service (memcache) need to check back periodically, and those use a short,
+growing backoff in addition to in-process notification.
+"""
+
+import os
+import errno
+
+from time import time as _time, sleep as _sleep
+from threading import Lock as _Lock, Condition as _Condition, Thread as _Thread, local as _local
+from os.path import join as pathjoin
+from hashlib import md5
+
+try:
+    from fcntl import flock as _flock, LOCK_EX, LOCK_UN
+except ImportError:
+    # at least we can build the documentation
+    pass
+
+try:
+    from memcache import Client
+except ImportError:
+    # at least we can build the documentation
+    pass
+
+def getLockByName(name):
+    """ Retrieve a lock manager class by name.
+
+        Raise an exception if the name doesn't work out.
+    """
+    if name.lower() == 'thread':
+        return Thread
+
+    elif name.lower() == 'file':
+        return File
+
+    elif name.lower() == 'memcache':
+        return Memcache
+
+    elif name.lower() == 'null':
+        return Null
+
+    raise Exception('Unknown lock manager name: "%s"' % name)
+
+def lock_key(layer, coord, format):
+    """ Return a lock key string.
+    """
+    name = layer.name()
+    tile = '%d/%d/%d' % (coord.zoom, coord.column, coord.row)
+    return str('%s/%s.%s' % (name, tile, format.lower()))
+
+class Null:
+    """ Lock manager that never blocks.
+
+        Useful for read-only sources such as MBTiles tilesets,
+        where there is nothing to protect.
+
+        Example configuration:
+
+            "lock": {"name": "Null"}
+    """
+    def lock(self, layer, coord, format):
+        return
+
+    def unlock(self, layer, coord, format):
+        return
+
+class Thread:
+    """ In-process lock manager, for threaded servers.
+
+        Locks are held in a dictionary shared by all threads in the current
+        process, and waiters are woken up by unlock() as soon as a lock is
+        released. Locks held by other processes are not seen at all.
+
+        Waiters never wait with a timeout, because Python's timed waits poll.
+        Instead, a single watchdog thread forces stale locks when they're due.
+
+        Example configuration:
+
+            "lock": {"name": "Thread"}
+    """
+    def __init__(self):
+        self.guard = _Lock()
+        self.held = {}
+        self.watchdog = None
+
+    def _entry(self, key):
+        """ Return a lock entry for a key, creating one if necessary.
+
+            Each entry in self.held is a list: [condition, locked, waiters, due].
+            Caller must hold self.guard.
+        """
+        if key not in self.held:
+            self.held[key] = [_Condition(self.guard), False, 0, None]
+
+        return self.held[key]
+
+    def _release(self, key):
+        """ Release a lock by key, waking up one waiting thread.
+
+            Caller must hold self.guard.
+        """
+        entry = self.held[key]
+        entry[1], entry[3] = False, None
+
+        if entry[2]:
+            entry[0].notify()
+        else:
+            del self.held[key]
+
+    def _watch(self):
+        """ Force stale locks until there are no more locks to watch.
+        """
+        while True:
+            with self.guard:
+                now = _time()
+
+                for (key, entry) in self.held.items():
+                    if entry[1] and entry[3] <= now:
+                        # someone left the door locked.
+                        self._release(key)
+
+                dues = [entry[3] for entry in self.held.values() if entry[1]]
+
+                if not dues:
+                    self.watchdog = None
+                    return
+
+                wait = min(dues) - now
+
+            _sleep(min(max(wait, .01), 1.))
+
+    def acquire(self, key, timeout):
+        """ Acquire a lock by key, forcing it after timeout seconds.
+        """
+        with self.guard:
+            entry = self._entry(key)
+            entry[2] += 1
+
+            try:
+                while entry[1]:
+                    entry[0].wait()
+
+            finally:
+                entry[2] -= 1
+
+            entry[1], entry[3] = True, _time() + timeout
+
+            if self.watchdog is None:
+                self.watchdog = _Thread(target=self._watch)
+                self.watchdog.setDaemon(True)
+                self.watchdog.start()
+
+    def release(self, key):
+        """ Release a lock by key, waking up one waiting thread.
+        """
+        with self.guard:
+            if key in self.held and self.held[key][1]:
+                self._release(key)
+
+    def lock(self, layer, coord, format):
+        """ Acquire a lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        self.acquire(lock_key(layer, coord, format), layer.stale_lock_timeout)
+
+    def unlock(self, layer, coord, format):
+        """ Release a lock for this tile.
+        """
+        self.release(lock_key(layer, coord, format))
+
+class File:
+    """ Lock manager using flock() on local files, for multi-process servers.
+
+        Waiting processes block inside flock() and are woken by the kernel
+        when the lock is released. A lock is released automatically when its
+        holder dies, so there is no stale lock to force; the stale_lock_timeout
+        of a layer is not used.
+
+        Lock files are named by a hash of the tile and held in one directory,
+        and are removed on unlock.
+
+        Example configuration:
+
+            "lock": {
+              "name": "File",
+              "path": "/tmp/stache-locks",
+              "umask": "0000"
+            }
+
+        Extra parameters:
+        - path: required local directory path where lock files are kept.
+        - umask: optional string representation of octal permission mask
+          for lock files. Defaults to 0022.
+    """
+    def __init__(self, path, umask=0022):
+        self.lockpath = path
+        self.umask = umask
+        self.handles = {}
+        self.guard = _Lock()
+
+    def _lockpath(self, key):
+        """
+        """
+        return pathjoin(self.lockpath, md5(key).hexdigest() + '.lock')
+
+    def acquire(self, key):
+        """ Acquire a lock by key, blocking in flock() until it's available.
+        """
+        lockpath = self._lockpath(key)
+
+        try:
+            umask_old = os.umask(self.umask)
+            os.makedirs(self.lockpath, 0777&~self.umask)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.umask(umask_old)
+
+        while True:
+            fd = os.open(lockpath, os.O_RDWR|os.O_CREAT, 0666&~self.umask)
+            _flock(fd, LOCK_EX)
+
+            try:
+                # the file may have been unlinked by its previous holder
+                # while we were waiting on it, in which case try again.
+                if os.fstat(fd).st_ino == os.stat(lockpath).st_ino:
+                    break
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+
+            os.close(fd)
+
+        with self.guard:
+            self.handles[key] = fd
+
+    def release(self, key):
+        """ Release a lock by key.
+        """
+        with self.guard:
+            fd = self.handles.pop(key, None)
+
+        if fd is None:
+            return
+
+        try:
+            os.unlink(self._lockpath(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        finally:
+            _flock(fd, LOCK_UN)
+            os.close(fd)
+
+    def lock(self, layer, coord, format):
+        """ Acquire a lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        self.acquire(lock_key(layer, coord, format))
+
+    def unlock(self, layer, coord, format):
+        """ Release a lock for this tile.
+        """
+        self.release(lock_key(layer, coord, format))
+
+class Memcache:
+    """ Lock manager using memcache add(), for servers on many hosts.
+
+        Memcache can't notify anyone of a released lock, so waiters within
+        this process are woken up directly by unlock() and waiters elsewhere
+        check back with a growing backoff, starting at 10ms and never waiting
+        longer than 200ms between checks.
+
+        Example configuration:
+
+            "lock": {
+              "name": "Memcache",
+              "servers": ["127.0.0.1:11211"]
+            }
+
+        Extra parameters:
+        - servers: optional array of servers, list of "{host}:{port}" pairs.
+          Defaults to ["127.0.0.1:11211"] if omitted.
+        - revision: optional revision number, as for the Memcache cache.
+          Defaults to 0.
+
+        Lock keys are tile keys of TileStache.Memcache with "-lock" added,
+        so they're hashed when too long and include the revision number.
+
+        python-memcached doesn't raise errors for servers that are down, so
+        lock() raises IOError instead of waiting when every server is down.
+    """
+    def __init__(self, servers=['127.0.0.1:11211'], revision=0):
+        self.servers = servers
+        self.revision = revision
+        self.waiting = Thread()
+        self._local = _local()
+
+    def _client(self):
+        """ Return a persistent memcache client for the current thread.
+        """
+        if not hasattr(self._local, 'client'):
+            self._local.client = Client(self.servers)
+
+        return self._local.client
+
+    def _key(self, layer, coord, format):
+        """ Return a memcache lock key for a tile.
+        """
+        # imported here because TileStache.Memcache imports this module.
+        from .Memcache import tile_key
+
+        return tile_key(layer, coord, format, self.revision) + '-lock'
+
+    def _servers_down(self, mem):
+        """ Return true if every server of a memcache client is marked dead.
+
+            The client marks a server dead for a while when it can't connect,
+            and just returns a false result for anything sent its way.
+        """
+        now = _time()
+        return bool(mem.servers) and min([getattr(host, 'deaduntil', 0) for host in mem.servers]) > now
+
+    def lock(self, layer, coord, format):
+        """ Acquire a lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        key = self._key(layer, coord, format)
+        timeout = layer.stale_lock_timeout
+        due = _time() + timeout
+
+        # take turns inside this process first.
+        self.waiting.acquire(key, timeout)
+
+        mem = self._client()
+        wait = .01
+
+        while _time() < due:
+            if mem.add(key, 'locked.', timeout):
+                return
+
+            if self._servers_down(mem):
+                self.waiting.release(key)
+                raise IOError('No memcache server available to lock %s' % key)
+
+            _sleep(wait)
+            wait = min(wait * 2, .2)
+
+        mem.set(key, 'locked.', timeout)
+
+    def unlock(self, layer, coord, format):
+        """ Release a lock for this tile.
+        """
+        key = self._key(layer, coord, format)
+
+        self._client().delete(key)
+        self.waiting.release(key)
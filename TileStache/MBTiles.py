@@ -34,23 +34,68 @@ MBTiles provider parameters:
 
   tileset:
     Required local file path to MBTiles tileset file, a SQLite 3 database file.
+
+Tilesets can also be used as a cache, see the documentation of Cache below:
+
+  "cache": {
+    "name": "MBTiles",
+    "filename": "/tmp/stache/{layer}.mbtiles"
+  }
+
+Tiles are read through read-only connections that are kept open and reused,
+one for each thread in each process. SQLite keeps the compiled tile query with
+each connection, and the database is memory-mapped where SQLite supports it.
+Tileset metadata is read and the query is built again whenever the schema
+changes, e.g. when a Writer in another process adds a tile_timestamp column.
+
+Tiles are written in bulk through a Writer, which keeps a single connection
+open and commits once for every batch of tiles instead of once for each tile.
+New tilesets may optionally use the deduplicated layout, with each distinct
+tile image stored once in an "images" table, referenced from a "map" table,
+and presented to readers through a "tiles" view.
 """
+import os
+
 from urlparse import urlparse, urljoin
-from os.path import exists
+from os.path import exists, dirname, join as pathjoin
+from os import getpid
+from time import time as _time
+from hashlib import md5
+from atexit import register as _atexit
+from threading import local as _local, Lock as _Lock, Timer as _Timer
 
 try:
-    from sqlite3 import connect as _connect
+    from sqlite3 import connect as _connect, DatabaseError as _DatabaseError
 except ImportError:
     # Heroku appears to be missing standard python's
     # sqlite3 package, so throw an ImportError later
-    def _connect(filename):
+    def _connect(filename, **kwargs):
         raise ImportError('No module named sqlite3')
+    
+    class _DatabaseError(Exception):
+        pass
 
 from ModestMaps.Core import Coordinate
 
-def create_tileset(filename, name, type, version, description, format, bounds=None):
+from .Locks import File as FileLocks
+from .Core import areaRanges
+
+# tileset formats for TileStache formats.
+_formats = {'png': 'png', 'jpg': 'jpg', 'jpeg': 'jpg'}
+
+# bytes of each tileset to memory-map for reading.
+_mmap_size = 256 * 1024**2
+
+# shared readers, by tileset filename.
+_readers = {}
+_readers_lock = _Lock()
+
+def create_tileset(filename, name, type, version, description, format, bounds=None, dedupe=False):
     """ Create a tileset 1.1 with the given filename and metadata.
     
+        If dedupe is true, tiles are stored in the deduplicated layout
+        with separate map and images tables behind a tiles view.
+    
         From the specification:
 
         The metadata table is used as a key/value store for settings.
@@ -86,8 +131,19 @@ def create_tileset(filename, name, type, version, description, format, bounds=No
     db = _connect(filename)
     
     db.execute('CREATE TABLE metadata (name TEXT, value TEXT, PRIMARY KEY (name))')
-    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
-    db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
+    
+    if dedupe:
+        db.execute('CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)')
+        db.execute('CREATE UNIQUE INDEX coord ON map (zoom_level, tile_column, tile_row)')
+        db.execute('CREATE TABLE images (tile_id TEXT, tile_data BLOB)')
+        db.execute('CREATE UNIQUE INDEX image ON images (tile_id)')
+        db.execute("""CREATE VIEW tiles AS
+                      SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                             map.tile_row AS tile_row, images.tile_data AS tile_data
+                      FROM map JOIN images ON images.tile_id = map.tile_id""")
+    else:
+        db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
     
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('name', name))
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('type', type))
@@ -138,35 +194,147 @@ def tileset_info(filename):
     
     return info
 
-def list_tiles(filename):
-    """ Get a list of tile coordinates.
+def _zooms_clause(zooms):
+    """ Return an SQL WHERE clause and parameters limiting tiles to a list of zooms.
+    """
+    if zooms is None:
+        return '', ()
+    
+    zooms = tuple(map(int, zooms))
+    return 'WHERE zoom_level IN (%s)' % ', '.join(['?'] * len(zooms)), zooms
+
+def list_tiles(filename, zooms=None):
+    """ Generate a stream of tile coordinates, optionally limited to a list of zooms.
+    
+        Tiles are read with a database cursor in index order, zoom by zoom,
+        so memory use doesn't grow with the size of the tileset.
     """
     db = _connect(filename)
     db.text_factory = bytes
     
-    tiles = db.execute('SELECT tile_row, tile_column, zoom_level FROM tiles')
-    tiles = (((2**z - 1) - y, x, z) for (y, x, z) in tiles) # Hello, Paul Ramsey.
-    tiles = [Coordinate(row, column, zoom) for (row, column, zoom) in tiles]
+    # the map table of a deduplicated tileset is indexed the same way.
+    table = _is_deduped(db) and 'map' or 'tiles'
+    where, args = _zooms_clause(zooms)
+    
+    q = 'SELECT tile_row, tile_column, zoom_level FROM %s %s ORDER BY zoom_level, tile_column, tile_row'
+    
+    for (y, x, z) in db.execute(q % (table, where), args):
+        yield Coordinate((2**z - 1) - y, x, z) # Hello, Paul Ramsey.
     
-    return tiles
+    db.close()
+
+def count_tiles(filename, zooms=None):
+    """ Return the number of tiles, optionally limited to a list of zooms.
+    """
+    db = _connect(filename)
+    table = _is_deduped(db) and 'map' or 'tiles'
+    where, args = _zooms_clause(zooms)
+    
+    count, = db.execute('SELECT COUNT(*) FROM %s %s' % (table, where), args).fetchone()
+    db.close()
+    
+    return count
+
+class _Reader:
+    """ Read-only connections to a single tileset, one for each thread.
+    
+        Metadata and the tile query are read again whenever the schema
+        version changes, and metadata without a format is never kept, in
+        case it was read while another process was creating the tileset.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.state = None, {}, None
+        self.local = _local()
+    
+    def connection(self):
+        """ Return an open connection for the current thread.
+        
+            Connections can't be shared across a fork(), so a new one
+            is opened whenever the process ID changes.
+        """
+        if getattr(self.local, 'pid', None) != getpid():
+            db = _connect(self.filename)
+            db.text_factory = bytes
+            
+            # both pragmas are quietly ignored by older versions of SQLite.
+            db.execute('PRAGMA query_only = 1')
+            db.execute('PRAGMA mmap_size = %d' % _mmap_size)
+            
+            self.local.db, self.local.pid = db, getpid()
+        
+        return self.local.db
+    
+    def _current(self, db):
+        """ Return metadata and tile query, reading them again if they're out of date.
+        """
+        # schema_version is read from the database header, so this is cheap.
+        version = db.execute('PRAGMA schema_version').fetchone()[0]
+        built, metadata, query = self.state
+        
+        if version != built or 'format' not in metadata:
+            metadata = dict(db.execute('SELECT name, value FROM metadata'))
+            query = _tile_query(db)
+            self.state = version, metadata, query
+        
+        return metadata, query
+    
+    def format(self):
+        """ Return the tileset format, e.g. "png".
+        """
+        metadata, query = self._current(self.connection())
+        return metadata.get('format')
+    
+    def get(self, coord):
+        """ Return raw content and timestamp of a tile by coordinate.
+        
+            Either may be None, if the tile doesn't exist or has no timestamp.
+        """
+        db = self.connection()
+        metadata, query = self._current(db)
+        
+        tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+        row = db.execute(query, (coord.zoom, coord.column, tile_row)).fetchone()
+        
+        return row and (row[0], row[1]) or (None, None)
+
+def _tile_query(db):
+    """ Return an SQL query for the content and timestamp of a tile.
+    """
+    deduped = _is_deduped(db)
+    
+    if deduped:
+        table = 'map'
+        select = 'images.tile_data, %s FROM map JOIN images ON images.tile_id = map.tile_id'
+    else:
+        table = 'tiles'
+        select = 'tile_data, %s FROM tiles'
+    
+    stamp = _has_timestamps(db, deduped) and (table + '.tile_timestamp') or 'NULL'
+    where = ' WHERE %s.zoom_level=? AND %s.tile_column=? AND %s.tile_row=?' % (table, table, table)
+    
+    return 'SELECT ' + (select % stamp) + where
+
+def _reader(filename):
+    """ Return the shared _Reader for a tileset, creating it if necessary.
+    """
+    with _readers_lock:
+        if filename not in _readers:
+            _readers[filename] = _Reader(filename)
+        
+        return _readers[filename]
 
 def get_tile(filename, coord):
     """ Retrieve the mime-type and raw content of a tile by coordinate.
     
         If the tile does not exist, None is returned for the content.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    reader = _reader(filename)
     
     formats = {'png': 'image/png', 'jpg': 'image/jpeg', None: None}
-    format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
-    format = format and format[0] or None
-    mime_type = formats[format]
+    mime_type = formats[reader.format()]
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-    content = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
-    content = content and content[0] or None
+    content, timestamp = reader.get(coord)
 
     return mime_type, content
 
@@ -176,9 +344,10 @@ def delete_tile(filename, coord):
     db = _connect(filename)
     db.text_factory = bytes
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-    db.execute(q, (coord.zoom, coord.column, tile_row))
+    _delete_tile(db, _is_deduped(db), coord)
+
+    db.commit()
+    db.close()
 
 def put_tile(filename, coord, content):
     """
@@ -186,13 +355,204 @@ def put_tile(filename, coord, content):
     db = _connect(filename)
     db.text_factory = bytes
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
-    db.execute(q, (coord.zoom, coord.column, tile_row, buffer(content)))
+    _put_tile(db, _is_deduped(db), coord, content)
 
     db.commit()
     db.close()
 
+def _is_deduped(db):
+    """ Return true if the tileset uses the deduplicated map and images layout.
+    """
+    q = "SELECT name FROM sqlite_master WHERE type='table' AND name='map'"
+    return db.execute(q).fetchone() is not None
+
+def _has_timestamps(db, deduped):
+    """ Return true if the tileset has a tile_timestamp column.
+    """
+    columns = db.execute('PRAGMA table_info(%s)' % (deduped and 'map' or 'tiles'))
+    return 'tile_timestamp' in [row[1] for row in columns]
+
+def _put_tile(db, deduped, coord, content, timestamp=None):
+    """ Write a single tile without committing.
+    
+        Timestamp is an optional number of seconds since the epoch,
+        for tilesets with a tile_timestamp column.
+    """
+    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+    
+    if deduped:
+        tile_id = md5(content).hexdigest()
+        db.execute('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)', (tile_id, buffer(content)))
+        table, column, value = 'map', 'tile_id', tile_id
+    
+    else:
+        table, column, value = 'tiles', 'tile_data', buffer(content)
+    
+    if timestamp is None:
+        q = 'REPLACE INTO %s (zoom_level, tile_column, tile_row, %s) VALUES (?, ?, ?, ?)'
+        db.execute(q % (table, column), (coord.zoom, coord.column, tile_row, value))
+    
+    else:
+        q = 'REPLACE INTO %s (zoom_level, tile_column, tile_row, %s, tile_timestamp) VALUES (?, ?, ?, ?, ?)'
+        db.execute(q % (table, column), (coord.zoom, coord.column, tile_row, value, int(timestamp)))
+
+def _delete_tile(db, deduped, coord):
+    """ Delete a single tile without committing.
+    
+        Images of a deduplicated tileset are left in place.
+    """
+    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+    q = 'DELETE FROM %s WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+    db.execute(q % (deduped and 'map' or 'tiles'), (coord.zoom, coord.column, tile_row))
+
+def _delete_area(db, deduped, zoom, left, top, right, bottom):
+    """ Delete a block of tiles at one zoom level without committing.
+    
+        Images of a deduplicated tileset are left in place.
+    """
+    q = 'DELETE FROM %s WHERE zoom_level=? AND tile_column>=? AND tile_column<? AND tile_row>=? AND tile_row<?'
+    db.execute(q % (deduped and 'map' or 'tiles'), (zoom, left, right, 2**zoom - bottom, 2**zoom - top))
+
+class Writer:
+    """ Batched writer for a single tileset, for bulk loading.
+    
+        Keeps one connection open and commits after every batch of tiles, or
+        after a number of seconds, whichever comes first. A timer commits a
+        batch that's still pending once that time is up, so tiles become
+        visible even when nothing else is written after them. While the writer is
+        open the database uses write-ahead logging with relaxed syncing, and
+        it's returned to a normal single-file database on close() unless
+        another connection still has it open.
+        
+        Constructor arguments:
+        - filename: Existing tileset file.
+        - batch: Number of tiles in each transaction, default 1000.
+        - interval: Longest number of seconds between commits, default 5.
+        - timestamps: If true, add a tile_timestamp column to the tileset if
+          it's missing. Default false. Tiles are stamped with their save time
+          whenever the column exists.
+        
+        Tiles in an uncommitted batch are not yet visible to readers, for
+        at most one interval. Writers are closed automatically when the interpreter exits.
+    """
+    def __init__(self, filename, batch=1000, interval=5, timestamps=False):
+        self.filename = filename
+        self.batch = batch
+        self.interval = interval
+        
+        # other writers hold the database for up to one interval.
+        self.db = _connect(filename, timeout=interval * 6, check_same_thread=False)
+        self.db.text_factory = bytes
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        
+        self.deduped = _is_deduped(self.db)
+        self.timestamps = _has_timestamps(self.db, self.deduped)
+        
+        if timestamps and not self.timestamps:
+            q = 'ALTER TABLE %s ADD COLUMN tile_timestamp INTEGER'
+            self.db.execute(q % (self.deduped and 'map' or 'tiles'))
+            self.db.commit()
+            self.timestamps = True
+        
+        self.pending = 0
+        self.committed = _time()
+        self.guard = _Lock()
+        self.timer = None
+        
+        _atexit(self.close)
+    
+    def put(self, coord, content):
+        """ Add a tile to the current batch, committing if the batch is done.
+        """
+        self.put_many([coord], [content])
+    
+    def put_many(self, coords, contents):
+        """ Add a list of tiles to the current batch, committing if the batch is done.
+        """
+        with self.guard:
+            timestamp = self.timestamps and _time() or None
+            
+            for (coord, content) in zip(coords, contents):
+                _put_tile(self.db, self.deduped, coord, content, timestamp)
+            
+            self._added(len(coords))
+    
+    def delete(self, coord):
+        """ Add a tile deletion to the current batch, committing if the batch is done.
+        """
+        with self.guard:
+            _delete_tile(self.db, self.deduped, coord)
+            self._added(1)
+    
+    def delete_area(self, zoom, left, top, right, bottom):
+        """ Add a deletion of a block of tiles to the current batch, committing if the batch is done.
+        
+            The block includes left and top, and excludes right and bottom.
+        """
+        with self.guard:
+            _delete_area(self.db, self.deduped, zoom, left, top, right, bottom)
+            self._added(1)
+    
+    def flush(self):
+        """ Commit the current batch.
+        """
+        with self.guard:
+            if self.db is not None:
+                self._commit()
+    
+    def _added(self, count):
+        """ Count changes to the current batch, with the guard already held.
+        """
+        self.pending += count
+        
+        if self.pending >= self.batch or _time() - self.committed >= self.interval:
+            self._commit()
+        
+        elif self.timer is None:
+            # commit on time even if nothing else gets written.
+            self.timer = _Timer(self.committed + self.interval - _time(), self._timed)
+            self.timer.daemon = True
+            self.timer.start()
+    
+    def _timed(self):
+        """ Commit a batch that has been pending for an interval, from the timer.
+        """
+        with self.guard:
+            self.timer = None
+            
+            if self.db is not None and self.pending:
+                self._commit()
+    
+    def _commit(self):
+        """ Commit the current batch, with the guard already held.
+        """
+        self.db.commit()
+        self.pending = 0
+        self.committed = _time()
+    
+    def close(self):
+        """ Commit the current batch and close the tileset.
+        """
+        with self.guard:
+            if self.db is None:
+                return
+        
+            self._commit()
+            
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            
+            try:
+                self.db.execute('PRAGMA journal_mode = DELETE')
+            except:
+                # still open elsewhere, the last one out will switch it back.
+                pass
+            
+            self.db.close()
+            self.db = None
+
 class Provider:
     """ MBTiles provider.
     
@@ -237,40 +597,224 @@ class TileResponse:
         out.write(self.content)
 
 class Cache:
-    """ Cache provider for writing to MBTiles files.
-    
-        This class is not exposed as a normal cache provider for TileStache,
-        because MBTiles has restrictions on file formats that aren't quite
-        compatible with some of the looser assumptions made by TileStache.
-        Instead, this cache provider is provided for use with the script
-        tilestache-seed.py, which can be called with --to-mbtiles option
-        to write cached tiles to a new tileset.
+    """ Cache provider for MBTiles tilesets.
+    
+        Example configuration:
+
+            "cache": {
+              "name": "MBTiles",
+              "filename": "/tmp/stache/{layer}.mbtiles"
+            }
+
+        Extra configuration parameters:
+        - filename: required local file path to a tileset. "{layer}" in the
+          filename is replaced with the layer name, for a separate tileset per
+          layer. Without it, every layer shares one tileset, which only works
+          for a configuration with a single layer.
+        - umask: optional string representation of octal permission mask
+          for new tilesets and lock files. Defaults to 0022.
+        - tileset name: optional name for new tilesets, defaults to the
+          layer name. Passed to the constructor as name.
+        - dedupe: optional boolean flag to create new tilesets with the
+          deduplicated map and images layout. Defaults to false.
+        
+        Tilesets are created as needed, and are given a tile_timestamp column
+        so that cached tiles expire after the layer's cache lifespan. Tiles
+        with no timestamp, e.g. tiles loaded by other applications, never
+        expire. MBTiles holds a single image format: a layer's tiles are only
+        cached in PNG or JPEG, whichever is saved first.
+        
+        Reads are made through shared read-only connections, and writes through
+        one Writer per tileset in each process, with each metatile saved in a
+        single transaction. Tilesets use write-ahead logging while open, so
+        readers are not blocked by writes. Locks are kept in a "locks" directory
+        next to the tileset using a TileStache.Locks.File lock manager; use
+        a "lock" dictionary in the cache configuration for another.
+        
+        The arguments format and batch are for use by tilestache-seed.py, which
+        can be called with --to-mbtiles option to write tiles to a new tileset.
+        Format creates the tileset right away, and batch is the number of tiles
+        to commit in each transaction, defaulting to 1 so that every save is
+        visible at once.
     """
-    def __init__(self, filename, format, name):
+    def __init__(self, filename, format=None, name=None, dedupe=False, umask=0022, batch=1):
         """
         """
         self.filename = filename
+        self.name = name
+        self.dedupe = dedupe
+        self.umask = umask
+        self.batch = batch
+        
+        self._locks = {}
+        self._writers = {}
+        self._pid = None
+        self._guard = _Lock()
         
-        if not tileset_exists(filename):
-            create_tileset(filename, name, 'baselayer', '0', '', format.lower())
+        if format is not None:
+            self._writer(filename, format)
+    
+    def _tileset(self, layer):
+        """ Return the tileset filename for a layer.
+        """
+        return self.filename.replace('{layer}', layer.name())
+    
+    def _writer(self, filename, format, name=None):
+        """ Return the writer for a tileset, creating the tileset if necessary.
+        
+            Returns None if the tileset doesn't exist and can't be created
+            in the requested format.
+        """
+        with self._guard:
+            if self._pid != getpid():
+                # connections can't be shared across a fork().
+                self._writers, self._pid = {}, getpid()
+            
+            if filename not in self._writers:
+                if not tileset_exists(filename):
+                    if format is None or format.lower() not in _formats:
+                        return None
+                    
+                    umask_old = os.umask(self.umask)
+                    
+                    try:
+                        create_tileset(filename, self.name or name or '', 'baselayer', '0', '',
+                                       _formats[format.lower()], dedupe=self.dedupe)
+                    except:
+                        # another process may have created it first.
+                        if not tileset_exists(filename):
+                            raise
+                    finally:
+                        os.umask(umask_old)
+                
+                self._writers[filename] = Writer(filename, self.batch, timestamps=True)
+            
+            return self._writers[filename]
+    
+    def _readable(self, layer, format):
+        """ Return the tileset filename for a layer if it holds tiles of a format.
+        
+            Returns None otherwise, or if there is no such tileset. Only the
+            shared reader is used, so nothing is opened for writing.
+        """
+        filename = self._tileset(layer)
+        
+        if not exists(filename):
+            return None
+        
+        try:
+            tileset_format = _reader(filename).format()
+        except _DatabaseError:
+            # not a tileset, or not one yet if another process is creating it.
+            return None
+        
+        if tileset_format != _formats.get(format.lower()):
+            return None
+        
+        return filename
+    
+    def _ready(self, layer, format, create):
+        """ Return the tileset filename for a layer with its writer open, if it holds tiles of a format.
+        
+            With create, a missing tileset is created first. Returns None
+            otherwise, or if there is no such tileset.
+        """
+        filename = self._tileset(layer)
+        
+        if not create and not self._readable(layer, format):
+            return None
+        
+        if self._writer(filename, create and format or None, layer.name()) is None:
+            return None
+        
+        if _reader(filename).format() != _formats.get(format.lower()):
+            return None
+        
+        return filename
+    
+    def _lock_manager(self, layer):
+        """ Return the lock manager for a layer's tileset.
+        """
+        lockpath = pathjoin(dirname(self._tileset(layer)), 'locks')
+        
+        with self._guard:
+            if lockpath not in self._locks:
+                self._locks[lockpath] = FileLocks(lockpath, self.umask)
+            
+            return self._locks[lockpath]
+    
+    def flush(self):
+        """ Commit the current batch of every tileset written by this process.
+        
+            Writers also commit when the interpreter exits, but exit handlers
+            don't run in multiprocessing children, so worker processes need
+            to call this before they finish.
+        """
+        with self._guard:
+            writers = self._pid == getpid() and self._writers.values() or []
+        
+        for writer in writers:
+            writer.flush()
     
     def lock(self, layer, coord, format):
-        return
+        """ Acquire a cache lock for this tile.
+        
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        return self._lock_manager(layer).lock(layer, coord, format)
     
     def unlock(self, layer, coord, format):
-        return
+        """ Release a cache lock for this tile.
+        """
+        return self._lock_manager(layer).unlock(layer, coord, format)
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        delete_tile(self.filename, coord)
+        filename = self._ready(layer, format, False)
+        
+        if filename:
+            self._writers[filename].delete(coord)
+    
+    def remove_area(self, layer, zooms, bbox, formats):
+        """ Remove every cached tile in an area, in each of a list of formats.
+        
+            Each zoom level of the area is removed with a single statement.
+        """
+        for format in formats:
+            filename = self._ready(layer, format, False)
+            
+            if not filename:
+                continue
+            
+            for (zoom, left, top, right, bottom) in areaRanges(zooms, bbox):
+                self._writers[filename].delete_area(zoom, left, top, right, bottom)
         
     def read(self, layer, coord, format):
         """ Return raw tile content from tileset.
         """
-        return get_tile(self.filename, coord)[1]
+        filename = self._readable(layer, format)
+        
+        if not filename:
+            return None
+        
+        content, timestamp = _reader(filename).get(coord)
+        
+        if layer.cache_lifespan and timestamp is not None:
+            if _time() - timestamp > layer.cache_lifespan:
+                return None
+        
+        return content
     
     def save(self, body, layer, coord, format):
         """ Write raw tile content to tileset.
         """
-        put_tile(self.filename, coord, body)
+        self.save_many([body], layer, [coord], format)
+    
+    def save_many(self, bodies, layer, coords, format):
+        """ Write a list of raw tile contents to tileset in a single transaction.
+        """
+        filename = self._ready(layer, format, True)
+        
+        if filename:
+            self._writers[filename].put_many(coords, bodies)
@@ -20,8 +20,43 @@ Memcache cache parameters:
   revision
     Optional revision number for mass-expiry of cached tiles
     regardless of lifespan. Defaults to 0.
+
+  compress
+    Optional size in bytes above which tiles are zlib-compressed
+    before they are stored. Defaults to 0, no compression.
+
+  generation_zoom
+    Optional zoom level of blocks with their own generation number, so
+    that remove_area() can expire an area by bumping a few numbers instead
+    of deleting every tile. Defaults to none. Unrelated to the per-layer
+    "generations" flag of Disk and S3 caches: Memcache caches have no
+    bump_generation(), see TileStache.Caches.Multi.
+
+Connections to memcache are kept open and reused, one client per thread.
+Tiles of a metatile are saved together in a single round trip, and batches
+of tiles can be read at once with read_many().
+
+Memcache can't list its keys, so remove_area() deletes an area by making up
+the key of every tile in it, a thousand keys to a round trip. With a generation
+zoom the tiles of each zoom level are grouped into blocks, each the size of a
+tile at that zoom, and each block keeps a generation number that's part
+of the key of every tile in it. Removing an area then bumps the generation of
+every block that the area touches, leaving old tiles to be evicted unread.
+Every read and save needs one more round trip to look up generations, and a
+whole block is expired even when the area covers only part of it: 8 or 10 is
+a good choice for removing city-sized areas at street-level zooms.
+
+Keys that would be too long for memcache, e.g. for layers with very long
+names, are replaced with a hash.
 """
-from time import time as _time, sleep as _sleep
+from time import time
+from hashlib import md5
+from threading import local as _local
+
+from ModestMaps.Core import Coordinate
+
+from .Locks import Memcache as MemcacheLocks
+from .Core import areaRanges
 
 try:
     from memcache import Client
@@ -29,74 +64,165 @@ except ImportError:
     # at least we can build the documentation
     pass
 
+# longest key that memcache will accept.
+_max_key_length = 250
+
+# most keys to delete in a single round trip.
+_delete_batch = 1000
+
 def tile_key(layer, coord, format, rev):
     """ Return a tile key string.
     """
     name = layer.name()
-    tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
-    return str('%(rev)s/%(name)s/%(tile)s.%(format)s' % locals())
+    tile = '%d/%d/%d' % (coord.zoom, coord.column, coord.row)
+    key = str('%s/%s/%s.%s' % (rev, name, tile, format))
+
+    if len(key) > _max_key_length or len(key.split()) > 1:
+        # too long, or spaces that memcache won't accept
+        key = str('%s/%s' % (rev, md5(key).hexdigest()))
+
+    return key
+
+def _fresh_generation():
+    """ Return a new generation number, unlike any that came before.
+    """
+    return int(time() * 1000)
 
 class Cache:
     """
     """
-    def __init__(self, servers=['127.0.0.1:11211'], revision=0):
+    def __init__(self, servers=['127.0.0.1:11211'], revision=0, compress=0, generation_zoom=None):
         self.servers = servers
         self.revision = revision
+        self.compress = compress
+        self.generation_zoom = generation_zoom
+
+        self.locks = MemcacheLocks(servers, revision)
+        self._local = _local()
+
+    def _client(self):
+        """ Return a persistent memcache client for the current thread.
+        """
+        if not hasattr(self._local, 'client'):
+            self._local.client = Client(self.servers)
+
+        return self._local.client
+
+    def _generation_key(self, layer, coord, format):
+        """ Return the key of the generation number for the block holding a tile.
+        """
+        zoom = min(int(coord.zoom), int(self.generation_zoom))
+        shift = int(coord.zoom) - zoom
+        block = Coordinate(int(coord.row) >> shift, int(coord.column) >> shift, zoom)
+
+        return tile_key(layer, block, '%d.%s.generation' % (coord.zoom, format), self.revision)
+
+    def _generations(self, keys):
+        """ Return a dictionary of generation numbers for a list of keys.
+
+            Missing numbers are started fresh, so that a number lost to
+            eviction can't bring back tiles from before a removal.
+        """
+        client = self._client()
+        values = client.get_multi(keys)
+        missing = [key for key in keys if key not in values]
+
+        if missing:
+            for key in missing:
+                client.add(key, _fresh_generation())
+
+            values.update(client.get_multi(missing))
+
+        return values
+
+    def _keys(self, layer, coords, format):
+        """ Return a list of tile keys, with generations if there are any.
+        """
+        if self.generation_zoom is None:
+            return [tile_key(layer, coord, format, self.revision) for coord in coords]
+
+        blocks = [self._generation_key(layer, coord, format) for coord in coords]
+        generations = self._generations(list(set(blocks)))
+
+        return [tile_key(layer, coord, format, '%s.%s' % (self.revision, generations.get(block) or _fresh_generation()))
+                for (coord, block) in zip(coords, blocks)]
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
-        
+
             Returns nothing, but blocks until the lock has been acquired.
         """
-        mem = Client(self.servers)
-        key = tile_key(layer, coord, format, self.revision)
-        due = _time() + layer.stale_lock_timeout
-        
-        try:
-            while _time() < due:
-                if mem.add(key+'-lock', 'locked.', layer.stale_lock_timeout):
-                    return
-                
-                _sleep(.2)
-            
-            mem.set(key+'-lock', 'locked.', layer.stale_lock_timeout)
-            return
-
-        finally:
-            mem.disconnect_all()
-        
+        return self.locks.lock(layer, coord, format)
+
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
         """
-        mem = Client(self.servers)
-        key = tile_key(layer, coord, format, self.revision)
-        
-        mem.delete(key+'-lock')
-        mem.disconnect_all()
-        
+        return self.locks.unlock(layer, coord, format)
+
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        mem = Client(self.servers)
-        key = tile_key(layer, coord, format, self.revision)
-        
-        mem.delete(key)
-        
+        key, = self._keys(layer, [coord], format)
+        self._client().delete(key)
+
+    def remove_area(self, layer, zooms, bbox, formats):
+        """ Remove every cached tile in an area, in each of a list of formats.
+
+            With a generation zoom, the generation of every block touched by
+            the area is bumped. Without, tiles are deleted in batches.
+        """
+        client = self._client()
+
+        for (zoom, left, top, right, bottom) in areaRanges(zooms, bbox):
+            if self.generation_zoom is None:
+                coords = [Coordinate(row, column, zoom) for row in range(top, bottom) for column in range(left, right)]
+
+                for format in formats:
+                    keys = [tile_key(layer, coord, format, self.revision) for coord in coords]
+
+                    for offset in range(0, len(keys), _delete_batch):
+                        client.delete_multi(keys[offset:offset + _delete_batch])
+
+                continue
+
+            # first tile of each block, in place of the block.
+            shift = zoom - min(zoom, int(self.generation_zoom))
+            coords = [Coordinate(row << shift, column << shift, zoom)
+                      for row in range(top >> shift, ((bottom - 1) >> shift) + 1)
+                      for column in range(left >> shift, ((right - 1) >> shift) + 1)]
+
+            for format in formats:
+                for coord in coords:
+                    key = self._generation_key(layer, coord, format)
+
+                    if client.incr(key) is None:
+                        client.add(key, _fresh_generation())
+
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
-        mem = Client(self.servers)
-        key = tile_key(layer, coord, format, self.revision)
-        
-        value = mem.get(key)
-        mem.disconnect_all()
-        
-        return value
-        
+        key, = self._keys(layer, [coord], format)
+        return self._client().get(key)
+
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles in a single round trip.
+
+            Returns a list of bodies in the same order as coords,
+            with None for each tile that wasn't found.
+        """
+        keys = self._keys(layer, coords, format)
+        values = self._client().get_multi(keys)
+
+        return [values.get(key) for key in keys]
+
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
-        mem = Client(self.servers)
-        key = tile_key(layer, coord, format, self.revision)
-        
-        mem.set(key, body, layer.cache_lifespan or 0)
+        key, = self._keys(layer, [coord], format)
+        self._client().set(key, body, layer.cache_lifespan or 0, self.compress)
+
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles in a single round trip.
+        """
+        keys = self._keys(layer, coords, format)
+        self._client().set_multi(dict(zip(keys, bodies)), layer.cache_lifespan or 0, '', self.compress)
@@ -23,89 +23,339 @@ S3 cache parameters:
   secret
     Required secret access key for your S3 account.
 
+  uploaders
+    Optional number of tiles from a single metatile to upload at once.
+    Defaults to 8.
+
+  host, port, secure
+    Optional location of an S3-compatible service to use instead of Amazon,
+    e.g. a local stand-in for testing. Secure is a boolean flag for HTTPS,
+    defaults to true. Buckets are addressed by path rather than by hostname
+    whenever a host is given.
+
+  generations
+    Optional boolean flag to keep each layer's tiles in numbered generations,
+    see below. Defaults to false.
+
+  generation_ttl
+    Optional number of seconds that each process keeps its copy of a layer's
+    generation number. Defaults to 5.
+
 Access and secret keys are under "Security Credentials" at your AWS account page:
   http://aws.amazon.com/account/
+
+Each cached tile is read with a single GET request: a missing tile is a 404,
+and when the layer has a cache lifespan an If-Modified-Since header makes S3
+answer an expired tile with an empty 304 instead of the tile body. Connections
+are kept open and reused, one per thread, and the tiles of each metatile are
+uploaded in parallel. Areas are removed by remove_area() with multi-object
+delete requests of up to a thousand keys each, several requests at once.
+
+With generations, tile keys start with the current generation of their layer,
+e.g. "osm/g3/12/656/1582.png", and the number is kept in a small key of its own,
+e.g. "osm/generation". Call bump_generation() to move a layer to a new, empty
+generation at once, instead of deleting millions of keys. Keys of older
+generations are deleted in the background by a low-priority reaper thread in
+the same process, a thousand at a time, using TileStache.Generations.Reaper.
+
+Locks are held as "-lock" keys next to their tiles, so they're seen by every
+server sharing the bucket. Waiters in the same process take turns and are woken
+up as soon as a lock is released, and only poll S3 with a HEAD request when
+another process holds the lock. S3 offers no atomic way to take a lock, so two
+servers may still now and then render the same tile at once; use a "lock"
+dictionary in the cache configuration for another lock manager, e.g. memcache,
+or "thread" to skip the requests when a single process uses the bucket. See
+TileStache.Locks for details.
 """
-from time import time as _time, sleep as _sleep
 from mimetypes import guess_type
-from time import strptime, time
+from time import strptime, time, gmtime, strftime, sleep
+from threading import local as _local, Lock as _Lock
+from multiprocessing.pool import ThreadPool
+from itertools import islice
 from calendar import timegm
+from os import getpid
+
+from ModestMaps.Core import Coordinate
+
+from .Locks import Thread as ThreadLocks
+from .Core import KnownUnknown, areaRanges
+from .Generations import Generations, Reaper
 
 try:
     from boto.s3.bucket import Bucket as S3Bucket
-    from boto.s3.connection import S3Connection
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    from boto.exception import S3ResponseError
 except ImportError:
     # at least we can build the documentation
     pass
 
-def tile_key(layer, coord, format):
-    """ Return a tile key string.
+# most keys that S3 will delete in a single request.
+_delete_batch = 1000
+
+def tile_key(layer, coord, format, generation=None):
+    """ Return a tile key string, with a generation number if there is one.
     """
     name = layer.name()
-    tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
+    tile = '%d/%d/%d' % (coord.zoom, coord.column, coord.row)
     ext = format.lower()
 
+    if generation is not None:
+        name = '%s/g%d' % (name, generation)
+
     return str('%(name)s/%(tile)s.%(ext)s' % locals())
 
 class Cache:
     """
     """
-    def __init__(self, bucket, access, secret):
-        self.bucket = S3Bucket(S3Connection(access, secret), bucket)
+    def __init__(self, bucket, access, secret, uploaders=8, host=None, port=None, secure=True, generations=False, generation_ttl=5):
+        self.bucket_name = bucket
+        self.access = access
+        self.secret = secret
+        self.uploaders = uploaders
+
+        self.host = host
+        self.port = port
+        self.secure = secure
+
+        self.locks = ThreadLocks()
+
+        self._local = _local()
+        self._pool = None
+        self._pool_pid = None
+        self._guard = _Lock()
+
+        self.generations = None
+        self.reaper = None
+
+        if generations:
+            self.generations = Generations(self._read_generation, self._write_generation, generation_ttl)
+            self.reaper = Reaper(delay=generation_ttl * 2)
+
+    def _bucket(self):
+        """ Return a persistent S3 bucket for the current thread.
+
+            Boto connections can't be shared between threads,
+            so each thread keeps its own for reuse.
+        """
+        if not hasattr(self._local, 'bucket'):
+            kwargs = dict(is_secure=bool(self.secure))
+
+            if self.host:
+                kwargs.update(host=self.host, calling_format=OrdinaryCallingFormat())
+
+            if self.port:
+                kwargs.update(port=int(self.port))
+
+            connection = S3Connection(self.access, self.secret, **kwargs)
+            self._local.bucket = S3Bucket(connection, self.bucket_name)
+
+        return self._local.bucket
+
+    def _uploader(self):
+        """ Return a bounded pool of uploader threads for this process.
+        """
+        with self._guard:
+            if self._pool_pid != getpid():
+                self._pool = ThreadPool(self.uploaders)
+                self._pool_pid = getpid()
+
+            return self._pool
+
+    def _key_name(self, layer, coord, format):
+        """ Return the key string for a tile in the current generation of its layer.
+        """
+        if self.generations is None:
+            return tile_key(layer, coord, format)
+
+        return tile_key(layer, coord, format, self.generations.get(layer.name()))
+
+    def _read_generation(self, name):
+        """ Return the generation number of a layer from its key, or None.
+        """
+        key = self._bucket().new_key(str('%s/generation' % name))
+
+        try:
+            return int(key.get_contents_as_string())
+
+        except S3ResponseError, e:
+            if e.status == 404:
+                return None
+
+            raise
+
+    def _write_generation(self, name, number):
+        """ Write the generation number of a layer to its key.
+        """
+        key = self._bucket().new_key(str('%s/generation' % name))
+        key.set_contents_from_string('%d' % number, {'Content-Type': 'text/plain'})
+
+    def _reap_generations(self, name, number):
+        """ Delete every generation of a layer before a number, yielding after each batch of keys.
+        """
+        bucket = self._bucket()
+
+        for prefix in bucket.list(str('%s/g' % name), '/'):
+            generation = prefix.name[len(name) + 2:].rstrip('/')
+
+            if not prefix.name.endswith('/') or not generation.isdigit() or int(generation) >= number:
+                continue
+
+            key_names = []
+
+            for key in bucket.list(prefix.name):
+                key_names.append(key.name)
+
+                if len(key_names) == _delete_batch:
+                    bucket.delete_keys(key_names, quiet=True)
+                    key_names = []
+                    yield
+
+            if key_names:
+                bucket.delete_keys(key_names, quiet=True)
+                yield
+
+    def bump_generation(self, layer):
+        """ Move a layer to a new generation, so that none of its cached tiles are found.
+
+            Returns the new generation number. Older generations are
+            deleted in the background once other processes have caught up.
+        """
+        if self.generations is None:
+            raise KnownUnknown('S3 cache for bucket "%s" has no generations, set "generations" to true to use them' % self.bucket_name)
+
+        number = self.generations.bump(layer.name())
+        self.reaper.put(self._reap_generations, layer.name(), number)
+
+        return number
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
-        
+
             Returns nothing, but blocks until the lock has been acquired.
         """
-        key_name = tile_key(layer, coord, format)
-        due = _time() + layer.stale_lock_timeout
-        
-        while _time() < due:
-            if not self.bucket.get_key(key_name+'-lock'):
+        key_name = tile_key(layer, coord, format) + '-lock'
+        timeout = layer.stale_lock_timeout
+        due = time() + timeout
+
+        # take turns inside this process first.
+        self.locks.acquire(key_name, timeout)
+
+        bucket = self._bucket()
+
+        while time() < due:
+            if not bucket.get_key(key_name):
                 break
-            
-            _sleep(.2)
-        
-        key = self.bucket.new_key(key_name+'-lock')
+
+            sleep(.2)
+
+        key = bucket.new_key(key_name)
         key.set_contents_from_string('locked.', {'Content-Type': 'text/plain'})
-        
+
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
         """
-        key_name = tile_key(layer, coord, format)
-        self.bucket.delete_key(key_name+'-lock')
-        
+        key_name = tile_key(layer, coord, format) + '-lock'
+
+        try:
+            self._bucket().delete_key(key_name)
+        finally:
+            self.locks.release(key_name)
+
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        key_name = tile_key(layer, coord, format)
-        self.bucket.delete_key(key_name)
-        
+        key_name = self._key_name(layer, coord, format)
+        self._bucket().delete_key(key_name)
+
+    def remove_area(self, layer, zooms, bbox, formats):
+        """ Remove every cached tile in an area, in each of a list of formats.
+
+            Keys are deleted in batches with multi-object delete requests.
+            Deleting a key that isn't there is not an error, so keys are
+            made up for every tile in the area instead of listed first.
+            Uploaders are given one batch each at a time, so a large area
+            is never held in memory all at once.
+        """
+        generation = self.generations and self.generations.get(layer.name())
+
+        def batches():
+            batch = []
+
+            for (zoom, left, top, right, bottom) in areaRanges(zooms, bbox):
+                for column in range(left, right):
+                    for row in range(top, bottom):
+                        for format in formats:
+                            batch.append(tile_key(layer, Coordinate(row, column, zoom), format, generation))
+
+                            if len(batch) == _delete_batch:
+                                yield batch
+                                batch = []
+
+            if batch:
+                yield batch
+
+        def delete(key_names):
+            result = self._bucket().delete_keys(key_names, quiet=True)
+
+            if result.errors:
+                error = result.errors[0]
+                raise Exception('Failed to remove %d keys from S3, e.g. %s: %s' % (len(result.errors), error.key, error.message))
+
+        stream = batches()
+
+        while True:
+            chunk = list(islice(stream, self.uploaders))
+
+            if not chunk:
+                break
+
+            self._uploader().map(delete, chunk, 1)
+
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
-        key_name = tile_key(layer, coord, format)
-        key = self.bucket.get_key(key_name)
-        
-        if key is None:
-            return None
-        
+        key_name = self._key_name(layer, coord, format)
+        key = self._bucket().new_key(key_name)
+        headers = {}
+
         if layer.cache_lifespan:
+            # S3 answers 304 Not Modified for tiles older than the lifespan.
+            oldest = gmtime(time() - layer.cache_lifespan)
+            headers['If-Modified-Since'] = strftime('%a, %d %b %Y %H:%M:%S GMT', oldest)
+
+        try:
+            body = key.get_contents_as_string(headers)
+
+        except S3ResponseError, e:
+            if e.status in (304, 404):
+                return None
+
+            raise
+
+        if layer.cache_lifespan and key.last_modified:
+            # in case the service ignored If-Modified-Since
             t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
 
             if (time() - t) > layer.cache_lifespan:
                 return None
-        
-        return key.get_contents_as_string()
-        
+
+        return body
+
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
-        key_name = tile_key(layer, coord, format)
-        key = self.bucket.new_key(key_name)
-        
+        key_name = self._key_name(layer, coord, format)
+        key = self._bucket().new_key(key_name)
+
         content_type, encoding = guess_type('example.'+format)
         headers = content_type and {'Content-Type': content_type} or {}
-        
+
         key.set_contents_from_string(body, headers, policy='public-read')
+
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles, uploading several at once.
+        """
+        def save(args):
+            self.save(args[0], layer, args[1], format)
+
+        self._uploader().map(save, zip(bodies, coords))
@@ -0,0 +1,178 @@
+""" Compact integer IDs for tiles.
+
+A tile ID is a single integer holding the zoom level and a Morton code, the
+bits of the column and row interleaved. A marker bit above the Morton code
+gives away the zoom, so that no two tiles at any zoom share an ID:
+
+    id = (1 << 2 * zoom) | morton(column, row)
+
+IDs are cheap to hash and to keep in memory, and sort by zoom first and then
+in Z-order within each zoom (see Curves), so that tiles near each other on the
+map are near each other in a sorted list. Quadtree arithmetic needs no new
+Coordinate objects: the parent of a tile is id >> 2, its four children are
+(id << 2) | 0...3, and all of its descendants at some deeper zoom form one
+contiguous range of IDs.
+
+Example use:
+
+    id = from_coord(Coordinate(1582, 656, 12))
+    up = parent(id)
+    first, stop = descendants(id, 15)
+
+    column, row, zoom = decode(id)
+    coord = to_coord(id)
+
+IDs are plain Python integers, so they can be used as dictionary keys, put
+in lists and sets, pickled and written to JSON.
+"""
+from ModestMaps.Core import Coordinate
+
+def _spread_byte(byte):
+    """ Spread the bits of a byte out to every other bit of 16.
+    """
+    return sum([((byte >> bit) & 1) << (bit * 2) for bit in range(8)])
+
+def _gather_byte(byte):
+    """ Gather the even bits of a byte into 4 bits.
+    """
+    return sum([((byte >> (bit * 2)) & 1) << bit for bit in range(4)])
+
+# lookup tables that handle eight bits at a time.
+_spread = [_spread_byte(byte) for byte in range(256)]
+_gather = [_gather_byte(byte) for byte in range(256)]
+
+def morton(column, row):
+    """ Return the Morton code of a column and row, with column bits in the even places.
+    """
+    code, shift = 0, 0
+    column, row = int(column), int(row)
+
+    if column < 0 or row < 0:
+        raise ValueError('Morton codes need a non-negative column and row, not %d and %d' % (column, row))
+
+    while column or row:
+        code |= (_spread[column & 0xff] | (_spread[row & 0xff] << 1)) << shift
+        column, row = column >> 8, row >> 8
+        shift += 16
+
+    return code
+
+def unmorton(code):
+    """ Return the (column, row) of a Morton code, the inverse of morton().
+    """
+    column, row, shift = 0, 0, 0
+
+    while code:
+        column |= _gather[code & 0xff] << shift
+        row |= _gather[(code >> 1) & 0xff] << shift
+        code >>= 8
+        shift += 4
+
+    return column, row
+
+def encode(column, row, zoom):
+    """ Return the ID of a tile.
+
+        Raise ValueError if the tile is off the map, since the column and
+        row of a tile at zoom z must both be less than 2^z to have an ID.
+    """
+    column, row, zoom = int(column), int(row), int(zoom)
+
+    if column >> zoom or row >> zoom:
+        # also true of negative numbers.
+        raise ValueError('Tile %d/%d/%d is off the map' % (zoom, column, row))
+
+    # same as morton(), inline because this is called for every tile.
+    id, shift = 1 << (2 * zoom), 0
+
+    while column or row:
+        id |= (_spread[column & 0xff] | (_spread[row & 0xff] << 1)) << shift
+        column, row = column >> 8, row >> 8
+        shift += 16
+
+    return id
+
+def decode(id):
+    """ Return the (column, row, zoom) of a tile ID.
+    """
+    z = zoom(id)
+    column, row = unmorton(id ^ (1 << (2 * z)))
+
+    return column, row, z
+
+def from_coord(coord):
+    """ Return the ID of a ModestMaps Coordinate.
+    """
+    return encode(coord.column, coord.row, coord.zoom)
+
+def key(coord):
+    """ Return a hashable key for a ModestMaps Coordinate.
+
+        The key is the tile's ID, or a (zoom, column, row) tuple for a
+        tile off the map, such as padding around the edge of the world.
+    """
+    try:
+        return from_coord(coord)
+    except ValueError:
+        return coord.zoom, coord.column, coord.row
+
+def from_key(key):
+    """ Return a new ModestMaps Coordinate for a key from key().
+    """
+    if type(key) is tuple:
+        zoom, column, row = key
+        return Coordinate(row, column, zoom)
+
+    return to_coord(key)
+
+def to_coord(id):
+    """ Return a new ModestMaps Coordinate for a tile ID.
+    """
+    column, row, z = decode(id)
+
+    return Coordinate(row, column, z)
+
+def zoom(id):
+    """ Return the zoom level of a tile ID.
+    """
+    return (id.bit_length() - 1) / 2
+
+def parent(id, levels=1):
+    """ Return the ID of the tile a number of zoom levels above, or None above zoom 0.
+    """
+    if levels > zoom(id):
+        return None
+
+    return id >> (2 * levels)
+
+def children(id):
+    """ Return a list of the four child tile IDs, in Z-order.
+    """
+    return [(id << 2) | quadrant for quadrant in range(4)]
+
+def descendants(id, z):
+    """ Return the (first, stop) range of IDs below a tile at a deeper zoom.
+
+        Every tile at that zoom under this one has an ID in range(first, stop).
+    """
+    depth = z - zoom(id)
+
+    return id << (2 * depth), (id + 1) << (2 * depth)
+
+def neighbor(id, columns, rows):
+    """ Return the ID of a tile a number of columns and rows away, or None if it's off the map.
+    """
+    column, row, z = decode(id)
+    column, row = column + columns, row + rows
+
+    if column < 0 or row < 0 or column >= (1 << z) or row >= (1 << z):
+        return None
+
+    return encode(column, row, z)
+
+def quadkey(id):
+    """ Return the quadkey string of a tile ID, as used by Bing Maps.
+    """
+    z = zoom(id)
+
+    return ''.join([str((id >> (2 * level)) & 3) for level in range(z - 1, -1, -1)])
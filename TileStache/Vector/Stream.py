@@ -0,0 +1,264 @@
+""" Streaming JSON output for the Vector provider.
+
+The dictionary path turns each feature into a tree of dictionaries with
+json_loads(geometry.ExportToJson()), encodes the tree with JSONEncoder, and
+matches every atom of output against a regular expression to round floats
+to the configured precision. The functions here write GeoJSON and Arc
+GeoServices JSON straight from OGR geometries instead: coordinates are read
+with GetPoints(), each point is rounded and written by a single string format,
+and Arc output skips the intermediate objects of reserialize_to_arc().
+
+Output has the same structure and key order as the dictionary path. The only
+difference is in floats, which are all written at the configured precision
+here. JSONEncoder emits list items together with their brackets and commas,
+e.g. ", 37.8044", which the regular expression never matches, so most
+coordinates from the dictionary path keep their full precision; and a
+whole-number coordinate comes out as "1.000000" here instead of "1".
+
+Example use, with a stream of (properties, geometry) pairs from OGR:
+
+    content = {'type': 'FeatureCollection', 'features': features}
+
+    write_geojson(out, content, 'osm_id', 6)
+    write_arcjson(out, {'wkid': 4326}, features, 6)
+"""
+from re import compile
+
+try:
+    from json import JSONEncoder, loads as json_loads
+except ImportError:
+    from simplejson import JSONEncoder, loads as json_loads
+
+from TileStache.Core import KnownUnknown
+from Arc import geometry_types, _amfSpatialReference, _amfFeatureSet, _amfFeature, \
+                _amfGeometryPolyline, _amfGeometryPolygon
+
+_encoder = JSONEncoder()
+_float_pat = compile(r'^-?\d+\.\d+$')
+
+# GeoJSON type names by OGR geometry name.
+_geojson_types = {
+    'POINT': 'Point',
+    'LINESTRING': 'LineString',
+    'POLYGON': 'Polygon',
+    'MULTIPOINT': 'MultiPoint',
+    'MULTILINESTRING': 'MultiLineString',
+    'MULTIPOLYGON': 'MultiPolygon',
+    'GEOMETRYCOLLECTION': 'GeometryCollection'
+  }
+
+#
+# Key orders of the dictionaries in the dictionary path, made the same way
+# so that output comes out in the same order.
+#
+_geometry_keys = list(json_loads('{"type": null, "coordinates": null}'))
+_collection_keys = list(json_loads('{"type": null, "geometries": null}'))
+_feature_keys = list({'type': None, 'properties': None, 'geometry': None})
+_feature_id_keys = {'type': None, 'properties': None, 'geometry': None}
+_feature_id_keys['id'] = None
+_feature_id_keys = list(_feature_id_keys)
+
+_arc_set_keys = list(_amfFeatureSet(None, None, None))
+_arc_feature_keys = list(_amfFeature(None, None))
+_arc_polyline_keys = list(_amfGeometryPolyline(None, None))
+_arc_polygon_keys = list(_amfGeometryPolygon(None, None))
+_arc_point_keys = list({'x': None, 'y': None})
+
+def _object(keys, values):
+    """ Return a JSON object from a list of keys and a dictionary of encoded values.
+    """
+    return '{' + ', '.join(['"%s": %s' % (key, values[key]) for key in keys if key in values]) + '}'
+
+def _value(value, precision):
+    """ Return JSON for any value, with floats rounded like the dictionary path.
+    """
+    if type(value) is float:
+        atom = _encoder.encode(value)
+        return _float_pat.match(atom) and ('%.*f' % (precision, value)) or atom
+
+    elif type(value) in (list, tuple):
+        return '[' + ', '.join([_value(item, precision) for item in value]) + ']'
+
+    elif type(value) is dict:
+        return '{' + ', '.join(['%s: %s' % (_encoder.encode(key), _value(val, precision)) for (key, val) in value.items()]) + '}'
+
+    return _encoder.encode(value)
+
+class _Points:
+    """ Point formats at one precision, one for each number of dimensions.
+    """
+    def __init__(self, precision):
+        self.precision = precision
+        self.formats = {}
+
+    def format(self, dimensions):
+        if dimensions not in self.formats:
+            self.formats[dimensions] = '[' + ', '.join(['%%.%df' % self.precision] * dimensions) + ']'
+
+        return self.formats[dimensions]
+
+    def point(self, geometry, dimensions=None):
+        """ Return JSON for a single OGR point.
+        """
+        if geometry.IsEmpty():
+            return '[]'
+
+        if (dimensions or geometry.GetCoordinateDimension()) == 3:
+            return self.format(3) % geometry.GetPoint()
+
+        return self.format(2) % geometry.GetPoint_2D()
+
+    def line(self, geometry, dimensions=None):
+        """ Return JSON for a list of the points of an OGR line or ring.
+        """
+        points = geometry.GetPoints()
+
+        if not points:
+            return '[]'
+
+        if dimensions and dimensions != len(points[0]):
+            points = [xy[:dimensions] for xy in points]
+
+        return '[' + ', '.join(map(self.format(len(points[0])).__mod__, points)) + ']'
+
+def _geojson_coordinates(geometry, points):
+    """ Return JSON for the coordinates of an OGR geometry.
+    """
+    name = geometry.GetGeometryName()
+
+    if name == 'POINT':
+        return points.point(geometry)
+
+    elif name in ('LINESTRING', 'LINEARRING'):
+        return points.line(geometry)
+
+    parts = [geometry.GetGeometryRef(index) for index in range(geometry.GetGeometryCount())]
+
+    return '[' + ', '.join([_geojson_coordinates(part, points) for part in parts]) + ']'
+
+def _geojson_geometry(geometry, points):
+    """ Return GeoJSON for an OGR geometry.
+    """
+    name = geometry.GetGeometryName()
+
+    if name not in _geojson_types:
+        # not one of the usual types, so take the slow way.
+        return _value(json_loads(geometry.ExportToJson()), points.precision)
+
+    if name == 'GEOMETRYCOLLECTION':
+        parts = [geometry.GetGeometryRef(index) for index in range(geometry.GetGeometryCount())]
+        parts = '[' + ', '.join([_geojson_geometry(part, points) for part in parts]) + ']'
+
+        return _object(_collection_keys, {'type': '"GeometryCollection"', 'geometries': parts})
+
+    coordinates = _geojson_coordinates(geometry, points)
+
+    return _object(_geometry_keys, {'type': '"%s"' % _geojson_types[name], 'coordinates': coordinates})
+
+def write_geojson(out, content, id_property, precision):
+    """ Write a GeoJSON feature collection to a file-like object.
+
+        Content is a dictionary like that of VectorResponse, with an
+        iterable of (properties, geometry) pairs for features. Features
+        get an id from the id_property property, if they have one.
+    """
+    points = _Points(precision)
+
+    def features():
+        yield '['
+
+        for (index, (properties, geometry)) in enumerate(content['features']):
+            values = {'type': '"Feature"', 'properties': _value(properties, precision),
+                      'geometry': _geojson_geometry(geometry, points)}
+
+            if id_property is not None and id_property in properties:
+                values['id'] = _value(properties[id_property], precision)
+                keys = _feature_id_keys
+            else:
+                keys = _feature_keys
+
+            yield (index and ', ' or '') + _object(keys, values)
+
+        yield ']'
+
+    out.write('{')
+
+    for (index, key) in enumerate(content):
+        out.write((index and ', ' or '') + _encoder.encode(key) + ': ')
+
+        if key == 'features':
+            for chunk in features():
+                out.write(chunk)
+        else:
+            out.write(_value(content[key], precision))
+
+    out.write('}')
+
+def _arc_geometry(geometry, sref, points):
+    """ Return Arc GeoServices JSON and geometry type for an OGR geometry.
+    """
+    name = geometry.GetGeometryName()
+    geometry_type = geometry_types.get(_geojson_types.get(name))
+
+    if geometry_type is None:
+        raise KnownUnknown('Arc serialization can\'t handle a %s geometry' % name)
+
+    parts = [geometry.GetGeometryRef(index) for index in range(geometry.GetGeometryCount())]
+
+    if name == 'POINT':
+        if geometry.IsEmpty():
+            raise KnownUnknown('Arc serialization can\'t handle an empty point')
+
+        x, y = geometry.GetPoint_2D()
+        values = {'x': '%.*f' % (points.precision, x), 'y': '%.*f' % (points.precision, y)}
+        arc_geometry = _object(_arc_point_keys, values)
+
+    elif name == 'LINESTRING':
+        paths = '[' + points.line(geometry, 2) + ']'
+        arc_geometry = _object(_arc_polyline_keys, {'spatialReference': sref, 'paths': paths})
+
+    elif name == 'POLYGON':
+        rings = '[' + ', '.join([points.line(ring, 2) for ring in parts]) + ']'
+        arc_geometry = _object(_arc_polygon_keys, {'spatialReference': sref, 'rings': rings})
+
+    elif name == 'MULTIPOINT':
+        arc_geometry = '{"points": [%s]}' % ', '.join([points.point(point, 2) for point in parts])
+
+    elif name == 'MULTILINESTRING':
+        paths = '[' + ', '.join([points.line(path, 2) for path in parts]) + ']'
+        arc_geometry = _object(_arc_polyline_keys, {'spatialReference': sref, 'paths': paths})
+
+    elif name == 'MULTIPOLYGON':
+        rings = [polygon.GetGeometryRef(index) for polygon in parts for index in range(polygon.GetGeometryCount())]
+        rings = '[' + ', '.join([points.line(ring, 2) for ring in rings]) + ']'
+        arc_geometry = _object(_arc_polygon_keys, {'spatialReference': sref, 'rings': rings})
+
+    return arc_geometry, geometry_type
+
+def write_arcjson(out, crs, features, precision):
+    """ Write an Arc GeoServices JSON feature set to a file-like object.
+
+        Crs is a dictionary with "wkid" or "wkt", and features is an iterable
+        of (properties, geometry) pairs. Like reserialize_to_arc(), raises
+        KnownUnknown if there's more than one geometry type. Nothing is
+        written until every feature has been read.
+    """
+    points = _Points(precision)
+    sref = _value(_amfSpatialReference(crs.get('wkid', None), crs.get('wkt', None)), precision)
+
+    chunks, found_geometry_types, geometry_type = [], set(), None
+
+    for (properties, geometry) in features:
+        arc_geometry, geometry_type = _arc_geometry(geometry, sref, points)
+        found_geometry_types.add(geometry_type)
+
+        values = {'attributes': _value(properties, precision), 'geometry': arc_geometry}
+        chunks.append(_object(_arc_feature_keys, values))
+
+    if len(found_geometry_types) > 1:
+        raise KnownUnknown('Arc serialization needs a single geometry type, not ' + ', '.join(found_geometry_types))
+
+    values = {'geometryType': _encoder.encode(geometry_type), 'spatialReference': sref,
+              'features': '[' + ', '.join(chunks) + ']'}
+
+    out.write(_object(_arc_set_keys, values))
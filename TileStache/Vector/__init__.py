@@ -87,6 +87,19 @@ Common parameters:
     features at least this many pixels apart are returned. Order of features
     in the data source matters: early features beat out later features.
   
+  simplify:
+    Optional number of tile pixels for simplifying geometries in responses.
+    Geometries are simplified before they're clipped, with a tolerance of
+    this many pixels at the zoom level of each tile, so low zoom tiles lose
+    detail that would never be seen and high zoom tiles keep all of it.
+    Half a pixel to a pixel is usually invisible.
+  
+  preserve_topology:
+    Default is false.
+    Boolean flag for simplifying with OGR's SimplifyPreserveTopology() rather
+    than plain Douglas-Peucker Simplify(), so that polygons stay valid and
+    small features don't collapse away, at some cost in speed and size.
+  
   verbose:
     Default is false.
     Boolean flag for optionally expanding output with additional whitespace
@@ -148,21 +161,29 @@ how to correctly filter and reproject it. Although response tiles are typically
 in web (spherical) mercator projection, the actual vector content of responses
 is unprojected back to plain WGS84 latitude and longitude.
 
+Datasources are opened once and kept open by each thread for later tiles,
+so a PostGIS layer costs one connection per server thread rather than one
+per tile. Files are opened again when they change on disk, and connections
+that have been idle for a while are checked before they're used again.
+
 If you are using PostGIS and spherical mercator a.k.a. SRID 900913,
 you can save yourself a world of trouble by using this definition:
   http://github.com/straup/postgis-tools/raw/master/spatial_ref_900913-8.3.sql
 """
 
 from re import compile
+from os import getpid, stat
+from time import time
 from urlparse import urlparse, urljoin
+from threading import local as _local
 
 try:
-    from json import JSONEncoder, loads as json_loads
+    from json import JSONEncoder, loads as json_loads, dumps as json_dumps
 except ImportError:
-    from simplejson import JSONEncoder, loads as json_loads
+    from simplejson import JSONEncoder, loads as json_loads, dumps as json_dumps
 
 try:
-    from osgeo import ogr, osr
+    from osgeo import ogr, osr, gdal
 except ImportError:
     # At least we'll be able to build the documentation.
     pass
@@ -170,6 +191,7 @@ except ImportError:
 from TileStache.Core import KnownUnknown
 from TileStache.Geography import getProjectionByName
 from Arc import reserialize_to_arc, pyamf_classes
+from Stream import write_geojson, write_arcjson
 
 class VectorResponse:
     """ Wrapper class for Vector response that makes it behave like a PIL.Image object.
@@ -177,13 +199,21 @@ class VectorResponse:
         TileStache.getTile() expects to be able to save one of these to a buffer.
         
         Constructor arguments:
-        - content: Vector data to be serialized, typically a dictionary.
+        - content: Vector data to be serialized, a dictionary with an iterable
+          of (properties, geometry) pairs for features; see _Features.
         - verbose: Boolean flag to expand response for better legibility.
+        - precision: Number of decimal places for floating point values.
+        - id_property: Optional property to use for GeoJSON feature ids.
+        
+        Compact GeoJSON and Arc JSON are streamed straight from the features
+        by TileStache.Vector.Stream, while other encodings and verbose JSON
+        are encoded from dictionaries of features.
     """
-    def __init__(self, content, verbose, precision=6):
+    def __init__(self, content, verbose, precision=6, id_property=None):
         self.content = content
         self.verbose = verbose
         self.precision = precision
+        self.id_property = id_property
 
     def save(self, out, format):
         """
@@ -200,7 +230,7 @@ class VectorResponse:
             return
         
         if format in ('GeoJSON', 'GeoBSON', 'GeoAMF'):
-            content = self.content
+            content = dict(self.content)
             
             if 'wkt' in content['crs']:
                 content['crs'] = {'type': 'link', 'properties': {'href': '0.wkt', 'type': 'ogcwkt'}}
@@ -208,25 +238,30 @@ class VectorResponse:
                 del content['crs']
 
         elif format in ('ArcJSON', 'ArcBSON', 'ArcAMF'):
-            content = reserialize_to_arc(self.content, format == 'ArcAMF')
+            content = self.content
         
         else:
             raise KnownUnknown('Vector response only saves .geojson, .arcjson, .geobson, .arcbson, .geoamf, .arcamf and .wkt tiles, not "%s"' % format)
 
+        if format == 'GeoJSON' and not self.verbose:
+            write_geojson(out, content, self.id_property, self.precision)
+            return
+        
+        elif format == 'ArcJSON' and not self.verbose:
+            write_arcjson(out, content['crs'], content['features'], self.precision)
+            return
+        
+        content = dict(content)
+        content['features'] = [_feature_dict(prop, geometry, self.id_property) for (prop, geometry) in content['features']]
+        
+        if format in ('ArcJSON', 'ArcBSON', 'ArcAMF'):
+            content = reserialize_to_arc(content, format == 'ArcAMF')
+
         #
         # Encode
         #
         if format in ('GeoJSON', 'ArcJSON'):
-            indent = self.verbose and 2 or None
-            
-            encoded = JSONEncoder(indent=indent).iterencode(content)
-            float_pat = compile(r'^-?\d+\.\d+$')
-    
-            for atom in encoded:
-                if float_pat.match(atom):
-                    out.write(('%%.%if' % self.precision) % float(atom))
-                else:
-                    out.write(atom)
+            _encode_json(out, content, self.verbose and 2 or None, self.precision)
         
         elif format in ('GeoBSON', 'ArcBSON'):
             import bson
@@ -243,6 +278,21 @@ class VectorResponse:
             encoded = pyamf.encode(content, 0).read()
             out.write(encoded)
 
+def _encode_json(out, content, indent, precision):
+    """ Encode a dictionary of content as JSON with floats at a given precision.
+    
+        Slower than TileStache.Vector.Stream, but it handles any content
+        and indentation.
+    """
+    encoded = JSONEncoder(indent=indent).iterencode(content)
+    float_pat = compile(r'^-?\d+\.\d+$')
+
+    for atom in encoded:
+        if float_pat.match(atom):
+            out.write(('%%.%if' % precision) % float(atom))
+        else:
+            out.write(atom)
+
 def _sref_4326():
     """
     """
@@ -359,6 +409,37 @@ def _append_with_delim(s, delim, data, key):
     else:
         return s
 	
+# OGR driver names by the names accepted in configuration.
+_okay_drivers = {'postgis': 'PostgreSQL', 'esri shapefile': 'ESRI Shapefile',
+                 'postgresql': 'PostgreSQL', 'shapefile': 'ESRI Shapefile',
+                 'geojson': 'GeoJSON', 'spatialite': 'SQLite', 'oracle': 'OCI', 'mysql': 'MySQL'}
+
+# drivers that read local files, and drivers that connect to databases.
+_file_drivers = ('ESRI Shapefile', 'GeoJSON', 'SQLite')
+_database_drivers = ('PostgreSQL', 'MySQL', 'OCI')
+
+def _driver_name(driver_name):
+    """ Return the OGR name of a driver named in configuration.
+    """
+    if driver_name.lower() not in _okay_drivers:
+        raise KnownUnknown('Got a driver type Vector doesn\'t understand: "%s". Need one of %s.' % (driver_name, ', '.join(_okay_drivers.keys())))
+
+    return _okay_drivers[driver_name.lower()]
+
+def _file_path(parameters, dirpath):
+    """ Return the local path of a data file, relative to configuration dirpath.
+    """
+    if 'file' not in parameters:
+        raise KnownUnknown('Need at least a "file" parameter for a shapefile')
+
+    file_href = urljoin(dirpath, parameters['file'])
+    scheme, h, file_path, q, p, f = urlparse(file_href)
+    
+    if scheme not in ('file', ''):
+        raise KnownUnknown('Shapefiles need to be local, not %s' % file_href)
+    
+    return file_path
+
 def _open_layer(driver_name, parameters, dirpath):
     """ Open a layer, return it and its datasource.
     
@@ -367,14 +448,7 @@ def _open_layer(driver_name, parameters, dirpath):
     #
     # Set up the driver
     #
-    okay_drivers = {'postgis': 'PostgreSQL', 'esri shapefile': 'ESRI Shapefile',
-                    'postgresql': 'PostgreSQL', 'shapefile': 'ESRI Shapefile',
-                    'geojson': 'GeoJSON', 'spatialite': 'SQLite', 'oracle': 'OCI', 'mysql': 'MySQL'}
-    
-    if driver_name.lower() not in okay_drivers:
-        raise KnownUnknown('Got a driver type Vector doesn\'t understand: "%s". Need one of %s.' % (driver_name, ', '.join(okay_drivers.keys())))
-
-    driver_name = okay_drivers[driver_name.lower()]
+    driver_name = _driver_name(driver_name)
     driver = ogr.GetDriverByName(str(driver_name))
     
     #
@@ -421,17 +495,8 @@ def _open_layer(driver_name, parameters, dirpath):
         source_name = _append_with_delim(source_name, '/', parameters, 'dbname')
         source_name = source_name + ":" + parameters['table']
         
-    elif driver_name in ('ESRI Shapefile', 'GeoJSON', 'SQLite'):
-        if 'file' not in parameters:
-            raise KnownUnknown('Need at least a "file" parameter for a shapefile')
-    
-        file_href = urljoin(dirpath, parameters['file'])
-        scheme, h, file_path, q, p, f = urlparse(file_href)
-        
-        if scheme not in ('file', ''):
-            raise KnownUnknown('Shapefiles need to be local, not %s' % file_href)
-        
-        source_name = file_path
+    elif driver_name in _file_drivers:
+        source_name = _file_path(parameters, dirpath)
 
     datasource = driver.Open(str(source_name))
 
@@ -464,12 +529,112 @@ def _open_layer(driver_name, parameters, dirpath):
     #
     return layer, datasource
 
-def _get_features(coord, properties, projection, layer, clipped, projected, spacing, id_property):
-    """ Return a list of features in an OGR layer with properties in GeoJSON form.
+def _source_signature(driver_name, parameters, dirpath):
+    """ Return something that changes when a data file changes, or None.
+    
+        Uses the modification time and size of the file; database
+        sources have no signature.
+    """
+    if _driver_name(driver_name) not in _file_drivers:
+        return None
+    
+    try:
+        info = stat(_file_path(parameters, dirpath))
+    except OSError:
+        return None
+    
+    return info.st_mtime, info.st_size
+
+def _is_healthy(driver_name, datasource):
+    """ Return false if a datasource has lost its database connection.
     
-        Optionally clip features to coordinate bounding box, and optionally
-        limit returned features to only those separated by number of pixels
-        given as spacing.
+        Runs a trivial query; file datasources are always healthy.
+    """
+    driver_name = _driver_name(driver_name)
+    
+    if driver_name not in _database_drivers:
+        return True
+    
+    query = driver_name == 'OCI' and 'SELECT 1 FROM DUAL' or 'SELECT 1'
+    result = datasource.ExecuteSQL(query)
+    
+    if result is None:
+        return False
+    
+    datasource.ReleaseResultSet(result)
+    return True
+
+class _Handles:
+    """ Open layers and datasources, kept for reuse by each thread.
+    
+        Opening a datasource is the largest fixed cost of a vector tile,
+        a full connection handshake for PostGIS and a fresh read of the
+        headers for a shapefile, so open handles are kept by provider
+        parameters and reused from tile to tile. OGR datasources can't be
+        shared between threads or across a fork(), so each thread of each
+        process keeps its own.
+        
+        A file is opened again when its modification time or size changes,
+        and a database connection is checked with a trivial query whenever
+        more than a number of seconds have passed since its last check, no
+        matter how busy it is. Between checks, a connection that fails while
+        features are read is caught by _iter_features().
+    """
+    def __init__(self, check_interval=30):
+        self.check_interval = check_interval
+        self.local = _local()
+    
+    def _handles(self):
+        """ Return a dictionary of open handles for the current thread.
+        """
+        if getattr(self.local, 'pid', None) != getpid():
+            self.local.handles, self.local.pid = {}, getpid()
+        
+        return self.local.handles
+    
+    def get(self, driver_name, parameters, dirpath):
+        """ Return an open layer and its datasource, like _open_layer().
+        """
+        handles = self._handles()
+        key = driver_name.lower(), json_dumps(parameters, sort_keys=True), dirpath
+        signature = _source_signature(driver_name, parameters, dirpath)
+        
+        if key in handles:
+            layer, datasource, old_signature, checked = handles[key]
+            
+            if old_signature != signature:
+                del handles[key]
+            
+            elif time() - checked > self.check_interval:
+                if _is_healthy(driver_name, datasource):
+                    handles[key] = layer, datasource, signature, time()
+                else:
+                    del handles[key]
+        
+        if key not in handles:
+            layer, datasource = _open_layer(driver_name, parameters, dirpath)
+            handles[key] = layer, datasource, signature, time()
+        
+        layer, datasource, signature, checked = handles[key]
+        return layer, datasource
+    
+    def discard(self, driver_name, parameters, dirpath):
+        """ Forget the handle for a set of parameters, so it's opened again next time.
+        """
+        key = driver_name.lower(), json_dumps(parameters, sort_keys=True), dirpath
+        self._handles().pop(key, None)
+
+# shared by every provider, so layers with the same parameters share handles.
+_handles = _Handles()
+
+def _iter_features(coord, properties, projection, layer, clipped, projected, spacing, simplify=None, preserve_topology=False):
+    """ Generate (properties, geometry) pairs for features in an OGR layer.
+    
+        Properties are a dictionary and geometry is an OGR Geometry in output
+        coordinates. Optionally clip features to coordinate bounding box,
+        optionally limit returned features to only those separated by number
+        of pixels given as spacing, and optionally simplify geometries with
+        a tolerance of a number of pixels given as simplify.
     """
     #
     # Prepare output spatial reference - always WGS84.
@@ -492,16 +657,40 @@ def _get_features(coord, properties, projection, layer, clipped, projected, spac
     # Spatially filter the layer
     #
     bbox = _tile_perimeter_geom(coord, projection, clipped == 'padded')
+    xmin, xmax, ymin, ymax = bbox.GetEnvelope()
     bbox.TransformTo(layer_sref)
     layer.SetSpatialFilter(bbox)
+    layer.ResetReading()
+    
+    if simplify:
+        #
+        # Tolerance is a number of pixels, converted from output
+        # units to data source units by the ratio of bbox widths.
+        #
+        lxmin, lxmax, lymin, lymax = bbox.GetEnvelope()
+        pixel = _tile_perimeter_width(coord, projection) / 256.
+        tolerance = simplify * pixel * (lxmax - lxmin) / (xmax - xmin)
     
-    features = []
     mask = None
     
     if spacing is not None:
         buffer = spacing * _tile_perimeter_width(coord, projection) / 256.
 
-    for feature in layer:
+    while True:
+        #
+        # OGR doesn't raise when a connection dies mid-query, it just runs
+        # out of features early; look for an error so an incomplete tile
+        # isn't mistaken for an empty one and cached.
+        #
+        gdal.ErrorReset()
+        feature = layer.GetNextFeature()
+        
+        if feature is None:
+            if gdal.GetLastErrorType() >= gdal.CE_Failure:
+                raise KnownUnknown('Couldn\'t read features: %s' % gdal.GetLastErrorMsg())
+            
+            break
+        
         geometry = feature.geometry().Clone()
         
         if not geometry.Intersect(bbox):
@@ -510,6 +699,15 @@ def _get_features(coord, properties, projection, layer, clipped, projected, spac
         if mask and geometry.Intersect(mask):
             continue
         
+        if simplify and preserve_topology:
+            geometry = geometry.SimplifyPreserveTopology(tolerance)
+        elif simplify:
+            geometry = geometry.Simplify(tolerance)
+        
+        if simplify and (geometry is None or geometry.IsEmpty()):
+            # collapsed to nothing at this zoom
+            continue
+        
         if clipped:
             geometry = geometry.Intersection(bbox)
         
@@ -527,15 +725,45 @@ def _get_features(coord, properties, projection, layer, clipped, projected, spac
         geometry.AssignSpatialReference(layer_sref)
         geometry.TransformTo(output_sref)
 
-        geom = json_loads(geometry.ExportToJson())
         prop = _feature_properties(feature, definition, properties)
+        yield prop, geometry
+
+def _feature_dict(properties, geometry, id_property):
+    """ Return a feature in GeoJSON form, from properties and an OGR geometry.
+    """
+    geom = json_loads(geometry.ExportToJson())
+    geojson_feature = {'type': 'Feature', 'properties': properties, 'geometry': geom}
+    
+    if id_property != None and id_property in properties:
+       geojson_feature['id'] = properties[id_property]
+    
+    return geojson_feature
 
-        geojson_feature = {'type': 'Feature', 'properties': prop, 'geometry': geom}
-        if id_property != None and id_property in prop:
-           geojson_feature['id'] = prop[id_property]
-        features.append(geojson_feature)
+class _Features:
+    """ Features of one tile, read from a provider's datasource each time they're iterated over.
     
-    return features
+        Generates (properties, geometry) pairs from _iter_features(), so
+        responses can be written straight from the OGR cursor without
+        building a list of features first.
+    """
+    def __init__(self, provider, coord):
+        self.provider = provider
+        self.coord = coord
+    
+    def __iter__(self):
+        provider = self.provider
+        driver, parameters, dirpath = provider.driver, provider.parameters, provider.layer.config.dirpath
+        layer, ds = _handles.get(driver, parameters, dirpath)
+        
+        try:
+            for feature in _iter_features(self.coord, provider.properties, provider.layer.projection,
+                                          layer, provider.clipped, provider.projected, provider.spacing,
+                                          provider.simplify, provider.preserve_topology):
+                yield feature
+        except Exception:
+            # the handle may be at fault, so don't use it again.
+            _handles.discard(driver, parameters, dirpath)
+            raise
 
 class Provider:
     """ Vector Provider for OGR datasources.
@@ -543,7 +771,7 @@ class Provider:
         See module documentation for explanation of constructor arguments.
     """
     
-    def __init__(self, layer, driver, parameters, clipped, verbose, projected, spacing, properties, precision, id_property):
+    def __init__(self, layer, driver, parameters, clipped, verbose, projected, spacing, properties, precision, id_property, simplify=None, preserve_topology=False):
         self.layer      = layer
         self.driver     = driver
         self.clipped    = clipped
@@ -554,12 +782,13 @@ class Provider:
         self.properties = properties
         self.precision  = precision
         self.id_property = id_property
+        self.simplify   = simplify
+        self.preserve_topology = preserve_topology
 
     def renderTile(self, width, height, srs, coord):
         """ Render a single tile, return a VectorResponse instance.
         """
-        layer, ds = _open_layer(self.driver, self.parameters, self.layer.config.dirpath)
-        features = _get_features(coord, self.properties, self.layer.projection, layer, self.clipped, self.projected, self.spacing, self.id_property)
+        features = _Features(self, coord)
         response = {'type': 'FeatureCollection', 'features': features}
         
         if self.projected:
@@ -572,7 +801,7 @@ class Provider:
         else:
             response['crs'] = {'srid': 4326, 'wkid': 4326}
 
-        return VectorResponse(response, self.verbose, self.precision)
+        return VectorResponse(response, self.verbose, self.precision, self.id_property)
         
     def getTypeByExtension(self, extension):
         """ Get mime-type and format by file extension.
@@ -0,0 +1,285 @@
+""" Shared queues of seeding work, for seeding a layer from several machines.
+
+A coordinator fills a queue with units of work, each one a list of tiles from
+a single metatile. Workers on any machine lease units from the queue, seed
+their tiles, and acknowledge them along with any tiles that failed. A lease
+that isn't acknowledged in time expires and the unit is leased again, so work
+held by a dead worker is not lost; a unit whose lease has expired too many
+times is marked as failed.
+
+Two queues are included:
+
+  SQLiteQueue
+    Keeps the queue in a SQLite database file, which may be kept on storage
+    shared by all of the machines as long as it supports file locking.
+
+  MemoryQueue
+    Keeps the queue in memory, a stand-in for tests and single-process use.
+
+Other queues can be used in their place by providing the same methods:
+put(), lease(), ack() and stats(). Units are (layer, extension, tiles) tuples,
+where tiles is a list of (offset, count, row, column, zoom) tuples.
+
+Example use, with tilestache-seed.py:
+
+    tilestache-seed.py -c tilestache.cfg -l osm --queue /shared/osm.queue --enqueue 10 11 12
+    tilestache-seed.py -c tilestache.cfg -l osm --queue /shared/osm.queue --workers 4
+    tilestache-seed.py --queue /shared/osm.queue --queue-stats
+"""
+from time import time
+from threading import Lock
+
+try:
+    from json import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from simplejson import dumps as json_dumps, loads as json_loads
+
+try:
+    from sqlite3 import connect as _connect
+except ImportError:
+    # Heroku appears to be missing standard python's
+    # sqlite3 package, so throw an ImportError later
+    def _connect(filename, **kwargs):
+        raise ImportError('No module named sqlite3')
+
+# unit states.
+_pending, _leased, _done, _failed = 0, 1, 2, 3
+
+# seconds of recent work used to measure throughput.
+_window = 600
+
+# most failed tiles to list in stats.
+_max_failures = 100
+
+def _summarize(now, states, finished, first_start, failures):
+    """ Return a stats dictionary from raw queue numbers.
+
+        States is a dictionary of (units, tiles) tuples by state, finished is
+        a list of (finish time, tiles) tuples, and failures is a list of
+        (tile, error) tuples.
+    """
+    units = dict([(state, states.get(state, (0, 0))[0]) for state in range(4)])
+    tiles = dict([(state, states.get(state, (0, 0))[1]) for state in range(4)])
+
+    # tiles per second over the recent window, or since the start if sooner.
+    recent = sum([count for (t, count) in finished if t >= now - _window])
+    elapsed = first_start and min(_window, now - first_start) or 0
+    throughput = elapsed and float(recent) / elapsed or 0.
+
+    remaining = tiles[_pending] + tiles[_leased]
+    eta = throughput and remaining / throughput or None
+
+    return {'units pending': units[_pending], 'units leased': units[_leased],
+            'units done': units[_done], 'units failed': units[_failed],
+            'tiles total': sum(tiles.values()), 'tiles done': tiles[_done],
+            'tiles remaining': remaining, 'tiles per second': throughput,
+            'seconds remaining': eta,
+            'failures': [dict(tile='%d/%d/%d' % (z, x, y), error=error)
+                         for ((y, x, z), error) in failures[:_max_failures]]}
+
+class SQLiteQueue:
+    """ Queue of seeding work in a SQLite database file.
+
+        Constructor arguments:
+        - filename: Database file, created if necessary.
+        - attempts: Number of times a unit may be leased before it's
+          marked as failed, default 3.
+
+        Every method opens its own short-lived connection, so a single
+        instance can be used from many threads and processes.
+    """
+    def __init__(self, filename, attempts=3):
+        self.filename = filename
+        self.attempts = attempts
+
+        db = self._db()
+        db.execute('''CREATE TABLE IF NOT EXISTS units (
+                        id INTEGER PRIMARY KEY, layer TEXT, extension TEXT, tiles TEXT,
+                        size INTEGER, state INTEGER, worker TEXT, attempts INTEGER,
+                        lease_until REAL, started REAL, finished REAL)''')
+        db.execute('CREATE INDEX IF NOT EXISTS units_state ON units (state, layer, id)')
+        db.execute('CREATE TABLE IF NOT EXISTS failures (unit INTEGER, tile TEXT, error TEXT)')
+        db.close()
+
+    def _db(self):
+        """ Return a new connection with explicit transactions.
+        """
+        return _connect(self.filename, timeout=60, isolation_level=None)
+
+    def put(self, units):
+        """ Add units of work from a stream of (layer, extension, tiles) tuples.
+
+            Returns the number of units added.
+        """
+        db = self._db()
+        added = 0
+        batch = []
+
+        def flush():
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('''INSERT INTO units (layer, extension, tiles, size, state, attempts)
+                              VALUES (?, ?, ?, ?, 0, 0)''', batch)
+            db.execute('COMMIT')
+
+        for (layer, extension, tiles) in units:
+            batch.append((layer, extension, json_dumps(tiles), len(tiles)))
+            added += 1
+
+            if len(batch) == 1000:
+                flush()
+                batch = []
+
+        if batch:
+            flush()
+
+        db.close()
+        return added
+
+    def lease(self, worker, layer, seconds=600):
+        """ Lease the next unit of work for a layer.
+
+            Returns (id, extension, tiles) or None if no unit is available.
+            The lease expires after a number of seconds.
+        """
+        now = time()
+        db = self._db()
+
+        try:
+            db.execute('BEGIN IMMEDIATE')
+
+            # units whose leases expired too many times have failed.
+            db.execute('''UPDATE units SET state = 3, finished = ?
+                          WHERE state = 1 AND lease_until < ? AND attempts >= ?''',
+                       (now, now, self.attempts))
+
+            row = db.execute('''SELECT id, extension, tiles FROM units
+                                WHERE layer = ? AND (state = 0 OR (state = 1 AND lease_until < ?))
+                                ORDER BY id LIMIT 1''', (layer, now)).fetchone()
+
+            if row is None:
+                db.execute('COMMIT')
+                return None
+
+            db.execute('''UPDATE units SET state = 1, worker = ?, attempts = attempts + 1,
+                          lease_until = ?, started = COALESCE(started, ?) WHERE id = ?''',
+                       (worker, now + seconds, now, row[0]))
+            db.execute('COMMIT')
+
+        finally:
+            db.close()
+
+        id, extension, tiles = row
+        return id, str(extension), [tuple(tile) for tile in json_loads(tiles)]
+
+    def ack(self, id, failures=[]):
+        """ Acknowledge a finished unit of work.
+
+            Failures is a list of ((row, column, zoom), error) tuples for
+            tiles that could not be seeded.
+        """
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('UPDATE units SET state = 2, finished = ? WHERE id = ?', (time(), id))
+        db.executemany('INSERT INTO failures (unit, tile, error) VALUES (?, ?, ?)',
+                       [(id, json_dumps(tile), error) for (tile, error) in failures])
+        db.execute('COMMIT')
+        db.close()
+
+    def stats(self):
+        """ Return a dictionary of progress, throughput, ETA and failures.
+        """
+        now = time()
+        db = self._db()
+
+        states = dict([(state, (units, tiles)) for (state, units, tiles)
+                       in db.execute('SELECT state, COUNT(*), SUM(size) FROM units GROUP BY state')])
+
+        finished = db.execute('SELECT finished, size FROM units WHERE state = 2 AND finished >= ?',
+                              (now - _window, )).fetchall()
+
+        first_start, = db.execute('SELECT MIN(started) FROM units').fetchone()
+
+        failures = [(tuple(json_loads(tile)), error) for (tile, error)
+                    in db.execute('SELECT tile, error FROM failures LIMIT ?', (_max_failures, ))]
+
+        # whole units that failed when their leases ran out too many times.
+        for (tiles, ) in db.execute('SELECT tiles FROM units WHERE state = 3 LIMIT ?', (_max_failures, )):
+            failures += [(tuple(tile[2:]), 'Lease expired too many times') for tile in json_loads(tiles)]
+
+        db.close()
+
+        return _summarize(now, states, finished, first_start, failures)
+
+class MemoryQueue:
+    """ Queue of seeding work in memory, with the same methods as SQLiteQueue.
+    """
+    def __init__(self, attempts=3):
+        self.attempts = attempts
+        self.units = []
+        self.failures = []
+        self.guard = Lock()
+
+    def put(self, units):
+        """ Add units of work from a stream of (layer, extension, tiles) tuples.
+        """
+        added = 0
+
+        with self.guard:
+            for (layer, extension, tiles) in units:
+                self.units.append(dict(id=len(self.units), layer=layer, extension=extension,
+                                       tiles=list(tiles), state=_pending, attempts=0,
+                                       lease_until=None, started=None, finished=None))
+                added += 1
+
+        return added
+
+    def lease(self, worker, layer, seconds=600):
+        """ Lease the next unit of work for a layer, or return None.
+        """
+        now = time()
+
+        with self.guard:
+            for unit in self.units:
+                expired = unit['state'] == _leased and unit['lease_until'] < now
+
+                if expired and unit['attempts'] >= self.attempts:
+                    unit.update(state=_failed, finished=now)
+
+                elif unit['layer'] == layer and (unit['state'] == _pending or expired):
+                    unit.update(state=_leased, attempts=unit['attempts'] + 1, lease_until=now + seconds)
+                    unit['started'] = unit['started'] or now
+                    return unit['id'], unit['extension'], unit['tiles']
+
+        return None
+
+    def ack(self, id, failures=[]):
+        """ Acknowledge a finished unit of work.
+        """
+        with self.guard:
+            self.units[id].update(state=_done, finished=time())
+            self.failures += failures
+
+    def stats(self):
+        """ Return a dictionary of progress, throughput, ETA and failures.
+        """
+        now = time()
+
+        with self.guard:
+            states = {}
+
+            for unit in self.units:
+                units, tiles = states.get(unit['state'], (0, 0))
+                states[unit['state']] = units + 1, tiles + len(unit['tiles'])
+
+            finished = [(unit['finished'], len(unit['tiles'])) for unit in self.units
+                        if unit['state'] == _done]
+
+            starts = [unit['started'] for unit in self.units if unit['started']]
+
+            failures = self.failures[:]
+
+            for unit in self.units:
+                if unit['state'] == _failed:
+                    failures += [(tuple(tile[2:]), 'Lease expired too many times') for tile in unit['tiles']]
+
+        return _summarize(now, states, finished, starts and min(starts) or None, failures)
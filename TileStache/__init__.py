@@ -59,6 +59,9 @@ def getTile(layer, coord, extension, ignore_cached=False):
     
     mimetype, format = layer.getTypeByExtension(extension)
     cache = layer.config.cache
+    
+    # a layer may have its own lock manager, otherwise the cache does locking.
+    locks = layer.locks or cache
 
     if not ignore_cached:
         # Start by checking for a tile in the cache.
@@ -80,7 +83,7 @@ def getTile(layer, coord, extension, ignore_cached=False):
                 lockCoord = layer.metatile.firstCoord(coord)
                 
                 # We may need to write a new tile, so acquire a lock.
-                cache.lock(layer, lockCoord, format)
+                locks.lock(layer, lockCoord, format)
             
             if not ignore_cached:
                 # There's a chance that some other process has
@@ -120,7 +123,7 @@ def getTile(layer, coord, extension, ignore_cached=False):
         finally:
             if lockCoord:
                 # Always clean up a lock when it's no longer being used.
-                cache.unlock(layer, lockCoord, format)
+                locks.unlock(layer, lockCoord, format)
     
     Core._addRecentTile(layer, coord, format, body)
     logging.info('TileStache.getTile() %s/%d/%d/%d.%s via %s in %.3f', layer.name(), coord.zoom, coord.column, coord.row, extension, tile_from, time() - start_time)
@@ -6,11 +6,26 @@ West Oakland (http://sta.mn/ck) in the "osm" layer, for zoom levels 12-15:
 
     tilestache-clean.py -c ./config.json -l osm -b 37.79 -122.35 37.83 -122.25 -e png 12 13 14 15
 
+Tiles in a bounding box are removed an area at a time: each zoom level is cut
+into strips of columns that are shared among a pool of worker threads, and each
+strip is removed with one call to TileStache.Caches.remove_area(), which uses
+bulk removal for caches that support it.
+
+With a cache that keeps its tiles in generations, a whole layer can be cleaned
+at once by moving it to a new generation, which leaves the old tiles to be
+removed at a slower pace:
+
+    tilestache-clean.py -c ./config.json -l osm --new-generation
+
+In a Multi cache only the Disk and S3 tiers with generations are moved along;
+Memcache tiers keep serving the old tiles until they expire.
+
 See `tilestache-clean.py --help` for more information.
 """
 
-from sys import stderr, path
+from sys import stderr, path, exit
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 
 try:
     from json import dump as json_dump
@@ -26,11 +41,11 @@ parser = OptionParser(usage="""%prog [options] [zoom...]
 Cleans a single layer in your TileStache configuration - no images are returned,
 and TileStache ends up with an empty in selected areas cache. Bounding box is
 given as a pair of lat/lon coordinates, e.g. "37.788 -122.349 37.833 -122.246".
-Output is a list of tile paths as they are created.
+Output is a list of tile paths or areas as they are removed.
 
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(extension='png', padding=0, verbose=True, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(extension='png', padding=0, workers=8, verbose=True, bbox=(37.777, -122.352, 37.839, -122.226))
 
 parser.set_defaults(**defaults)
 
@@ -63,48 +78,61 @@ parser.add_option('-i', '--include-path', dest='include',
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
 
-def generateCoordinates(ul, lr, zooms, padding):
-    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+parser.add_option('--order', dest='order',
+                  help='Order of tiles from --tile-list within each zoom: "row", "zorder" or "hilbert". Curve orders remove nearby tiles together, so cache directories stay warm. Tiles are only reordered if this is given.',
+                  type='choice', choices=('row', 'zorder', 'hilbert'))
+
+parser.add_option('--new-generation', dest='new_generation',
+                  help='Move each layer to a new, empty generation of the cache instead of removing tiles, for caches with generations. Old generations are removed before exiting. Memcache tiers of a Multi cache keep their tiles until they expire. Ignores --bbox, --padding, --tile-list and zoom levels.',
+                  action='store_true')
+
+parser.add_option('--workers', dest='workers',
+                  help='Number of worker threads removing tiles at once. Default value is %s.' % repr(defaults['workers']),
+                  type='int')
+
+# most tiles in a single strip of an area.
+strip_tiles = 4096
+
+def generateAreas(ul, lr, zooms, padding):
+    """ Generate a stream of (offset, count, zoom, left, top, right, bottom) tuples for cleaning.
     
-        Flood-fill coordinates based on two corners, a list of zooms and padding.
+        Each zoom is cut into strips of whole columns based on two corners and
+        padding; left and top are included in a strip, right and bottom are not.
+        Offset is the number of tiles up to the end of the strip.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
+    areas = []
     
     for zoom in zooms:
         ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
         lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
         
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
-        
-        count += int(rows * cols)
-
-    # now generate the actual coordinates.
-    # offset starts at zero
+        areas.append((zoom, int(ul_.column), int(ul_.row), int(lr_.column) + 1, int(lr_.row) + 1))
+    
+    count = sum([(right - left) * (bottom - top) for (zoom, left, top, right, bottom) in areas])
     offset = 0
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-
-        for row in range(int(ul_.row), int(lr_.row + 1)):
-            for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield (offset, count, coord)
-                
-                offset += 1
+    for (zoom, left, top, right, bottom) in areas:
+        width = max(1, strip_tiles / (bottom - top))
+        
+        for column in range(left, right, width):
+            stop = min(right, column + width)
+            offset += (stop - column) * (bottom - top)
+            
+            yield (offset, count, zoom, column, top, stop, bottom)
 
-def listCoordinates(filename):
+def listCoordinates(filename, order=None):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
-        Read coordinates from a file with one Z/X/Y coordinate per line.
+        Read coordinates from a file with one Z/X/Y coordinate per line,
+        sorted by zoom and then by the given order from Curves, if any.
     """
     coords = (line.strip().split('/') for line in open(filename, 'r'))
     coords = (map(int, (row, column, zoom)) for (zoom, column, row) in coords)
     coords = [Coordinate(*args) for args in coords]
     
+    if order:
+        coords.sort(key=lambda coord: (coord.zoom, Curves.index(coord.column, coord.row, coord.zoom, order)))
+    
     count = len(coords)
     
     for (offset, coord) in enumerate(coords):
@@ -119,7 +147,8 @@ if __name__ == '__main__':
 
     from TileStache import parseConfigfile, getTile
     from TileStache.Core import KnownUnknown
-    from TileStache.Caches import Disk, Multi
+    from TileStache.Caches import Disk, Multi, remove_area
+    from TileStache import Curves, Generations
     
     from ModestMaps.Core import Coordinate
     from ModestMaps.Geo import Location
@@ -164,46 +193,73 @@ if __name__ == '__main__':
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
 
+        if options.workers < 1:
+            raise KnownUnknown('At least one worker is needed.')
+
         padding = options.padding
         tile_list = options.tile_list
 
     except KnownUnknown, e:
         parser.error(str(e))
 
+    if options.new_generation:
+        if not hasattr(config.cache, 'bump_generation'):
+            parser.error('The cache in %s has no generations.' % options.config)
+        
+        for layer in layers:
+            try:
+                number = config.cache.bump_generation(layer)
+            except KnownUnknown, e:
+                parser.error(str(e))
+            
+            if options.verbose:
+                print >> stderr, '%s moved to generation %s' % (layer.name(), number)
+        
+        if options.verbose:
+            print >> stderr, 'Removing old generations...'
+        
+        Generations.wait()
+        exit(0)
+
+    pool = ThreadPool(options.workers)
+
     for layer in layers:
 
+        try:
+            mimetype, format = layer.getTypeByExtension(extension)
+        except:
+            #
+            # It's not uncommon for layers to lack support for certain
+            # extensions, so just don't attempt to remove cached tiles
+            # for an unsupported format.
+            #
+            continue
+
         if tile_list:
-            coordinates = listCoordinates(tile_list)
+            def clean((offset, count, coord)):
+                config.cache.remove(layer, coord, format)
+                
+                path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+                return {"tile": path, "offset": offset + 1, "total": count}
+            
+            tasks = listCoordinates(tile_list, options.order)
+
         else:
+            def clean((offset, count, zoom, left, top, right, bottom)):
+                bbox = Coordinate(top, left, zoom), Coordinate(bottom - 1, right - 1, zoom)
+                remove_area(config.cache, layer, [zoom], bbox, [format], workers=1)
+                
+                path = '%s/%d/%d-%d/%d-%d.%s' % (layer.name(), zoom, left, right - 1, top, bottom - 1, extension)
+                return {"tile": path, "offset": offset, "total": count}
+            
             ul = layer.projection.locationCoordinate(northwest)
             lr = layer.projection.locationCoordinate(southeast)
     
-            coordinates = generateCoordinates(ul, lr, zooms, padding)
+            tasks = generateAreas(ul, lr, zooms, padding)
         
-        for (offset, count, coord) in coordinates:
-            path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
-    
-            progress = {"tile": path,
-                        "offset": offset + 1,
-                        "total": count}
-    
-            if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
-    
-            try:
-                mimetype, format = layer.getTypeByExtension(extension)
-            except:
-                #
-                # It's not uncommon for layers to lack support for certain
-                # extensions, so just don't attempt to remove a cached tile
-                # for an unsupported format.
-                #
-                pass
-            else:
-                config.cache.remove(layer, coord, format)
-    
+        for progress in pool.imap(clean, tasks):
             if options.verbose:
-                print >> stderr, '%(tile)s' % progress
+                print >> stderr, '%(offset)d of %(total)d... %(tile)s' % progress
                     
             if progressfile:
                 fp = open(progressfile, 'w')
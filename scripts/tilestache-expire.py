@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""tilestache-expire.py will expire tiles touched by a data update.
+
+This script is intended to be run directly. This example removes every tile of
+the "osm" layer at zoom levels 10-18 that shows a place in osm2pgsql's list of
+dirty tiles, from the dirty tiles themselves up to zoom 10 and down to zoom 18:
+
+    tilestache-expire.py -c ./config.json -l osm -e png 10 11 12 13 14 15 16 17 18 < expire.list
+
+Removed tiles can also be added to a work queue to be rendered again by
+tilestache-seed.py workers sharing the same queue:
+
+    tilestache-expire.py -c ./config.json -l osm --queue /shared/osm.queue 10 11 12 13 14 15 16 17 18 < expire.list
+
+Dirty lists have one entry per line: a tile as "zoom/column/row", or a bounding
+box as "south west north east" in degrees. See TileStache.Expire for details.
+
+See `tilestache-expire.py --help` for more information.
+"""
+
+from sys import stderr, stdin, path
+from optparse import OptionParser
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] zoom...
+
+Expires tiles of one or more layers in your TileStache configuration that show
+dirty places from a data update. Dirty tiles and bounding boxes are read from
+files given with --dirty, or from standard input. Every tile at the given zoom
+levels that shows a dirty place is removed from the cache, and added to a work
+queue with --queue.
+
+Configuration and layer options are required; see `%prog --help` for info.""")
+
+defaults = dict(extension='png', workers=8, verbose=True)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name from configuration. "ALL" is a special value that will expire all layers in turn. If you have an actual layer named "ALL", use "ALL LAYERS" instead.')
+
+parser.add_option('-d', '--dirty', dest='dirty',
+                  help='File with a list of dirty tiles and bounding boxes, may be given more than once. Default is to read standard input.',
+                  action='append')
+
+parser.add_option('-e', '--extension', dest='extension',
+                  help='Optional file type for rendered tiles. Default value is %s.' % repr(defaults['extension']))
+
+parser.add_option('--queue', dest='queue',
+                  help='Optional SQLite work queue file to add dirty tiles to for rendering by tilestache-seed.py --queue, after removing them from the cache.')
+
+parser.add_option('--workers', dest='workers',
+                  help='Number of worker threads removing tiles at once. Default value is %s.' % repr(defaults['workers']),
+                  type='int')
+
+parser.add_option('-q', action='store_false', dest='verbose',
+                  help='Suppress chatty output.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+if __name__ == '__main__':
+    options, zooms = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from TileStache import parseConfigfile
+    from TileStache.Core import KnownUnknown
+    from TileStache.Expire import DirtyTiles, load_dirty, expire_tiles, enqueue_tiles
+    from TileStache.WorkQueue import SQLiteQueue
+
+    try:
+        if options.config is None:
+            raise KnownUnknown('Missing required configuration (--config) parameter.')
+
+        if options.layer is None:
+            raise KnownUnknown('Missing required layer (--layer) parameter.')
+
+        config = parseConfigfile(options.config)
+
+        if options.layer in ('ALL', 'ALL LAYERS') and options.layer not in config.layers:
+            # expire every layer in the config
+            layers = config.layers.values()
+
+        elif options.layer not in config.layers:
+            raise KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (options.layer, ', '.join(sorted(config.layers.keys()))))
+
+        else:
+            # expire just one layer in the config
+            layers = [config.layers[options.layer]]
+
+        if not zooms:
+            raise KnownUnknown('At least one zoom level is needed.')
+
+        for (i, zoom) in enumerate(zooms):
+            if not zoom.isdigit():
+                raise KnownUnknown('"%s" is not a valid numeric zoom level.' % zoom)
+
+            zooms[i] = int(zoom)
+
+        if options.workers < 1:
+            raise KnownUnknown('At least one worker is needed.')
+
+        if options.dirty:
+            lines = [line for filename in options.dirty for line in open(filename, 'r')]
+        else:
+            lines = stdin.readlines()
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    extension = options.extension
+    queue = options.queue and SQLiteQueue(options.queue)
+
+    for layer in layers:
+
+        try:
+            mimetype, format = layer.getTypeByExtension(extension)
+        except:
+            #
+            # It's not uncommon for layers to lack support for certain
+            # extensions, so just don't attempt to expire tiles
+            # for an unsupported format.
+            #
+            continue
+
+        dirty = DirtyTiles(max(zooms))
+
+        try:
+            load_dirty(lines, layer.projection, dirty)
+        except ValueError, e:
+            parser.error(str(e))
+
+        count = dirty.count(zooms)
+
+        if queue:
+            units = enqueue_tiles(queue, config.cache, layer, extension, dirty, zooms, options.workers)
+
+            if options.verbose:
+                print >> stderr, '%s: expired and queued %d tiles in %d units' % (layer.name(), count, units)
+
+        else:
+            expire_tiles(config.cache, layer, dirty, zooms, [format], options.workers)
+
+            if options.verbose:
+                print >> stderr, '%s: expired %d tiles' % (layer.name(), count)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""tilestache-order-benchmark.py compares tile orders for seeding a layer.
+
+This script is intended to be run directly. It renders every metatile of an
+area once in each order, without writing to the cache, and reports the render
+time along with measures of locality for each order. This example compares
+orders for the area around West Oakland (http://sta.mn/ck) at zoom levels 14-15:
+
+    tilestache-order-benchmark.py -c ./config.json -l roads -b 37.79 -122.35 37.83 -122.25 14 15
+
+The difference between orders shows up best with a layer that reads from a
+database bigger than its memory, such as this PostGIS layer:
+
+    {
+      "cache": {"name": "Test"},
+      "layers":
+      {
+        "roads":
+        {
+          "provider":
+          {
+            "name": "vector", "driver": "PostgreSQL",
+            "parameters": {"dbname": "planet", "user": "osm",
+                           "table": "planet_osm_line"}
+          },
+          "metatile": {"rows": 4, "columns": 4}
+        }
+      }
+    }
+
+See `tilestache-order-benchmark.py --help` for more information.
+"""
+
+from sys import stderr, stdout, path
+from time import time
+from optparse import OptionParser
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] [zoom...]
+
+Renders a single layer in your TileStache configuration once for each tile
+order, and prints render time and locality for each. Nothing is written to
+the cache. Bounding box is given as a pair of lat/lon coordinates, e.g.
+"37.788 -122.349 37.833 -122.246".
+
+Orders are rendered one after the other, so a database or file system warmed
+up by one order helps the next; use --repeat to render them several times
+in rotation, and compare the later rounds.
+
+Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
+
+defaults = dict(extension='png', orders='row,zorder,hilbert', repeat=1, verbose=True, bbox=(37.777, -122.352, 37.839, -122.226))
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name from configuration.')
+
+parser.add_option('-b', '--bbox', dest='bbox',
+                  help='Bounding box in floating point geographic coordinates: south west north east. Default value is %.3f, %.3f, %.3f, %.3f.' % defaults['bbox'],
+                  type='float', nargs=4)
+
+parser.add_option('-e', '--extension', dest='extension',
+                  help='Optional file type for rendered tiles. Default value is %s.' % repr(defaults['extension']))
+
+parser.add_option('-o', '--orders', dest='orders',
+                  help='Comma-separated list of orders to compare. Default value is %s.' % repr(defaults['orders']))
+
+parser.add_option('-r', '--repeat', dest='repeat',
+                  help='Number of rounds to render every order, rotating which order goes first. Default value is %s.' % repr(defaults['repeat']),
+                  type='int')
+
+parser.add_option('-q', action='store_false', dest='verbose',
+                  help='Suppress chatty output.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+def metatileCoordinates(ul, lr, zooms, metatile, order):
+    """ Return a list of Coordinates for the first tile of each metatile in an area.
+    """
+    rows, columns = metatile.rows, metatile.columns
+    coords = []
+
+    for zoom in zooms:
+        ul_ = ul.zoomTo(zoom).container()
+        lr_ = lr.zoomTo(zoom).container()
+
+        top, left = int(ul_.row), int(ul_.column)
+        bottom, right = int(lr_.row + 1), int(lr_.column + 1)
+
+        for (meta_column, meta_row) in Curves.walk(left / columns, top / rows, (right - 1) / columns + 1, (bottom - 1) / rows + 1, order):
+            coords.append(Coordinate(max(top, meta_row * rows), max(left, meta_column * columns), zoom))
+
+    return coords
+
+def locality(coords):
+    """ Return mean distance in tiles between consecutive coordinates, and number of directory changes.
+
+        Directories are counted as in the "portable" layout of the Disk
+        cache, one per zoom and column.
+    """
+    distance, changes = 0., 0
+
+    for (one, two) in zip(coords, coords[1:]):
+        if one.zoom == two.zoom:
+            distance += ((one.row - two.row) ** 2 + (one.column - two.column) ** 2) ** .5
+
+        if (one.zoom, one.column) != (two.zoom, two.column):
+            changes += 1
+
+    return distance / max(1, len(coords) - 1), changes
+
+def renderAll(layer, coords, format, verbose):
+    """ Render a list of coordinates without writing to the cache, and return the seconds it took.
+    """
+    start = time()
+
+    for coord in coords:
+        try:
+            layer.render(coord, format)
+        except TileStache.Core.NoTileLeftBehind:
+            pass
+
+        if verbose:
+            print >> stderr, '.',
+
+    if verbose:
+        print >> stderr, ''
+
+    return time() - start
+
+if __name__ == '__main__':
+    options, zooms = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from TileStache import parseConfigfile, Curves
+    from TileStache.Core import KnownUnknown
+    import TileStache
+
+    from ModestMaps.Core import Coordinate
+    from ModestMaps.Geo import Location
+
+    try:
+        if options.config is None:
+            raise KnownUnknown('Missing required configuration (--config) parameter.')
+
+        if options.layer is None:
+            raise KnownUnknown('Missing required layer (--layer) parameter.')
+
+        config = parseConfigfile(options.config)
+
+        if options.layer not in config.layers:
+            raise KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (options.layer, ', '.join(sorted(config.layers.keys()))))
+
+        layer = config.layers[options.layer]
+        layer.write_cache = False
+
+        mimetype, format = layer.getTypeByExtension(options.extension)
+
+        orders = options.orders.split(',')
+
+        for order in orders:
+            if order not in Curves.orders:
+                raise KnownUnknown('"%s" is not an order I know about. Here are some that I do know about: %s.' % (order, ', '.join(Curves.orders)))
+
+        lat1, lon1, lat2, lon2 = options.bbox
+        south, west = min(lat1, lat2), min(lon1, lon2)
+        north, east = max(lat1, lat2), max(lon1, lon2)
+
+        ul = layer.projection.locationCoordinate(Location(north, west))
+        lr = layer.projection.locationCoordinate(Location(south, east))
+
+        for (i, zoom) in enumerate(zooms):
+            if not zoom.isdigit():
+                raise KnownUnknown('"%s" is not a valid numeric zoom level.' % zoom)
+
+            zooms[i] = int(zoom)
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    coords = dict([(order, metatileCoordinates(ul, lr, zooms, layer.metatile, order)) for order in orders])
+    seconds = dict([(order, []) for order in orders])
+
+    for round in range(options.repeat):
+        for order in orders[round % len(orders):] + orders[:round % len(orders)]:
+            if options.verbose:
+                print >> stderr, 'Round %d, %s order, %d metatiles' % (round + 1, order, len(coords[order]))
+
+            seconds[order].append(renderAll(layer, coords[order], format, options.verbose))
+
+    print >> stdout, '%-8s %10s %14s %12s  %s' % ('order', 'metatiles', 'mean distance', 'directories', 'seconds in each round')
+
+    for order in orders:
+        distance, changes = locality(coords[order])
+        rounds = ' '.join(['%.2f' % s for s in seconds[order]])
+
+        print >> stdout, '%-8s %10d %14.2f %12d  %s' % (order, len(coords[order]), distance, changes, rounds)
@@ -9,18 +9,34 @@ West Oakland (http://sta.mn/ck) in the "osm" layer, for zoom levels 12-15:
 See `tilestache-seed.py --help` for more information.
 """
 
-from sys import stderr, path
-from os.path import realpath, dirname
+from sys import stderr, stdout, path, exit
+from os import rename, getpid
+from socket import gethostname
+from os.path import realpath, dirname, exists
+from time import time, sleep
+from bisect import bisect_right
+from random import random, randint
+from math import sqrt
+from StringIO import StringIO
 from optparse import OptionParser
 from urlparse import urlparse
 from urllib import urlopen
+from traceback import format_exc
+from multiprocessing import Process, Queue
+from threading import Thread
+from itertools import groupby
+from Queue import Empty
 
 try:
     from json import dump as json_dump
     from json import load as json_load
+    from json import dumps as json_dumps
+    from json import loads as json_loads
 except ImportError:
     from simplejson import dump as json_dump
     from simplejson import load as json_load
+    from simplejson import dumps as json_dumps
+    from simplejson import loads as json_loads
 
 #
 # Most imports can be found below, after the --include-path option is known.
@@ -43,7 +59,7 @@ Protip: extract tiles from an MBTiles tileset to a directory like this:
 
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(extension='png', padding=0, verbose=True, enable_retries=False, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(extension='png', padding=0, verbose=True, enable_retries=False, workers=1, samples=30, bbox=(37.777, -122.352, 37.839, -122.226))
 
 parser.set_defaults(**defaults)
 
@@ -65,7 +81,29 @@ parser.add_option('-e', '--extension', dest='extension',
                   help='Optional file type for rendered tiles. Default value is %s.' % repr(defaults['extension']))
 
 parser.add_option('-f', '--progress-file', dest='progressfile',
-                  help="Optional JSON progress file that gets written on each iteration, so you don't have to pay close attention.")
+                  help="Optional JSON progress file that gets written about once a second, so you don't have to pay close attention.")
+
+parser.add_option('--queue', dest='queue',
+                  help='Optional SQLite work queue file shared by several machines. With --enqueue, this run\'s metatiles are added to the queue; otherwise tiles are taken from the queue and seeded until it\'s empty.')
+
+parser.add_option('--enqueue', dest='enqueue',
+                  help='Add metatiles to the --queue file instead of seeding them.',
+                  action='store_true')
+
+parser.add_option('--queue-stats', dest='queue_stats',
+                  help='Print a JSON summary of the --queue file with progress, throughput, time remaining and failed tiles, and exit.',
+                  action='store_true')
+
+parser.add_option('--order', dest='order',
+                  help='Order of tiles within each zoom: "row", "zorder" or "hilbert". Curve orders keep consecutive metatiles close together, so they share warm database pages and cache directories. Default value is "row" for a bounding box and "zorder" for --polygon; tiles from --tile-list or --from-mbtiles are only reordered if this is given, by sorting them in memory a zoom at a time.',
+                  type='choice', choices=('row', 'zorder', 'hilbert'))
+
+parser.add_option('--checkpoint', dest='checkpoint',
+                  help='Optional JSON checkpoint file that records finished metatiles every few seconds, for use with --resume.')
+
+parser.add_option('--resume', dest='resume',
+                  help='Skip metatiles recorded as finished in the --checkpoint file by an earlier run with the same options, without checking the cache.',
+                  action='store_true')
 
 parser.add_option('-q', action='store_false', dest='verbose',
                   help='Suppress chatty output, --progress-file works well with this.')
@@ -79,8 +117,15 @@ parser.add_option('-d', '--output-directory', dest='outputdirectory',
 parser.add_option('--to-mbtiles', dest='mbtiles_output',
                   help='Optional output file for tiles, will be created as an MBTiles 1.1 tileset. See http://mbtiles.org for more information.')
 
+parser.add_option('--dedupe-mbtiles', dest='mbtiles_dedupe',
+                  help='With --to-mbtiles, store identical tiles just once in a new tileset, using separate map and images tables.',
+                  action='store_true')
+
 parser.add_option('--from-mbtiles', dest='mbtiles_input',
-                  help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --extension, --bbox and --padding (this may change).')
+                  help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --extension, --bbox and --padding (this may change). If zoom levels are given, only tiles at those zooms are read.')
+
+parser.add_option('--polygon', dest='polygon',
+                  help='Optional GeoJSON file of polygons or multipolygons. Only tiles that cover the polygons are seeded. Overrides --bbox and --padding.')
 
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
@@ -95,10 +140,24 @@ parser.add_option('--enable-retries', dest='enable_retries',
 parser.add_option('-x', '--ignore-cached', action='store_true', dest='ignore_cached',
                   help='Re-render every tile, whether it is in the cache already or not.')
 
-def generateCoordinates(ul, lr, zooms, padding):
+parser.add_option('--estimate', dest='estimate',
+                  help='Print an estimate of render time, encoded bytes and file count for each zoom instead of seeding. A sample of tiles from each zoom is rendered and encoded with the real layer, but nothing is written to the cache.',
+                  action='store_true')
+
+parser.add_option('--samples', dest='samples',
+                  help='Number of tiles to render at each zoom with --estimate. Default value is %s.' % repr(defaults['samples']),
+                  type='int')
+
+parser.add_option('--workers', dest='workers',
+                  help='Number of worker processes to render tiles at once, each with its own copy of the configuration. Tiles are divided among workers by metatile. Default value is %s.' % repr(defaults['workers']),
+                  type='int')
+
+def generateCoordinates(ul, lr, zooms, padding, metatile=None, order='row'):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Flood-fill coordinates based on two corners, a list of zooms and padding.
+        If a metatile is given, all the tiles of each metatile come together.
+        Metatiles within each zoom are visited in the given order from Curves.
     """
     # start with a simple total of all the coordinates we will need.
     count = 0
@@ -116,43 +175,212 @@ def generateCoordinates(ul, lr, zooms, padding):
     # offset starts at zero
     offset = 0
     
+    rows, columns = metatile and (metatile.rows, metatile.columns) or (1, 1)
+    
     for zoom in zooms:
         ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
         lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+        
+        top, left = int(ul_.row), int(ul_.column)
+        bottom, right = int(lr_.row + 1), int(lr_.column + 1)
+        
+        metatiles = Curves.walk(left / columns, top / rows, (right - 1) / columns + 1, (bottom - 1) / rows + 1, order)
+        
+        for (meta_column, meta_row) in metatiles:
+            for row in range(max(top, meta_row * rows), min(bottom, meta_row * rows + rows)):
+                for column in range(max(left, meta_column * columns), min(right, meta_column * columns + columns)):
+                    coord = Coordinate(row, column, zoom)
+                    
+                    yield (offset, count, coord)
+                    
+                    offset += 1
 
-        for row in range(int(ul_.row), int(lr_.row + 1)):
-            for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield (offset, count, coord)
-                
-                offset += 1
+def sortCoordinates(coords, order, metatile):
+    """ Generate a stream of Coordinates sorted by zoom, and by metatile along a curve within each zoom.
+    
+        Each tile is kept in memory as a single integer key until the stream
+        is finished. Tiles of one metatile come out together, in row order.
+    """
+    rows, columns = metatile.rows, metatile.columns
+    keys = {}
+    
+    for coord in coords:
+        row, column, zoom = int(coord.row), int(coord.column), int(coord.zoom)
+        position = Curves.index(column / columns, row / rows, zoom, order)
+        keys.setdefault(zoom, []).append((position * rows + row % rows) * columns + column % columns)
+    
+    for zoom in sorted(keys):
+        zoom_keys = keys.pop(zoom)
+        zoom_keys.sort()
+        
+        for key in zoom_keys:
+            position, within = divmod(key, rows * columns)
+            meta_column, meta_row = Curves.coordinate(position, zoom, order)
+            
+            yield Coordinate(meta_row * rows + within / columns, meta_column * columns + within % columns, zoom)
 
-def listCoordinates(filename):
+def listCoordinates(filename, order=None, metatile=None):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
-        Read coordinates from a file with one Z/X/Y coordinate per line.
+        Read coordinates from a file with one Z/X/Y coordinate per line,
+        in the order of the file unless an order and metatile are given.
     """
-    coords = (line.strip().split('/') for line in open(filename, 'r'))
+    count = sum(1 for line in open(filename, 'r') if line.strip())
+    
+    coords = (line.strip().split('/') for line in open(filename, 'r') if line.strip())
     coords = (map(int, (row, column, zoom)) for (zoom, column, row) in coords)
-    coords = [Coordinate(*args) for args in coords]
+    coords = (Coordinate(*args) for args in coords)
     
-    count = len(coords)
+    if order:
+        coords = sortCoordinates(coords, order, metatile)
     
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
 
-def tilesetCoordinates(filename):
+def tilesetCoordinates(filename, zooms=None, order=None, metatile=None):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
-        Read coordinates from an MBTiles tileset filename.
+        Read coordinates from an MBTiles tileset filename, optionally
+        limited to a list of zooms, in the order of the tileset's index
+        unless an order and metatile are given.
     """
-    coords = MBTiles.list_tiles(filename)
-    count = len(coords)
+    count = MBTiles.count_tiles(filename, zooms)
+    coords = MBTiles.list_tiles(filename, zooms)
+    
+    if order:
+        coords = sortCoordinates(coords, order, metatile)
     
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
 
+def polygonCoordinates(filename, projection, zooms, order='zorder'):
+    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+    
+        Read polygons from a GeoJSON file, and find the tiles that cover
+        them with a quadtree. The count is exact, and is worked out first.
+    """
+    polygons = Coverage.load_polygons(open(filename, 'r'), projection)
+    count = Coverage.count_tiles(polygons, zooms)
+    
+    for (offset, coord) in enumerate(Coverage.list_tiles(polygons, zooms, order)):
+        yield (offset, count, coord)
+
+def stratifiedPositions(count, samples):
+    """ Return a list of up to a number of positions in range(count).
+    
+        One position is chosen at random from each of equal parts of the
+        range, so samples are spread out in the order of the range.
+    """
+    if count <= samples:
+        return range(count)
+    
+    return [int((index + random()) * count / samples) for index in range(samples)]
+
+def bboxSample(ul, lr, zoom, padding, samples):
+    """ Return a count of tiles at a zoom and a list of Coordinates sampled from them.
+    
+        Tiles are sampled in row order, so that each stratum is a band
+        across the area and the sample reaches from top to bottom.
+    """
+    ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
+    lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+    
+    top, left = int(ul_.row), int(ul_.column)
+    columns = int(lr_.column + 1) - left
+    count = (int(lr_.row + 1) - top) * columns
+    
+    coords = [Coordinate(top + position / columns, left + position % columns, zoom)
+              for position in stratifiedPositions(count, samples)]
+    
+    return count, coords
+
+def streamSample(coordinates, samples):
+    """ Return a dictionary of (count, coordinates) tuples by zoom.
+    
+        Coordinates are sampled from a stream of (offset, count, coordinate)
+        tuples in one pass, keeping a random reservoir for each zoom.
+    """
+    zooms = {}
+    
+    for (offset, total, coord) in coordinates:
+        count, coords = zooms.get(coord.zoom, (0, []))
+        count += 1
+        
+        if len(coords) < samples:
+            coords.append(coord)
+        else:
+            index = randint(0, count - 1)
+            
+            if index < samples:
+                coords[index] = coord
+        
+        zooms[coord.zoom] = count, coords
+    
+    return zooms
+
+def estimateTile(layer, coord, format):
+    """ Render and encode a tile without writing to the cache.
+    
+        Returns render time in seconds, encoded size in bytes, and whether
+        the tile would be saved. For a metatile layer, render() has already
+        encoded every tile of the metatile, so time and size are averaged
+        over those bodies instead of encoding the tile again.
+    """
+    if format.lower() == 'jpeg':
+        save_kwargs = layer.jpeg_options
+    elif format.lower() == 'png':
+        save_kwargs = layer.png_options
+    else:
+        save_kwargs = {}
+    
+    start = time()
+    
+    try:
+        tile, saved = layer.render(coord, format), True
+    except TileStache.Core.NoTileLeftBehind, e:
+        tile, saved = e.tile, False
+    
+    if saved and layer.doMetatile():
+        seconds = time() - start
+        bodies = [TileStache.Core._getRecentTile(layer, other, format) for (other, x, y) in layer.metaSubtiles(coord)]
+        sizes = [len(body) for body in bodies if body is not None]
+        
+        if sizes:
+            return seconds / len(sizes), float(sum(sizes)) / len(sizes), saved
+    
+    buff = StringIO()
+    tile.save(buff, format, **save_kwargs)
+    seconds = time() - start
+    
+    return seconds, saved and len(buff.getvalue()) or 0, saved
+
+def extrapolate(values, count):
+    """ Return an estimated total over a number of tiles, and the margin of a 95% confidence interval.
+    
+        Values are measured from a simple random sample of the tiles;
+        the margin includes the finite population correction, so it
+        shrinks to nothing when every tile was sampled.
+    """
+    n = len(values)
+    
+    if n == 0:
+        return 0., 0.
+    
+    mean = sum(values) / float(n)
+    variance = n > 1 and sum([(value - mean) ** 2 for value in values]) / (n - 1) or 0.
+    correction = count > 1 and float(count - n) / (count - 1) or 0.
+    
+    return count * mean, 1.96 * count * sqrt(variance / n * correction)
+
+def formatEstimate(value, margin, units):
+    """ Return a readable estimate and margin, e.g. "1.2 +/- 0.1 GB".
+    """
+    for (unit, size) in units:
+        if value >= size:
+            break
+    
+    return '%.1f +/- %.1f %s' % (value / size, margin / size, unit)
+
 def parseConfigfile(configpath):
     """ Parse a configuration file and return a raw dictionary and dirpath.
     
@@ -170,6 +398,377 @@ def parseConfigfile(configpath):
     
     return config_dict, dirpath
 
+def seedTile(layer, coord, extension, ignore_cached, attempts, verbose):
+    """ Render a single tile, trying a number of times, and return its size.
+    
+        The last error is raised if every attempt fails.
+    """
+    tile = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+    
+    while True:
+        try:
+            mimetype, content = getTile(layer, coord, extension, ignore_cached)
+        
+        except:
+            #
+            # Something went wrong: try again?
+            #
+            attempts -= 1
+            
+            if verbose:
+                print >> stderr, 'Failed %s, will try %s more.' % (tile, ['no', 'once', 'twice'][attempts])
+            
+            if attempts == 0:
+                raise
+        
+        else:
+            return len(content)
+
+def metatileKey(layer, coord):
+    """ Return a key for the metatile of a coordinate, a TileIDs integer if it's on the map.
+    """
+    column = int(coord.column) / layer.metatile.columns
+    row = int(coord.row) / layer.metatile.rows
+    
+    try:
+        return TileIDs.encode(column, row, coord.zoom)
+    except ValueError:
+        return int(coord.zoom), column, row
+
+def metatileGroups(layer, coordinates):
+    """ Generate a stream of lists of (offset, count, coordinate) tuples.
+    
+        Each list holds consecutive coordinates from a single metatile.
+    """
+    for (key, group) in groupby(coordinates, lambda item: metatileKey(layer, item[2])):
+        yield list(group)
+
+def seedMetatile(layer, group, extension, ignore_cached, attempts, verbose, catch):
+    """ Render a list of (offset, count, coordinate) tuples from one metatile.
+    
+        Returns a list of (offset, count, coordinate, size, error) tuples.
+        
+        The metatile is rendered just once for its first tile, and tiles
+        that came out of that render are counted as done without another
+        trip to the cache. Errors are returned as formatted tracebacks
+        if catch is true, otherwise they are raised.
+    """
+    mimetype, format = layer.getTypeByExtension(extension)
+    results = []
+    
+    for (offset, count, coord) in group:
+        body = None
+        
+        if results:
+            body = TileStache.Core._getRecentTile(layer, coord, format)
+        
+        if body is not None:
+            # produced by the metatile render for an earlier tile.
+            results.append((offset, count, coord, len(body), None))
+            continue
+        
+        try:
+            size = seedTile(layer, coord, extension, ignore_cached, attempts, verbose)
+        
+        except:
+            if not catch:
+                raise
+            
+            results.append((offset, count, coord, None, format_exc()))
+        
+        else:
+            results.append((offset, count, coord, size, None))
+    
+    return results
+
+def seedSerial(layer, groups, extension, ignore_cached, attempts, verbose, error_list):
+    """ Generate a stream of lists of (offset, count, coordinate, size, error) tuples.
+    
+        Each list is the outcome of one group of tiles from metatileGroups(),
+        rendered one at a time in this process. Errors are returned as
+        formatted tracebacks if there's an error list, otherwise they are raised.
+    """
+    outcomes = (seedMetatile(layer, group, extension, ignore_cached, attempts, verbose, bool(error_list))
+                for group in groups)
+    
+    for outcome in committedResults(layer.config.cache, outcomes):
+        yield outcome
+
+def flushCache(cache):
+    """ Commit writes that a cache holds back in batches, e.g. MBTiles with --to-mbtiles.
+    
+        Batches are otherwise committed by exit handlers, which don't run
+        when a worker process finishes.
+    """
+    if hasattr(cache, 'flush'):
+        cache.flush()
+
+def committedResults(cache, results, interval=5):
+    """ Generate a stream of results, each one held back until its tiles are committed.
+    
+        A cache that writes in batches is flushed every few seconds and at the
+        end, and results are passed on after the flush, so checkpoints and work
+        queues never record tiles that aren't saved yet. Results pass through
+        at once for any other cache. A None in the stream stands for a pause,
+        e.g. a worker waiting on others, and flushes right away.
+    """
+    if not hasattr(cache, 'flush'):
+        for result in results:
+            if result is not None:
+                yield result
+        
+        return
+    
+    pending, flushed = [], time()
+    
+    for result in results:
+        if result is not None:
+            pending.append(result)
+        
+        if result is None or time() - flushed >= interval:
+            flushCache(cache)
+            flushed = time()
+            
+            for result in pending:
+                yield result
+            
+            pending = []
+    
+    flushCache(cache)
+    
+    for result in pending:
+        yield result
+
+def seedWorker(config_dict, config_dirpath, layername, extension, ignore_cached, attempts, verbose, tasks, results):
+    """ Render metatiles from a queue of tasks and put the outcomes on a queue of results.
+    
+        Runs in its own process with its own configuration,
+        so nothing is shared with other workers.
+    """
+    config = buildConfiguration(config_dict, config_dirpath)
+    layer = config.layers[layername]
+    
+    def outcomes():
+        for tiles in iter(tasks.get, None):
+            group = [(offset, count, TileIDs.from_key(key)) for (offset, count, key) in tiles]
+            yield seedMetatile(layer, group, extension, ignore_cached, attempts, verbose, True)
+    
+    for outcome in committedResults(config.cache, outcomes()):
+        results.put([(offset, count, TileIDs.key(coord), size, error)
+                     for (offset, count, coord, size, error) in outcome])
+    
+    results.put(None)
+
+def seedParallel(config_dict, config_dirpath, layer, groups, extension, ignore_cached, attempts, verbose, error_list, workers):
+    """ Generate a stream of lists of (offset, count, coordinate, size, error) tuples.
+    
+        Each list is the outcome of one group of tiles from metatileGroups().
+        Metatiles are rendered by a number of worker processes taking turns at
+        a single queue of tasks, so a slow metatile never holds up idle workers.
+        Each metatile is taken by just one worker, so workers never wait on
+        each other's locks. Results arrive in the order that metatiles are finished.
+    """
+    tasks = Queue(256)
+    results = Queue()
+    
+    args = config_dict, config_dirpath, layer.name(), extension, ignore_cached, attempts, verbose, tasks, results
+    processes = [Process(target=seedWorker, args=args) for index in range(workers)]
+    
+    for process in processes:
+        process.daemon = True
+        process.start()
+    
+    def feed():
+        try:
+            for group in groups:
+                tasks.put([(offset, count, TileIDs.key(coord)) for (offset, count, coord) in group])
+        finally:
+            # one for each worker.
+            for process in processes:
+                tasks.put(None)
+    
+    feeder = Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    
+    return collectResults(processes, results, error_list)
+
+def collectResults(processes, results, error_list):
+    """ Generate a stream of lists of (offset, count, coordinate, size, error) tuples.
+    
+        Gathers outcomes from a queue of results filled by worker processes,
+        until each of them is finished. Errors are raised if there's no
+        error list.
+    """
+    workers, finished = len(processes), 0
+    
+    while finished < workers:
+        try:
+            result = results.get(True, 1)
+        
+        except Empty:
+            if [process for process in processes if process.exitcode not in (None, 0)]:
+                for process in processes:
+                    process.terminate()
+                
+                raise Exception('A worker process died unexpectedly.')
+            
+            continue
+        
+        if result is None:
+            finished += 1
+            continue
+        
+        outcome = [(offset, count, TileIDs.from_key(key), size, error)
+                   for (offset, count, key, size, error) in result]
+        
+        for (offset, count, coord, size, error) in outcome:
+            if error and not error_list:
+                for process in processes:
+                    process.terminate()
+                
+                raise Exception('Failed %d/%d/%d:\n%s' % (coord.zoom, coord.column, coord.row, error))
+        
+        yield outcome
+
+def queueWorker(config_dict, config_dirpath, layername, extension, ignore_cached, attempts, verbose, queuefile, results):
+    """ Seed metatiles leased from a work queue and put the outcomes on a queue of results.
+    
+        Units are leased until the queue has none left for the layer and no
+        leases are outstanding, since an expired lease may need to be taken
+        over. Failed tiles are reported back to the work queue.
+    """
+    config = buildConfiguration(config_dict, config_dirpath)
+    layer = config.layers[layername]
+    queue = WorkQueue.SQLiteQueue(queuefile)
+    worker = '%s:%d' % (gethostname(), getpid())
+    
+    def outcomes():
+        while True:
+            unit = queue.lease(worker, layername)
+            
+            if unit is None:
+                if queue.stats()['units leased']:
+                    # some of those leases may be ours, waiting on a flush.
+                    yield None
+                    sleep(5)
+                    continue
+                
+                break
+            
+            id, extension, tiles = unit
+            group = [(offset, count, Coordinate(row, column, zoom)) for (offset, count, row, column, zoom) in tiles]
+            yield id, seedMetatile(layer, group, extension, ignore_cached, attempts, verbose, True)
+    
+    # units are acknowledged only once their tiles are committed.
+    for (id, outcome) in committedResults(config.cache, outcomes()):
+        failures = [((coord.row, coord.column, coord.zoom), error.strip().split('\n')[-1])
+                    for (offset, count, coord, size, error) in outcome if error]
+        
+        queue.ack(id, failures)
+        
+        results.put([(offset, count, TileIDs.key(coord), size, error)
+                     for (offset, count, coord, size, error) in outcome])
+    
+    results.put(None)
+
+def seedQueue(config_dict, config_dirpath, layer, queuefile, extension, ignore_cached, attempts, verbose, workers):
+    """ Generate a stream of lists of (offset, count, coordinate, size, error) tuples.
+    
+        Metatiles are leased from a shared work queue by a number of worker
+        processes. Failed tiles are recorded in the queue, and never raised.
+    """
+    results = Queue()
+    
+    args = config_dict, config_dirpath, layer.name(), extension, ignore_cached, attempts, verbose, queuefile, results
+    processes = [Process(target=queueWorker, args=args) for index in range(max(1, workers))]
+    
+    for process in processes:
+        process.daemon = True
+        process.start()
+    
+    return collectResults(processes, results, True)
+
+def writeAtomically(filename, data):
+    """ Write data to a JSON file by way of a temporary file and a rename.
+    
+        Readers of the file never see it half-written.
+    """
+    tmpname = '%s.tmp' % filename
+    fp = open(tmpname, 'w')
+    json_dump(data, fp)
+    fp.close()
+    rename(tmpname, filename)
+
+class Checkpoint:
+    """ Compact record of finished metatiles, written to a file now and then.
+    
+        Groups of tiles from metatileGroups() cover consecutive offsets in the
+        stream of coordinates, so finished metatiles are kept as a short list
+        of merged [start, stop) offset ranges, along with a signature of the
+        options that produced the stream. A metatile is only recorded when
+        every one of its tiles was seeded without error.
+    """
+    def __init__(self, filename, signature, interval=10):
+        self.filename = filename
+        self.signature = signature
+        self.interval = interval
+        
+        self.ranges = []
+        self.skipped = 0
+        self.saved = time()
+    
+    def load(self):
+        """ Read finished ranges from the file, if it exists.
+        
+            Raise KnownUnknown if the file was written for other options.
+        """
+        if not exists(self.filename):
+            return
+        
+        data = json_load(open(self.filename, 'r'))
+        
+        if data['signature'] != self.signature:
+            raise KnownUnknown('Checkpoint file "%s" was written with different options, it can\'t be resumed.' % self.filename)
+        
+        self.ranges = [tuple(r) for r in data['ranges']]
+    
+    def add(self, start, stop):
+        """ Record a finished range of offsets, merging it with its neighbors.
+        """
+        ranges = self.ranges + [(start, stop)]
+        ranges.sort()
+        
+        self.ranges = ranges[:1]
+        
+        for (start, stop) in ranges[1:]:
+            if start <= self.ranges[-1][1]:
+                self.ranges[-1] = (self.ranges[-1][0], max(stop, self.ranges[-1][1]))
+            else:
+                self.ranges.append((start, stop))
+    
+    def covers(self, start, stop):
+        """ Return true if a range of offsets is finished.
+        """
+        index = bisect_right(self.ranges, (start, float('inf'))) - 1
+        return index >= 0 and self.ranges[index][0] <= start and stop <= self.ranges[index][1]
+    
+    def skip(self, groups):
+        """ Generate groups from a stream, leaving out the ones already finished.
+        """
+        for group in groups:
+            if self.covers(group[0][0], group[-1][0] + 1):
+                self.skipped += len(group)
+            else:
+                yield group
+    
+    def save(self, force=False):
+        """ Write the file, unless it was written less than an interval ago.
+        """
+        if force or time() - self.saved >= self.interval:
+            writeAtomically(self.filename, dict(signature=self.signature, ranges=self.ranges))
+            self.saved = time()
+
 if __name__ == '__main__':
     options, zooms = parser.parse_args()
 
@@ -181,11 +780,26 @@ if __name__ == '__main__':
     from TileStache.Core import KnownUnknown
     from TileStache.Config import buildConfiguration
     from TileStache import MBTiles
+    from TileStache import Coverage
+    from TileStache import Curves
+    from TileStache import TileIDs
+    from TileStache import WorkQueue
     import TileStache
     
     from ModestMaps.Core import Coordinate
     from ModestMaps.Geo import Location
 
+    if options.queue_stats:
+        if not options.queue:
+            parser.error('--queue-stats needs a --queue file.')
+        
+        json_dump(WorkQueue.SQLiteQueue(options.queue).stats(), stdout, indent=2)
+        print >> stdout, ''
+        exit(0)
+    
+    if options.enqueue and not options.queue:
+        parser.error('--enqueue needs a --queue file.')
+
     try:
         # determine if we have enough information to prep a config and layer
         
@@ -220,14 +834,14 @@ if __name__ == '__main__':
         
         if options.outputdirectory and options.mbtiles_output:
             cache1_dict = dict(name='disk', path=options.outputdirectory, dirs='portable', gzip=[])
-            cache2_dict = {'class': 'TileStache.MBTiles:Cache', 'kwargs': dict(filename=options.mbtiles_output, format=extension, name=options.layer)}
+            cache2_dict = {'class': 'TileStache.MBTiles:Cache', 'kwargs': dict(filename=options.mbtiles_output, format=extension, name=options.layer, dedupe=bool(options.mbtiles_dedupe), batch=1000)}
             config_dict['cache'] = dict(name='multi', tiers=[cache1_dict, cache2_dict])
 
         elif options.outputdirectory:
             config_dict['cache'] = dict(name='disk', path=options.outputdirectory, dirs='portable', gzip=[])
 
         elif options.mbtiles_output:
-            config_dict['cache'] = {'class': 'TileStache.MBTiles:Cache', 'kwargs': dict(filename=options.mbtiles_output, format=extension, name=options.layer)}
+            config_dict['cache'] = {'class': 'TileStache.MBTiles:Cache', 'kwargs': dict(filename=options.mbtiles_output, format=extension, name=options.layer, dedupe=bool(options.mbtiles_dedupe), batch=1000)}
         
         if options.mbtiles_input:
             layer_dict['provider'] = dict(name='mbtiles', tileset=options.mbtiles_input)
@@ -267,65 +881,168 @@ if __name__ == '__main__':
     except KnownUnknown, e:
         parser.error(str(e))
 
+    if options.polygon and options.order == 'row' and not (tile_list or options.mbtiles_input):
+        parser.error('Tiles from --polygon can be seeded in "zorder" or "hilbert" order, not "row".')
+    
     if tile_list:
-        coordinates = listCoordinates(tile_list)
+        coordinates = listCoordinates(tile_list, options.order, layer.metatile)
     elif options.mbtiles_input:
-        coordinates = tilesetCoordinates(options.mbtiles_input)
+        coordinates = tilesetCoordinates(options.mbtiles_input, zooms or None, options.order, layer.metatile)
+    elif options.polygon:
+        coordinates = polygonCoordinates(options.polygon, layer.projection, zooms, options.order or 'zorder')
     else:
-        coordinates = generateCoordinates(ul, lr, zooms, padding)
+        coordinates = generateCoordinates(ul, lr, zooms, padding, layer.metatile, options.order or 'row')
     
-    coordinates = list(coordinates)
+    groups = metatileGroups(layer, coordinates)
     
-    for (offset, count, coord) in coordinates:
-        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
-
-        progress = {"tile": path,
-                    "offset": offset + 1,
-                    "total": count}
-
-        #
-        # Fetch a tile.
-        #
+    if options.checkpoint:
+        signature = dict(layer=layer.name(), extension=extension, zooms=zooms, bbox=options.bbox,
+                         padding=padding, tile_list=tile_list, mbtiles_input=options.mbtiles_input,
+                         polygon=options.polygon, order=options.order)
         
-        attempts = options.enable_retries and 3 or 1
-        rendered = False
+        # a round trip through JSON makes the signature comparable to a loaded one.
+        checkpoint = Checkpoint(options.checkpoint, json_loads(json_dumps(signature)))
         
-        while not rendered:
-            if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
-    
+        if options.resume:
             try:
-                mimetype, content = getTile(layer, coord, extension, options.ignore_cached)
+                checkpoint.load()
+            except KnownUnknown, e:
+                parser.error(str(e))
             
-            except:
-                #
-                # Something went wrong: try again? Log the error?
-                #
-                attempts -= 1
-
+            groups = checkpoint.skip(groups)
+    
+    elif options.resume:
+        parser.error('--resume needs a --checkpoint file.')
+    
+    attempts = options.enable_retries and 3 or 1
+    
+    if options.estimate:
+        layer.write_cache = False
+        mimetype, format = layer.getTypeByExtension(extension)
+        
+        if tile_list or options.mbtiles_input:
+            samples = streamSample(coordinates, options.samples)
+        elif options.polygon:
+            polygons = Coverage.load_polygons(open(options.polygon, 'r'), layer.projection)
+            samples = dict([(zoom, (Coverage.count_tiles(polygons, [zoom]), Coverage.sample_tiles(polygons, zoom, options.samples)))
+                            for zoom in zooms])
+        else:
+            samples = dict([(zoom, bboxSample(ul, lr, zoom, padding, options.samples)) for zoom in zooms])
+        
+        durations = [('h', 3600.), ('min', 60.), ('s', 1.)]
+        filesizes = [('TB', 1024. ** 4), ('GB', 1024. ** 3), ('MB', 1024. ** 2), ('KB', 1024.), ('bytes', 1.)]
+        totals = dict(count=0, files=(0., 0.), seconds=(0., 0.), size=(0., 0.))
+        
+        print >> stdout, '%4s %12s %8s %20s %20s %24s' % ('zoom', 'tiles', 'sampled', 'files', 'render time', 'encoded size')
+        
+        for zoom in sorted(samples):
+            count, coords = samples[zoom]
+            measures = []
+            
+            for coord in coords:
+                measures.append(estimateTile(layer, coord, format))
+                
                 if options.verbose:
-                    print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
+                    print >> stderr, 'Sampled %s/%d/%d/%d.%s in %.3fs' % (layer.name(), coord.zoom, coord.column, coord.row, extension, measures[-1][0])
+            
+            times, sizes, saves = measures and zip(*measures) or ((), (), ())
+            
+            files = extrapolate([saved and 1 or 0 for saved in saves], count)
+            seconds = extrapolate(times, count)
+            size = extrapolate(sizes, count)
+            
+            # margins of independent zooms add in quadrature.
+            totals['count'] += count
+            
+            for (key, (value, margin)) in (('files', files), ('seconds', seconds), ('size', size)):
+                totals[key] = totals[key][0] + value, sqrt(totals[key][1] ** 2 + margin ** 2)
+            
+            print >> stdout, '%4d %12d %8d %20s %20s %24s' % (zoom, count, len(coords), '%.0f +/- %.0f' % files,
+                                                              formatEstimate(seconds[0], seconds[1], durations),
+                                                              formatEstimate(size[0], size[1], filesizes))
+        
+        print >> stdout, '%4s %12d %8s %20s %20s %24s' % ('all', totals['count'], '', '%.0f +/- %.0f' % totals['files'],
+                                                          formatEstimate(totals['seconds'][0], totals['seconds'][1], durations),
+                                                          formatEstimate(totals['size'][0], totals['size'][1], filesizes))
+        
+        print >> stdout, 'Margins are 95% confidence intervals; render time is for a single process.'
+        exit(0)
+    
+    if options.queue and options.enqueue:
+        units = ((layer.name(), extension, [(offset, count, coord.row, coord.column, coord.zoom)
+                                            for (offset, count, coord) in group])
+                 for group in groups)
+        
+        added = WorkQueue.SQLiteQueue(options.queue).put(units)
+        
+        if options.verbose:
+            print >> stderr, 'Added %d metatiles to %s' % (added, options.queue)
+        
+        exit(0)
+    
+    if options.queue:
+        results = seedQueue(config_dict, config_dirpath, layer, options.queue, extension,
+                            options.ignore_cached, attempts, options.verbose, options.workers)
+    
+    elif options.workers > 1:
+        results = seedParallel(config_dict, config_dirpath, layer, groups, extension,
+                               options.ignore_cached, attempts, options.verbose, error_list, options.workers)
+    else:
+        results = seedSerial(layer, groups, extension,
+                             options.ignore_cached, attempts, options.verbose, error_list)
+    
+    done, progress, progress_saved = 0, None, 0
+    
+    try:
+        for outcome in results:
+            for (offset, count, coord, size, error) in outcome:
+                done += 1
+                path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
                 
-                if attempts == 0:
-                    if not error_list:
-                        raise
-                    
+                if options.checkpoint:
+                    skipped = checkpoint.skipped
+                else:
+                    skipped = 0
+        
+                progress = {"tile": path,
+                            "offset": done + skipped,
+                            "total": count}
+        
+                if error and error_list:
+                    #
+                    # Something went wrong, log the error.
+                    #
                     fp = open(error_list, 'a')
                     fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
                     fp.close()
-                    break
+                
+                elif error:
+                    #
+                    # Something went wrong, the work queue has the error.
+                    #
+                    if options.verbose:
+                        print >> stderr, '%(offset)d of %(total)d... %(tile)s failed' % progress
+                
+                else:
+                    #
+                    # Successfully got the tile.
+                    #
+                    progress['size'] = '%dKB' % (size / 1024)
             
-            else:
-                #
-                # Successfully got the tile.
-                #
-                rendered = True
-                progress['size'] = '%dKB' % (len(content) / 1024)
+                    if options.verbose:
+                        print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s)' % progress
+            
+            if options.checkpoint and not [coord for (offset, count, coord, size, error) in outcome if error]:
+                checkpoint.add(outcome[0][0], outcome[-1][0] + 1)
+                checkpoint.save()
+            
+            if options.progressfile and time() - progress_saved >= 1:
+                writeAtomically(options.progressfile, progress)
+                progress_saved = time()
+    
+    finally:
+        if options.checkpoint:
+            checkpoint.save(True)
         
-                if options.verbose:
-                    print >> stderr, '%(tile)s (%(size)s)' % progress
-                
-        if options.progressfile:
-            fp = open(options.progressfile, 'w')
-            json_dump(progress, fp)
-            fp.close()
+        if options.progressfile and progress:
+            writeAtomically(options.progressfile, progress)
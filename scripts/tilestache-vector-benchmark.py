@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""tilestache-vector-benchmark.py compares vector tile encoders.
+
+This script is intended to be run directly. It reads the features of every tile
+in an area from a Vector provider layer once, then encodes them as GeoJSON or
+Arc JSON both with the streaming encoder of TileStache.Vector.Stream and with
+the older path through dictionaries, JSONEncoder and a float regular expression.
+It reports encoding time and size for each and checks that both give the same
+response once floats are rounded. This example compares encoders for the area
+around West Oakland (http://sta.mn/ck) at zoom levels 14-15:
+
+    tilestache-vector-benchmark.py -c ./config.json -l roads -b 37.79 -122.35 37.83 -122.25 14 15
+
+See `tilestache-vector-benchmark.py --help` for more information.
+"""
+
+from sys import stderr, stdout, path
+from time import time
+from StringIO import StringIO
+from optparse import OptionParser
+
+try:
+    from json import loads as json_loads
+except ImportError:
+    from simplejson import loads as json_loads
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] [zoom...]
+
+Encodes the tiles of a single Vector provider layer in your TileStache
+configuration with both the streaming and the older encoder, and prints
+encoding time and size for each. Nothing is written to the cache. Features
+are read from the datasource once, before either encoder runs, so only
+encoding is timed. Bounding box is given as a pair of lat/lon coordinates,
+e.g. "37.788 -122.349 37.833 -122.246".
+
+Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
+
+defaults = dict(extension='geojson', repeat=1, verbose=True, bbox=(37.777, -122.352, 37.839, -122.226))
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name from configuration.')
+
+parser.add_option('-b', '--bbox', dest='bbox',
+                  help='Bounding box in floating point geographic coordinates: south west north east. Default value is %.3f, %.3f, %.3f, %.3f.' % defaults['bbox'],
+                  type='float', nargs=4)
+
+parser.add_option('-e', '--extension', dest='extension',
+                  help='File type for encoded tiles, "geojson" or "arcjson". Default value is %s.' % repr(defaults['extension']))
+
+parser.add_option('-r', '--repeat', dest='repeat',
+                  help='Number of times to encode every tile with each encoder. Default value is %s.' % repr(defaults['repeat']),
+                  type='int')
+
+parser.add_option('-q', action='store_false', dest='verbose',
+                  help='Suppress chatty output.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+def areaCoordinates(ul, lr, zooms):
+    """ Return a list of Coordinates for every tile in an area.
+    """
+    coords = []
+
+    for zoom in zooms:
+        ul_ = ul.zoomTo(zoom).container()
+        lr_ = lr.zoomTo(zoom).container()
+
+        for row in range(int(ul_.row), int(lr_.row) + 1):
+            for column in range(int(ul_.column), int(lr_.column) + 1):
+                coords.append(Coordinate(row, column, zoom))
+
+    return coords
+
+def encodeOld(content, format, id_property, precision):
+    """ Encode content the older way, through dictionaries of features.
+    """
+    content = dict(content)
+    content['features'] = [Vector._feature_dict(prop, geometry, id_property) for (prop, geometry) in content['features']]
+
+    if format == 'ArcJSON':
+        content = Vector.reserialize_to_arc(content, False)
+
+    elif 'wkt' in content['crs']:
+        content['crs'] = {'type': 'link', 'properties': {'href': '0.wkt', 'type': 'ogcwkt'}}
+
+    else:
+        del content['crs']
+
+    out = StringIO()
+    Vector._encode_json(out, content, None, precision)
+
+    return out.getvalue()
+
+def encodeNew(content, format, id_property, precision):
+    """ Encode content with the streaming encoder.
+    """
+    out = StringIO()
+    Vector.VectorResponse(content, False, precision, id_property).save(out, format)
+
+    return out.getvalue()
+
+def rounded(value, precision):
+    """ Return a parsed JSON value with every number rounded, for comparisons.
+    """
+    if type(value) in (int, long, float):
+        return round(value, precision)
+
+    elif type(value) is list:
+        return [rounded(item, precision) for item in value]
+
+    elif type(value) is dict:
+        return dict([(key, rounded(item, precision)) for (key, item) in value.items()])
+
+    return value
+
+if __name__ == '__main__':
+    options, zooms = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from TileStache import parseConfigfile, Vector
+    from TileStache.Core import KnownUnknown
+
+    from ModestMaps.Core import Coordinate
+    from ModestMaps.Geo import Location
+
+    try:
+        if options.config is None:
+            raise KnownUnknown('Missing required configuration (--config) parameter.')
+
+        if options.layer is None:
+            raise KnownUnknown('Missing required layer (--layer) parameter.')
+
+        config = parseConfigfile(options.config)
+
+        if options.layer not in config.layers:
+            raise KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (options.layer, ', '.join(sorted(config.layers.keys()))))
+
+        layer = config.layers[options.layer]
+        provider = layer.provider
+
+        if not isinstance(provider, Vector.Provider):
+            raise KnownUnknown('"%s" is not a Vector provider layer.' % options.layer)
+
+        mimetype, format = provider.getTypeByExtension(options.extension)
+
+        if format not in ('GeoJSON', 'ArcJSON'):
+            raise KnownUnknown('Only "geojson" and "arcjson" can be compared, not "%s".' % options.extension)
+
+        lat1, lon1, lat2, lon2 = options.bbox
+        south, west = min(lat1, lat2), min(lon1, lon2)
+        north, east = max(lat1, lat2), max(lon1, lon2)
+
+        ul = layer.projection.locationCoordinate(Location(north, west))
+        lr = layer.projection.locationCoordinate(Location(south, east))
+
+        for (i, zoom) in enumerate(zooms):
+            if not zoom.isdigit():
+                raise KnownUnknown('"%s" is not a valid numeric zoom level.' % zoom)
+
+            zooms[i] = int(zoom)
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    encoders = (('old', encodeOld), ('stream', encodeNew))
+    seconds = dict([(name, 0.) for (name, encode) in encoders])
+    sizes = dict([(name, 0) for (name, encode) in encoders])
+    features, mismatches = 0, []
+
+    coords = areaCoordinates(ul, lr, zooms)
+
+    if options.verbose:
+        print >> stderr, 'Encoding %d tiles' % len(coords)
+
+    for coord in coords:
+        response = provider.renderTile(256, 256, layer.projection.srs, coord)
+
+        # read features from the datasource once, outside the timing.
+        content = dict(response.content)
+        content['features'] = list(content['features'])
+        features += len(content['features'])
+
+        bodies = {}
+
+        for (name, encode) in encoders:
+            start = time()
+
+            for repeat in range(options.repeat):
+                bodies[name] = encode(content, format, provider.id_property, provider.precision)
+
+            seconds[name] += time() - start
+            sizes[name] += len(bodies[name])
+
+        old, new = [rounded(json_loads(bodies[name]), provider.precision) for (name, encode) in encoders]
+
+        if old != new:
+            mismatches.append(coord)
+
+        if options.verbose:
+            print >> stderr, '.',
+
+    if options.verbose:
+        print >> stderr, ''
+
+    print >> stdout, '%-8s %8s %10s %12s %10s' % ('encoder', 'tiles', 'features', 'bytes', 'seconds')
+
+    for (name, encode) in encoders:
+        print >> stdout, '%-8s %8d %10d %12d %10.3f' % (name, len(coords), features, sizes[name], seconds[name])
+
+    print >> stdout, 'stream is %.1fx as fast as old' % (seconds['old'] / max(seconds['stream'], 1e-9))
+
+    for coord in mismatches:
+        print >> stdout, 'Different responses for tile %d/%d/%d' % (coord.zoom, coord.column, coord.row)
@@ -16,7 +16,7 @@ setup(name='TileStache',
                 'TileStache.Goodies',
                 'TileStache.Goodies.Caches',
                 'TileStache.Goodies.Providers'],
-      scripts=['scripts/tilestache-compose.py', 'scripts/tilestache-seed.py', 'scripts/tilestache-clean.py', 'scripts/tilestache-server.py', 'scripts/tilestache-render.py'],
+      scripts=['scripts/tilestache-compose.py', 'scripts/tilestache-seed.py', 'scripts/tilestache-clean.py', 'scripts/tilestache-expire.py', 'scripts/tilestache-server.py', 'scripts/tilestache-render.py'],
       data_files=[('share/tilestache', ['TileStache/Goodies/Providers/DejaVuSansMono-alphanumeric.ttf'])],
       download_url='http://tilestache.org/download/TileStache-%(version)s.tar.gz' % locals(),
       license='BSD')
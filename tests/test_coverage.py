@@ -0,0 +1,85 @@
+""" Tests for TileStache.Coverage.
+
+Run with "python -m unittest discover tests" from the top of the repository.
+"""
+import unittest
+
+from random import Random
+from StringIO import StringIO
+
+try:
+    from json import dumps as json_dumps
+except ImportError:
+    from simplejson import dumps as json_dumps
+
+from ModestMaps.Geo import Location
+
+from TileStache.Geography import SphericalMercator
+from TileStache import Coverage
+
+def square(lon, lat, size):
+    """ Return a GeoJSON polygon for a square with its lower-left corner at a place.
+    """
+    ring = [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]
+    return StringIO(json_dumps({'type': 'Polygon', 'coordinates': [ring]}))
+
+class SmallPolygonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.projection = SphericalMercator()
+
+    def test_seed_small_polygons(self):
+        for size in (1, .01, .001):
+            polygons = Coverage.load_polygons(square(-122.4, 37.7, size), self.projection)
+            middle = Location(37.7 + size / 2, -122.4 + size / 2)
+
+            for zoom in (0, 10, 14, 18):
+                coords = list(Coverage.list_tiles(polygons, [zoom]))
+                center = self.projection.locationCoordinate(middle).zoomTo(zoom).container()
+
+                self.assertTrue(coords, 'No tiles for a %s degree square at zoom %d' % (size, zoom))
+                self.assertEqual(len(coords), Coverage.count_tiles(polygons, [zoom]))
+                self.assertTrue((center.zoom, center.column, center.row) in [(c.zoom, c.column, c.row) for c in coords])
+
+    def test_sample_small_polygons(self):
+        for size in (1, .01, .001):
+            polygons = Coverage.load_polygons(square(-122.4, 37.7, size), self.projection)
+
+            for zoom in (0, 10, 14, 18):
+                count = Coverage.count_tiles(polygons, [zoom])
+                coords = Coverage.sample_tiles(polygons, zoom, 16, Random(0).random)
+                keys = [(c.zoom, c.column, c.row) for c in coords]
+
+                self.assertTrue(coords, 'No samples for a %s degree square at zoom %d' % (size, zoom))
+                self.assertEqual(len(set(keys)), min(count, 16))
+
+                if count <= 16:
+                    # every tile is sampled.
+                    expected = [(c.zoom, c.column, c.row) for c in Coverage.list_tiles(polygons, [zoom])]
+                    self.assertEqual(sorted(keys), sorted(expected))
+
+    def test_polygon_outside_tile(self):
+        polygons = Coverage.load_polygons(square(-122.4, 37.7, .001), self.projection)
+        clipped, state = Coverage._test(polygons, .5, .5, 1., 1.)
+
+        self.assertEqual(state, Coverage._outside)
+
+class OverlappingPolygonTests(unittest.TestCase):
+
+    def test_overlapping_polygons_partial(self):
+        # two overlapping strips that cover 90% of the box between them.
+        left = [[(0., 0.), (.6, 0.), (.6, 1.), (0., 1.), (0., 0.)]]
+        right = [[(.3, 0.), (.9, 0.), (.9, 1.), (.3, 1.), (.3, 0.)]]
+        clipped, state = Coverage._test([left, right], 0., 0., 1., 1.)
+
+        self.assertEqual(state, Coverage._partial)
+
+    def test_covering_polygon_inside(self):
+        small = [[(.3, 0.), (.9, 0.), (.9, 1.), (.3, 1.), (.3, 0.)]]
+        whole = [[(-1., -1.), (2., -1.), (2., 2.), (-1., 2.), (-1., -1.)]]
+        clipped, state = Coverage._test([small, whole], 0., 0., 1., 1.)
+
+        self.assertEqual(state, Coverage._inside)
+
+if __name__ == '__main__':
+    unittest.main()